@@ -0,0 +1,114 @@
+"""Measure per-packet overhead of `delay_analysis_*` probes attached with kprobes and with fentry.
+
+Runs a 1-byte TCP ping-pong over loopback, first without probes and then with each probe in each attach mode, and reports the round-trip time along with its increase over the baseline. Requires root and BCC.
+
+Usage: sudo python -m benchmarks.delay_analysis_attach [--round-trips N]
+"""
+
+import argparse
+import logging
+import socket
+from threading import Thread
+from time import perf_counter_ns
+from typing import Optional
+
+from network_tracing.daemon.tracing.poller import Poller
+from network_tracing.daemon.tracing.probes import (delay_analysis_in,
+                                                   delay_analysis_out)
+from network_tracing.daemon.utilities import global_state
+
+PROBES = {
+    'delay_analysis_out': delay_analysis_out.Probe,
+    'delay_analysis_in': delay_analysis_in.Probe,
+}
+ATTACH_MODES = ('kprobe', 'fentry')
+DEFAULT_ROUND_TRIPS = 200000
+WARMUP_ROUND_TRIPS = 1000
+
+
+def _echo(server: socket.socket) -> None:
+    connection, _ = server.accept()
+    with connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            data = connection.recv(1)
+            if not data:
+                return
+            connection.sendall(data)
+
+
+def _measure(round_trips: int) -> float:
+    """Return mean round-trip time in nanoseconds."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        thread = Thread(target=_echo, args=(server, ), daemon=True)
+        thread.start()
+
+        with socket.create_connection(server.getsockname()) as client:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for _ in range(WARMUP_ROUND_TRIPS):
+                client.sendall(b'x')
+                client.recv(1)
+
+            start = perf_counter_ns()
+            for _ in range(round_trips):
+                client.sendall(b'x')
+                client.recv(1)
+            elapsed = perf_counter_ns() - start
+
+        thread.join()
+    return elapsed / round_trips
+
+
+def _run(name: str, attach_mode: Optional[str],
+         round_trips: int) -> Optional[float]:
+    if attach_mode is None:
+        return _measure(round_trips)
+
+    try:
+        probe = PROBES[name](lambda event: None, {
+            'attach_mode': attach_mode,
+            'stats_interval': None,
+        })
+    except Exception as e:
+        print('{} ({}): unavailable: {}'.format(name, attach_mode, e))
+        return None
+
+    probe.start()
+    try:
+        return _measure(round_trips)
+    finally:
+        probe.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--round-trips',
+                        type=int,
+                        default=DEFAULT_ROUND_TRIPS,
+                        help='number of round trips per measurement')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    poller = Poller()
+    global_state.poller = poller
+    poller.start()
+    try:
+        baseline = _run('', None, args.round_trips)
+        print('{:<20} {:<8} {:>10.0f} ns/round trip'.format(
+            'baseline', '-', baseline))
+        for name in PROBES:
+            for attach_mode in ATTACH_MODES:
+                result = _run(name, attach_mode, args.round_trips)
+                if result is None:
+                    continue
+                print('{:<20} {:<8} {:>10.0f} ns/round trip  (+{:.0f} ns)'.
+                      format(name, attach_mode, result, result - baseline))
+    finally:
+        poller.stop()
+        global_state.poller = None
+
+
+if __name__ == '__main__':
+    main()
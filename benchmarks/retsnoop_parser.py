@@ -0,0 +1,267 @@
+"""Compare throughput of the previous and current parsers of `retsnoop` output.
+
+Parses captured `retsnoop` stdout (as written by the `log_path` option of the `retsnoop` probe) with a copy of the previous line-by-line parser and with the current one, and reports lines/sec of each. If no capture is given, a synthetic one is generated. Requires neither root nor BCC.
+
+Usage: python -m benchmarks.retsnoop_parser [LOG_PATH ...] [--synthetic-events N] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+from dataclasses import dataclass, field
+from socket import AF_INET, inet_ntop
+from struct import pack
+from time import perf_counter
+from typing import Any, Callable, Optional, TextIO
+
+from network_tracing.daemon.tracing.probes.retsnoop import (FunctionsPerFlow,
+                                                            ProbeEvent,
+                                                            ProbeOptions,
+                                                            _OutputParser)
+
+DEFAULT_SYNTHETIC_EVENTS = 20000
+DEFAULT_REPEAT = 3
+READ_SIZE = 65536
+
+_RE_HEADER = re.compile(
+    r'(?P<timestamp>\d{19}) -> .* TID/PID (?P<tid>\d*)\/(?P<pid>\d*) \((?P<tname>.*)\/(?P<pname>.*)\)',
+    re.U)
+_RE_MISSING_RECORD = re.compile(r'‼ ... missing.*', re.U)
+_RE_FUNCTION_ENTRY = re.compile(
+    r'\s*[→]\s(?P<name>[a-zA-Z_]*)~\d*~\s*=>(?P<saddr>\d*)-(?P<sport>\d*)-(?P<daddr>\d*)-(?P<dport>\d*)#',
+    re.U)
+_RE_FUNCTION_EXIT = re.compile(
+    r'\s*(?P<mark>[↔←])\s(?P<name>[a-zA-Z_]*)~\d*~\s*\[.*\]\s*~(?P<time>[0-9]*\.[0-9]*)us<=(?P<saddr>\d*)-(?P<sport>\d*)-(?P<daddr>\d*)-(?P<dport>\d*)#',
+    re.U)
+_RE_TAIL = re.compile(r'-END-', re.U)
+
+
+def legacy_parse(stream: TextIO, options: ProbeOptions,
+                 submit_event: Callable[[Any], Any]) -> None:
+    """The parser as it was before `_OutputParser`, with logging removed and the loop ending at EOF."""
+
+    @dataclass
+    class Context:
+        event: Optional[ProbeEvent] = field(default=None)
+        curr_depth: int = field(default=-1)
+        max_depth: int = field(default=-1)
+        ignored_count: int = field(default=0)
+        non_header_count: int = field(default=0)
+
+        def reset(self) -> None:
+            self.event = None
+            self.curr_depth = -1
+            self.max_depth = -1
+
+    context = Context()
+
+    def handle_header(line: str):
+        if context.event is not None:
+            return
+
+        if (header := re.match(_RE_HEADER, line)) is None:
+            context.non_header_count += 1
+            if context.non_header_count >= 256:
+                context.non_header_count = 0
+            return
+
+        if context.non_header_count:
+            context.non_header_count = 0
+
+        header_fields = header.groupdict()
+        for field in ('timestamp', 'pid', 'tid'):
+            header_fields[field] = int(header_fields[field])
+        context.reset()
+        context.event = ProbeEvent.from_dict(header_fields)
+
+    def handle_missing_record(line: str):
+        if context.event is None:
+            return
+
+        if re.match(_RE_MISSING_RECORD, line):
+            context.event = None
+            return
+
+    def handle_function_entry(line: str):
+        if context.event is None:
+            return
+
+        if (function_entry := re.match(_RE_FUNCTION_ENTRY, line)) is None:
+            return
+
+        saddr_bytes = pack('I', int(function_entry.group('saddr')))
+        if options.ignore_matcher.match_ip4_bytes(saddr_bytes):
+            context.event = None
+            context.ignored_count += 1
+            if context.ignored_count >= 256:
+                context.ignored_count = 0
+            return
+
+        if context.ignored_count:
+            context.ignored_count = 0
+
+        if function_entry.group('name') == '__tcp_transmit_skb':
+            sport, daddr_int, dport = map(
+                int, function_entry.group('sport', 'daddr', 'dport'))
+            daddr_bytes = pack('I', daddr_int)
+            saddr, daddr = map(lambda ip_bytes: inet_ntop(AF_INET, ip_bytes),
+                               (saddr_bytes, daddr_bytes))
+            flow_data = FunctionsPerFlow(saddr, sport, daddr, dport)
+            context.curr_depth += 1
+            if context.max_depth < context.curr_depth:
+                context.max_depth = context.curr_depth
+            context.event.flows.append(flow_data)
+
+    def handle_function_exit(line: str):
+        if context.event is None:
+            return
+
+        if (function_exit := re.match(_RE_FUNCTION_EXIT, line)) is None:
+            return
+
+        if context.curr_depth < 0:
+            context.event = None
+            return
+
+        mark, name, time_str = function_exit.group('mark', 'name', 'time')
+        time = float(time_str)
+        flow_functions = context.event.flows[context.curr_depth].functions
+        flow_functions[name] = flow_functions.get(name, 0.0) + time
+        process_functions = context.event.functions
+        process_functions[name] = flow_functions.get(name, 0.0) + time
+        if mark == '←' and name == '__tcp_transmit_skb':
+            context.curr_depth -= 1
+            if context.curr_depth < -1:
+                context.event = None
+                return
+
+    def handle_tail(line: str):
+        if context.event is None:
+            return
+
+        if re.match(_RE_TAIL, line):
+            submit_event(context.event)
+            context.event = None
+            return
+
+    while line := stream.readline():
+        line = line.strip()
+        if not line:
+            continue
+        for handler in (handle_header, handle_missing_record,
+                        handle_function_entry, handle_function_exit,
+                        handle_tail):
+            handler(line)
+
+
+def current_parse(fd: int, options: ProbeOptions,
+                  submit_events: Callable[..., Any]) -> None:
+    parser = _OutputParser(options, submit_events)
+    while data := os.read(fd, READ_SIZE):
+        parser.feed(data)
+    parser.close()
+
+
+def generate_log(path: str, events: int) -> None:
+    """Write a log resembling `retsnoop -T -S -e __tcp_transmit_skb` output, with nested calls and occasional gaps."""
+    rng = random.Random(0)
+    functions = [
+        'tcp_write_xmit', 'ip_queue_xmit', 'dev_queue_xmit',
+        'dev_hard_start_xmit', '_raw_spin_lock_bh', 'skb_clone'
+    ]
+    # 10.0.0.x and 10.0.1.x in the byte order retsnoop prints them
+    saddr = int.from_bytes(bytes((10, 0, 0, 1)), 'little')
+    daddr = int.from_bytes(bytes((10, 0, 1, 1)), 'little')
+    with open(path, 'w', encoding='utf-8') as fp:
+        timestamp = 1700000000000000000
+        for i in range(events):
+            timestamp += rng.randrange(1000, 100000)
+            tid = rng.randrange(1000, 5000)
+            fp.write('{} -> {} TID/PID {}/{} (iperf3/iperf3):\n\n'.format(
+                timestamp, timestamp + 50000, tid, tid))
+            if i % 50 == 0:
+                fp.write('‼ ... missing 2 records ...\n')
+            sport = rng.randrange(30000, 60000)
+            address = '{}-{}-{}-{}#'.format(saddr, sport, daddr, 5201)
+            fp.write('    → __tcp_transmit_skb~1~ =>{}\n'.format(address))
+            for depth, name in enumerate(rng.sample(functions, 4), start=2):
+                fp.write('    {}→ {}~{}~ =>{}\n'.format(
+                    '  ' * depth, name, depth, address))
+                fp.write('    {}← {}~{}~ [0] ~{:.3f}us<={}\n'.format(
+                    '  ' * depth, name, depth, rng.uniform(0.1, 20), address))
+            fp.write('    ← __tcp_transmit_skb~1~ [0] ~{:.3f}us<={}\n'.format(
+                rng.uniform(5, 50), address))
+            fp.write('-END-\n\n')
+
+
+def count_lines(path: str) -> int:
+    with open(path, 'rb') as fp:
+        return sum(1 for _ in fp)
+
+
+def measure(path: str, repeat: int) -> None:
+    options = ProbeOptions()
+    lines = count_lines(path)
+
+    results = {}
+    for name in ('previous', 'current'):
+        best = float('inf')
+        for _ in range(repeat):
+            events = []
+            if name == 'previous':
+                with open(path, 'r', encoding='utf-8') as fp:
+                    start = perf_counter()
+                    legacy_parse(fp, options, events.append)
+                    elapsed = perf_counter() - start
+            else:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    start = perf_counter()
+                    current_parse(fd, options,
+                                  lambda *batch: events.extend(batch))
+                    elapsed = perf_counter() - start
+                finally:
+                    os.close(fd)
+            best = min(best, elapsed)
+        results[name] = best
+        print('{:<10} {:>10} lines {:>8} events {:>8.3f} s {:>12.0f} lines/s'.
+              format(name, lines, len(events), best, lines / best))
+
+    print('speedup    {:.2f}x'.format(results['previous'] /
+                                      results['current']))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths',
+                        metavar='LOG_PATH',
+                        nargs='*',
+                        help='captured retsnoop stdout')
+    parser.add_argument(
+        '--synthetic-events',
+        type=int,
+        default=DEFAULT_SYNTHETIC_EVENTS,
+        help='number of events to generate if no capture is given')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=DEFAULT_REPEAT,
+                        help='number of runs per parser; the best one counts')
+    args = parser.parse_args()
+
+    if args.paths:
+        for path in args.paths:
+            print(path)
+            measure(path, args.repeat)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'retsnoop.log')
+        generate_log(path, args.synthetic_events)
+        print('synthetic ({} events)'.format(args.synthetic_events))
+        measure(path, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+"""Benchmarks of hot paths in the event pipeline, with synthetic inputs.
+
+Runs without root, BCC or network access, and writes results as JSON so that runs on different commits can be compared.
+
+Usage: python -m benchmarks.suite [--output PATH] [--compare BASELINE] [--repeat N] [--filter SUBSTRING]
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from socket import AF_INET, inet_ntop
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from network_tracing.common.models import TracingEvent, TracingTaskOptions
+
+DEFAULT_REPEAT = 5
+
+# Removed when the interpreter exits
+_temporary_directory = tempfile.TemporaryDirectory()
+
+Case = Callable[[], tuple[int, Callable[[], Any]]]
+"""Return the number of operations and a function performing them, after doing any setup that should not be timed."""
+
+cases: dict[str, Case] = {}
+
+
+def case(name: str) -> Callable[[Case], Case]:
+
+    def decorator(function: Case) -> Case:
+        cases[name] = function
+        return function
+
+    return decorator
+
+
+def _synthetic_events(shape: str, count: int) -> list[Any]:
+    from network_tracing.daemon.tracing.probes.synthetic import Probe
+
+    probe = Probe(lambda *events: None, {'shape': shape, 'seed': 0})
+    generate = probe._generators[shape]
+    return [
+        TracingEvent(timestamp=i, probe=shape, event=generate(i))
+        for i in range(count)
+    ]
+
+
+def _task_fanout(subscribers: int) -> Case:
+
+    def setup():
+        from network_tracing.daemon.tracing.task import TracingTask
+
+        task = TracingTask(
+            TracingTaskOptions.from_dict({
+                'probes': {
+                    'synthetic': {
+                        'seed': 0
+                    }
+                },
+                'events': {
+                    'buffer_length': 4096
+                },
+            }))
+        pollers = [task.get_event_poller() for _ in range(subscribers)]
+        callback = task._build_event_callback('synthetic')
+        events = [
+            event.event
+            for event in _synthetic_events('delay_analysis_out', 10000)
+        ]
+
+        def run():
+            for event in events:
+                callback(event)
+            for poller in pollers:
+                # Drain so that queues do not grow across repeats
+                poller._queue.queue.clear()
+
+        return len(events), run
+
+    return setup
+
+
+for _subscribers in (0, 1, 4, 16):
+    case('task_fanout[{}]'.format(_subscribers))(_task_fanout(_subscribers))
+
+
+@case('to_json[delay_analysis_out]')
+def _to_json():
+    events = _synthetic_events('delay_analysis_out', 10000)
+    return len(events), lambda: [event.to_json() for event in events]
+
+
+@case('from_json[delay_analysis_out]')
+def _from_json():
+    lines = [
+        event.to_json()
+        for event in _synthetic_events('delay_analysis_out', 10000)
+    ]
+    return len(lines), lambda: [TracingEvent.from_json(line) for line in lines]
+
+
+@case('to_json[retsnoop]')
+def _to_json_retsnoop():
+    events = _synthetic_events('retsnoop', 10000)
+    return len(events), lambda: [event.to_json() for event in events]
+
+
+@case('retsnoop_parser')
+def _retsnoop_parser():
+    from benchmarks.retsnoop_parser import generate_log
+    from network_tracing.daemon.tracing.probes.retsnoop import (ProbeOptions,
+                                                                _OutputParser)
+
+    path = os.path.join(_temporary_directory.name, 'retsnoop.log')
+    generate_log(path, 5000)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    options = ProbeOptions()
+    chunk_size = 65536
+
+    def run():
+        parser = _OutputParser(options, lambda *events: None)
+        for offset in range(0, len(data), chunk_size):
+            parser.feed(data[offset:offset + chunk_size])
+        parser.close()
+
+    return data.count(b'\n'), run
+
+
+def _upload_format(shape: str) -> Case:
+
+    def setup():
+        from network_tracing.cli.actions.events import _UploadAction
+
+        action = _UploadAction()
+        events = _synthetic_events(shape, 10000)
+        formatter = _UploadAction._event_formatters[shape]
+
+        def run():
+            lines: list[str] = []
+            for event in events:
+                formatter(action, event, lines)
+                lines.clear()
+
+        return len(events), run
+
+    return setup
+
+
+for _shape in ('delay_analysis_out', 'retsnoop'):
+    case('upload_format[{}]'.format(_shape))(_upload_format(_shape))
+
+
+@case('record[delay_analysis_out]')
+def _record():
+    from network_tracing.cli.recording import Recorder
+
+    events = _synthetic_events('delay_analysis_out', 65536)
+    path = os.path.join(_temporary_directory.name, 'recordings')
+
+    def run():
+        recorder = Recorder(path)
+        for event in events:
+            recorder.add(event.probe, event.timestamp, event.event)
+        recorder.close()
+
+    return len(events), run
+
+
+@case('analyze[delay_analysis_out]')
+def _analyze():
+    from network_tracing.cli.analysis import DelayAnalysis, iter_chunks
+    from network_tracing.cli.recording import Recorder
+
+    events = _synthetic_events('delay_analysis_out', 65536)
+    path = os.path.join(_temporary_directory.name, 'analyzed')
+    recorder = Recorder(path)
+    for event in events:
+        recorder.add(event.probe, event.timestamp, event.event)
+    recorder.close()
+
+    def run():
+        analysis = DelayAnalysis()
+        for _, columns in iter_chunks([path]):
+            analysis.add(columns)
+        analysis.flows.quantiles()
+
+    return len(events), run
+
+
+def _random_ip4_bytes(rng: random.Random, count: int) -> list[bytes]:
+    return [rng.getrandbits(32).to_bytes(4, 'big') for _ in range(count)]
+
+
+def _ip_matcher_cidrs(rng: random.Random, count: int) -> list[str]:
+    return [
+        '{}/{}'.format(inet_ntop(AF_INET, ip_bytes), rng.randrange(8, 33))
+        for ip_bytes in _random_ip4_bytes(rng, count)
+    ]
+
+
+def _ip_matcher_bytes(cidrs: int) -> Case:
+
+    def setup():
+        from network_tracing.daemon.utilities import IPMatcher
+
+        rng = random.Random(0)
+        matcher = IPMatcher(_ip_matcher_cidrs(rng, cidrs))
+        count = 10000
+
+        def run():
+            # Fresh addresses every run, so that any caching cannot make repeats look faster than real traffic
+            for ip_bytes in _random_ip4_bytes(rng, count):
+                matcher.match_ip4_bytes(ip_bytes)
+
+        return count, run
+
+    return setup
+
+
+for _cidrs in (64, 4096):
+    case('ip_matcher.match_ip4_bytes[{}]'.format(_cidrs))(
+        _ip_matcher_bytes(_cidrs))
+
+
+@case('ip_matcher.match[64]')
+def _ip_matcher_str():
+    from network_tracing.daemon.utilities import IPMatcher
+
+    rng = random.Random(0)
+    matcher = IPMatcher(_ip_matcher_cidrs(rng, 64))
+    count = 10000
+
+    def run():
+        for ip_bytes in _random_ip4_bytes(rng, count):
+            matcher.match(inet_ntop(AF_INET, ip_bytes))
+
+    return count, run
+
+
+def _write_kallsyms(path: str, count: int) -> list[str]:
+    rng = random.Random(0)
+    names = []
+    with open(path, 'w') as fp:
+        for i in range(count):
+            name = '{}_{:x}'.format(
+                rng.choice(('tcp', 'ip', 'dev', 'sched', 'mm', 'bpf')), i)
+            names.append(name)
+            module = ' [mod{}]'.format(i % 32) if i % 10 == 0 else ''
+            fp.write('{:016x} {} {}{}\n'.format(0xffffffff81000000 + i * 16,
+                                                rng.choice('TtDdBbRr'), name,
+                                                module))
+    return names
+
+
+@case('kernel_symbol.find_all[100000]')
+def _kernel_symbol_find_all():
+    from network_tracing.daemon.utilities import KernelSymbol
+
+    path = os.path.join(_temporary_directory.name, 'kallsyms')
+    _write_kallsyms(path, 100000)
+    return 100000, lambda: sum(1 for _ in KernelSymbol.find_all(path))
+
+
+@case('kernel_symbol.find_by_symbol_name[100000]')
+def _kernel_symbol_find_by_name():
+    from network_tracing.daemon.utilities import KernelSymbol
+
+    path = os.path.join(_temporary_directory.name, 'kallsyms')
+    names = _write_kallsyms(path, 100000)
+    rng = random.Random(0)
+    lookups = rng.sample(names, 20)
+
+    def run():
+        for name in lookups:
+            KernelSymbol.find_by_symbol_name(name, path)
+
+    return len(lookups), run
+
+
+@case('kernel_symbol_table.find_by_glob[100000]')
+def _kernel_symbol_table_find_by_glob():
+    from network_tracing.daemon.utilities import KernelSymbolTable
+
+    path = os.path.join(_temporary_directory.name, 'kallsyms')
+    _write_kallsyms(path, 100000)
+    table = KernelSymbolTable.get_instance(path)
+    patterns = ['tcp_1*', 'sched_?f*', 'ip_*0', '*_ff']
+
+    def run():
+        for pattern in patterns:
+            table.find_by_glob(pattern)
+
+    return len(patterns), run
+
+
+@case('api_client.get_tracing_events')
+def _api_client_get_tracing_events():
+    import requests
+
+    from network_tracing.cli.api import ApiClient
+
+    body = ''.join(
+        event.to_json() + '\n'
+        for event in _synthetic_events('delay_analysis_out', 20000)).encode()
+
+    class _LocalHttpClient(ApiClient._HttpClient):
+
+        def request(self, method: str, url: str, *args, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response.raw = io.BytesIO(body)
+            return response
+
+    client = ApiClient(_LocalHttpClient())
+
+    def run():
+        for _ in client.get_tracing_events('benchmark'):
+            pass
+
+    return body.count(b'\n'), run
+
+
+@case('decode_events[delay_analysis_out]')
+def _decode_events_delay_analysis_out():
+    from network_tracing.cli.decoding import decode_events
+
+    # Events of a chunk as coalesced by the daemon
+    block = '\n'.join(
+        event.to_json()
+        for event in _synthetic_events('delay_analysis_out', 1024)).encode()
+
+    def run():
+        decode_events(block)
+
+    return 1024, run
+
+
+def run_case(setup: Case, repeat: int) -> dict[str, Any]:
+    ops, function = setup()
+    function()  # warm up
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    best = min(timings)
+    return {
+        'ops': ops,
+        'repeat': repeat,
+        'best_seconds': best,
+        'mean_seconds': sum(timings) / len(timings),
+        'ops_per_second': ops / best,
+    }
+
+
+def collect_metadata() -> dict[str, Any]:
+    try:
+        commit: Optional[str] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': datetime.now().astimezone().isoformat(),
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+    }
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any]) -> None:
+    print('{:<44} {:>14} {:>14} {:>8}'.format('CASE', 'BASELINE OPS/S',
+                                              'OPS/S', 'RATIO'))
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        if 'ops_per_second' not in result or 'ops_per_second' not in base:
+            continue
+        print('{:<44} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(
+            name, base['ops_per_second'], result['ops_per_second'],
+            result['ops_per_second'] / base['ops_per_second']))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o',
+                        '--output',
+                        metavar='PATH',
+                        help='write results as JSON to this path')
+    parser.add_argument(
+        '-c',
+        '--compare',
+        metavar='BASELINE',
+        help='compare with results previously written to this path')
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        type=int,
+        default=DEFAULT_REPEAT,
+        help='number of timed runs per case; the best one counts')
+    parser.add_argument('-k',
+                        '--filter',
+                        metavar='SUBSTRING',
+                        help='run only cases whose name contains this')
+    args = parser.parse_args()
+
+    results: dict[str, Any] = {}
+    for name, setup in cases.items():
+        if args.filter is not None and args.filter not in name:
+            continue
+        try:
+            result = run_case(setup, args.repeat)
+        except ImportError as e:
+            result = {'skipped': 'missing dependency: {}'.format(e.name)}
+            print('{:<44} skipped ({})'.format(name, result['skipped']))
+        else:
+            print('{:<44} {:>14.0f} ops/s'.format(name,
+                                                  result['ops_per_second']))
+        results[name] = result
+
+    output = {'metadata': collect_metadata(), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(output, fp, indent=2)
+            fp.write('\n')
+
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as fp:
+            baseline = json.load(fp)
+        print()
+        compare(results, baseline['results'])
+
+
+if __name__ == '__main__':
+    main()
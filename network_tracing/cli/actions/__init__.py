@@ -1,21 +1,28 @@
 from argparse import _SubParsersAction
 from typing import Any, Callable
 
-from . import events, ls, start, stop, version, view
+from . import (analyze, events, import_, ls, start, stop, top, update, version,
+               view)
 
 SubparsersConfigurer = Callable[[_SubParsersAction], Any]
 SubcommandHandler = Callable[[Any], Any]
 
 subparsers_configurers: list[SubparsersConfigurer] = [
+    analyze.configure_subparsers,
     events.configure_subparsers,
+    import_.configure_subparsers,
     ls.configure_subparsers,
     start.configure_subparsers,
     stop.configure_subparsers,
+    top.configure_subparsers,
+    update.configure_subparsers,
     view.configure_subparsers,
 ]
 
 subcommand_handlers = {
+    'analyze': analyze.run,
     'events': events.run,
+    'import': import_.run,
     'ls': ls.run,
     'list': ls.run,
     'start': start.run,
@@ -23,6 +30,8 @@ subcommand_handlers = {
     'stop': stop.run,
     'rm': stop.run,
     'remove': stop.run,
+    'top': top.run,
+    'update': update.run,
     'version': version.run,
     'view': view.run,
 }
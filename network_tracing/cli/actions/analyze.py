@@ -0,0 +1,306 @@
+import json
+import logging
+import sys
+from argparse import ArgumentParser, _SubParsersAction
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Optional, Union
+
+from network_tracing.cli.aggregation import SORT_KEYS
+from network_tracing.cli.constants import DEFAULT_PROGRAM_NAME
+from network_tracing.cli.models import BaseOptions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 16384
+DEFAULT_INTERVAL = 60.0
+DEFAULT_LIMIT = 10
+DEFAULT_SORT_KEY = 'p99'
+
+_QUANTILE_NAMES = ('p50', 'p90', 'p99', 'p99.9')
+_ROW_FORMAT = '{:>10} {:>10} {:>10} {:>10} {:>10} {:>10}  {}'
+
+
+@dataclass(kw_only=True)
+class Options(BaseOptions):
+    paths: list = field(default_factory=list)
+    """Recorded files, or directories to look for them in, e.g. that of `ntctl events -a record`."""
+    interval: float = field(default=DEFAULT_INTERVAL)
+    """Seconds of each interval to compute percentiles over."""
+    chunk_size: int = field(default=DEFAULT_CHUNK_SIZE)
+    """Number of events loaded into memory at once."""
+    limit: int = field(default=DEFAULT_LIMIT)
+    """Maximum number of flows and tasks reported. All of them are written to `output`."""
+    sort: str = field(default=DEFAULT_SORT_KEY)
+    output: Optional[str] = field(default=None)
+    """If not `None`, also write full results as JSON to this path."""
+
+    def __post_init__(self):
+        if not self.paths:
+            raise ValueError('No recorded files to analyze')
+        if self.interval <= 0:
+            raise ValueError('Invalid interval {}'.format(self.interval))
+        if self.chunk_size <= 0:
+            raise ValueError('Invalid chunk size {}'.format(self.chunk_size))
+        if self.limit <= 0:
+            raise ValueError('Invalid limit {}'.format(self.limit))
+        if self.sort not in SORT_KEYS:
+            raise ValueError('Invalid sort key {}'.format(self.sort))
+
+
+def configure_subparsers(subparsers: _SubParsersAction):
+    parser: ArgumentParser = subparsers.add_parser(
+        'analyze',
+        help='compute latency percentiles and breakdowns of recorded events')
+
+    parser.add_argument(
+        '-n',
+        '--interval',
+        metavar='SECONDS',
+        type=float,
+        help='length of intervals to compute percentiles over; defaults to {}'.
+        format(DEFAULT_INTERVAL))
+
+    parser.add_argument(
+        '--chunk-size',
+        metavar='N',
+        type=int,
+        help='number of events loaded into memory at once; defaults to {}'.
+        format(DEFAULT_CHUNK_SIZE))
+
+    parser.add_argument(
+        '-l',
+        '--limit',
+        metavar='N',
+        type=int,
+        help='maximum number of flows and tasks shown; defaults to {}'.format(
+            DEFAULT_LIMIT))
+
+    parser.add_argument(
+        '-s',
+        '--sort',
+        metavar='KEY',
+        choices=SORT_KEYS,
+        help='statistic to rank flows and tasks by; can be one of {}. '
+        'Defaults to {}'.format(', '.join(SORT_KEYS), DEFAULT_SORT_KEY))
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar='PATH',
+        help='also write full results, including all flows, intervals and '
+        'tasks, as JSON to this path')
+
+    parser.add_argument(
+        'paths',
+        metavar='PATH',
+        nargs='+',
+        help='recorded files to analyze, or directories to look for them in; '
+        'can be Parquet or Arrow segments written by `events -a record`, or '
+        'JSON lines of events as streamed by the daemon')
+
+
+def run(options: Union[dict[str, Any], Options]):
+    try:
+        if isinstance(options, dict):
+            options = Options.from_dict(options)
+
+        try:
+            from network_tracing.cli import analysis
+        except ImportError as e:
+            raise RuntimeError(
+                'Subcommand \'analyze\' requires numpy; install it with '
+                '`pip install network-tracing[analyze]`') from e
+
+        delay = analysis.DelayAnalysis(options.interval)
+        runqueue = analysis.RunqueueAnalysis()
+        started_at = monotonic()
+        events = 0
+        for kind, columns in analysis.iter_chunks(options.paths,
+                                                  options.chunk_size):
+            if kind == analysis.DELAY:
+                delay.add(columns)
+            else:
+                runqueue.add(columns)
+            events += len(next(iter(columns.values())))
+        logger.info('Analyzed %d event(s) in %.1f s', events,
+                    monotonic() - started_at)
+
+        results = {
+            'delay': _build_delay_results(analysis, delay),
+            'runqueue': _build_runqueue_results(runqueue),
+        }
+        _print_results(results, options)
+
+        if options.output is not None:
+            with open(options.output, 'w', encoding='utf-8') as fp:
+                json.dump(results, fp, indent=2)
+    except Exception as e:
+        print('{}: error: failed to analyze events: {}'.format(
+            DEFAULT_PROGRAM_NAME,
+            e,
+        ),
+              file=sys.stderr)
+        logger.debug('Exception information:', exc_info=e)
+        return 1
+
+
+def _build_delay_results(analysis: Any, delay: Any) -> dict[str, Any]:
+    overall = _build_rows(delay.overall, delay.stage_shares(delay.overall))
+    flows = _build_rows(delay.flows, delay.stage_shares(delay.flows))
+    for row, (saddr, sport, daddr, dport) in zip(flows, delay.flows.keys):
+        row['flow'] = {
+            'saddr': saddr,
+            'sport': sport,
+            'daddr': daddr,
+            'dport': dport,
+        }
+    intervals = _build_rows(delay.intervals,
+                            delay.stage_shares(delay.intervals))
+    for row, start in zip(intervals, delay.intervals.keys):
+        row['start'] = analysis.format_time(start)
+    intervals.sort(key=lambda row: row['start'])
+
+    return {
+        'first_time': analysis.format_time(delay.first_time),
+        'last_time': analysis.format_time(delay.last_time),
+        'skipped': delay.skipped,
+        'overall': overall[0] if overall else None,
+        'flows': flows,
+        'intervals': intervals,
+    }
+
+
+def _build_runqueue_results(runqueue: Any) -> dict[str, Any]:
+    overall = _build_rows(runqueue.overall)
+    tasks = _build_rows(runqueue.tasks)
+    for row, key in zip(tasks, runqueue.tasks.keys):
+        if key[0] == 'tgid':
+            row['tgid'] = key[1]
+        else:
+            row['pid'], row['task'] = key
+    octaves = runqueue.overall.octaves()
+    return {
+        'skipped': runqueue.skipped,
+        'overall': overall[0] if overall else None,
+        'octaves': octaves[0].tolist() if len(octaves) else [],
+        'tasks': tasks,
+    }
+
+
+def _build_rows(
+        histograms: Any,
+        shares: Optional[dict[str, Any]] = None) -> list[dict[str, Any]]:
+    counts = histograms.counts
+    means = histograms.means
+    maxima = histograms.maxima
+    quantiles = histograms.quantiles()
+    rows = []
+    for index in range(len(histograms)):
+        row = {
+            'count': int(counts[index]),
+            'mean': float(means[index]),
+            'max': float(maxima[index]),
+        }
+        for name, value in zip(_QUANTILE_NAMES, quantiles[index]):
+            row[name] = float(value)
+        if shares:
+            row['stages'] = {
+                stage: float(values[index])
+                for stage, values in shares.items()
+            }
+        rows.append(row)
+    return rows
+
+
+def _print_results(results: dict[str, Any], options: Options) -> None:
+    delay = results['delay']
+    if delay['overall'] is not None:
+        print('Delay analysis: {} event(s) from {} to {}'.format(
+            delay['overall']['count'], delay['first_time'],
+            delay['last_time']))
+        if delay['skipped']:
+            print('Skipped {} malformed event(s)'.format(delay['skipped']))
+        print()
+        print('Total time (us)')
+        _print_table([('all', delay['overall'])])
+        if delay['overall']['stages']:
+            print()
+            print('Stage contribution: {}'.format(', '.join(
+                '{} {:.1%}'.format(stage, share)
+                for stage, share in delay['overall']['stages'].items())))
+
+        print()
+        print('Intervals of {:g} s - {}'.format(options.interval,
+                                                len(delay['intervals'])))
+        _print_table([(row['start'], row) for row in delay['intervals']],
+                     'START')
+
+        print()
+        print('Flows by {} - {}'.format(options.sort, len(delay['flows'])))
+        flows = _top(delay['flows'], options)
+        _print_table(
+            [('{saddr}:{sport} -> {daddr}:{dport}'.format(**row['flow']) +
+              _format_stages(row), row) for row in flows], 'FLOW (STAGES)')
+
+    runqueue = results['runqueue']
+    if runqueue['overall'] is not None:
+        if delay['overall'] is not None:
+            print()
+        print('Run queue delay (us): {} event(s)'.format(
+            runqueue['overall']['count']))
+        _print_table([('all', runqueue['overall'])])
+
+        print()
+        _print_octaves(runqueue['octaves'])
+
+        print()
+        print('Tasks by {} - {}'.format(options.sort, len(runqueue['tasks'])))
+        tasks = _top(runqueue['tasks'], options)
+        _print_table([('{task} ({pid})'.format(
+            **row) if 'pid' in row else 'tgid {}'.format(row['tgid']), row)
+                      for row in tasks], 'TASK')
+
+    if delay['overall'] is None and runqueue['overall'] is None:
+        print('No events of delay_analysis_* or runqslower found')
+
+
+def _top(rows: list[dict[str, Any]], options: Options) -> list[dict[str, Any]]:
+    return sorted(rows, key=lambda row: row[options.sort],
+                  reverse=True)[:options.limit]
+
+
+def _print_table(rows: list[tuple[str, dict[str, Any]]],
+                 name: str = '') -> None:
+    print(_ROW_FORMAT.format('COUNT', 'MEAN', 'P50', 'P90', 'P99', 'MAX',
+                             name))
+    for label, row in rows:
+        print(
+            _ROW_FORMAT.format(row['count'], '{:.1f}'.format(row['mean']),
+                               '{:.1f}'.format(row['p50']),
+                               '{:.1f}'.format(row['p90']),
+                               '{:.1f}'.format(row['p99']),
+                               '{:.1f}'.format(row['max']), label))
+
+
+def _format_stages(row: dict[str, Any]) -> str:
+    if not row.get('stages', None):
+        return ''
+    return ' ({})'.format(', '.join(
+        '{} {:.0%}'.format(stage.rsplit('_', 1)[0], share)
+        for stage, share in row['stages'].items()))
+
+
+def _print_octaves(octaves: list[int]) -> None:
+    """Print a distribution in log2 slots, as done by BCC tools."""
+    while octaves and not octaves[-1]:
+        octaves = octaves[:-1]
+    if not octaves:
+        return
+    peak = max(octaves)
+    print('{:>24} : {:<10} {}'.format('usecs', 'count', 'distribution'))
+    for octave, count in enumerate(octaves):
+        low = 0 if octave == 0 else 2**octave
+        bar = '*' * round(40 * count / peak)
+        print('{:>10} -> {:<10} : {:<10} |{:<40}|'.format(
+            low, 2**(octave + 1) - 1, count, bar))
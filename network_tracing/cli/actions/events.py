@@ -1,25 +1,49 @@
 import logging
-from numbers import Integral
 import sys
 from argparse import ArgumentParser, _SubParsersAction
-from copy import deepcopy
+from collections import deque
 from dataclasses import dataclass, field
+from functools import cache, partial
 from queue import Empty, Full, Queue
 from signal import SIGINT, SIGTERM, signal
-from threading import Thread
-from typing import Any, Iterable, Optional, Union
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Optional, Union
 
-from influxdb_client import InfluxDBClient, Point
+from influxdb_client import InfluxDBClient
 from influxdb_client.client.write_api import SYNCHRONOUS
 
-from network_tracing.cli.api import ApiClient
 from network_tracing.cli.constants import DEFAULT_PROGRAM_NAME
+from network_tracing.cli.decoding import decode_events
+from network_tracing.cli.influxdb import (DEFAULT_BATCH_SIZE,
+                                          DEFAULT_CONCURRENCY,
+                                          DEFAULT_FLUSH_INTERVAL,
+                                          DEFAULT_MAX_RETRIES, BatchingWriter)
+from network_tracing.cli.line_protocol import LineFormat, format_line
 from network_tracing.cli.models import BaseOptions
+from network_tracing.cli.spool import \
+    DEFAULT_SEGMENT_SIZE as DEFAULT_SPOOL_SEGMENT_SIZE
+from network_tracing.cli.spool import Spool
+from network_tracing.cli.stream import EventStreamReader
+from network_tracing.cli.workers import WorkerPool
 from network_tracing.common.models import TracingEvent
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_EVENT_BUFFER_SIZE = 4096
+DEFAULT_SPOOL_MAX_SIZE = 1024
+DEFAULT_RECORD_PATH = 'recordings'
+DEFAULT_RECORD_FORMAT = 'parquet'
+DEFAULT_RECORD_ROTATE_SIZE = 256
+DEFAULT_RECORD_ROTATE_INTERVAL = 3600.0
+RECORD_FORMATS = ('parquet', 'arrow')
+EVENT_BATCH_SIZE = 1024
+"""Maximum number of events taken from the buffer or the spool, or sent to a worker process, at once."""
+STATS_INTERVAL = 10.0
+INFLUXDB_BUCKET = 'network_subsystem'
+
+_PendingCommit = tuple[tuple[int, ...], tuple[int, int]]
+"""Mark of workers after a batch from the spool is submitted, with the spool position after the batch."""
 
 
 @dataclass(kw_only=True)
@@ -28,11 +52,40 @@ class Options(BaseOptions):
     actions: list = field(default_factory=list)
     buffer_size: int = field(default=DEFAULT_EVENT_BUFFER_SIZE)
     influxdb_config: Optional[str] = field(default=None)
+    batch_size: int = field(default=DEFAULT_BATCH_SIZE)
+    flush_interval: float = field(default=DEFAULT_FLUSH_INTERVAL)
+    concurrency: int = field(default=DEFAULT_CONCURRENCY)
+    max_retries: int = field(default=DEFAULT_MAX_RETRIES)
+    workers: int = field(default=0)
+    """Number of processes decoding events and taking actions. If 0, do so in the process reading events."""
+    spool_path: Optional[str] = field(default=None)
+    """If not `None`, keep events to a spool in this directory rather than dropping them when the buffer is full, and handle them once the buffer is drained."""
+    spool_max_size: int = field(default=DEFAULT_SPOOL_MAX_SIZE)
+    """Maximum disk usage of the spool in MiB."""
+    record_path: str = field(default=DEFAULT_RECORD_PATH)
+    """Directory to write segments to for the `record` action."""
+    record_format: str = field(default=DEFAULT_RECORD_FORMAT)
+    record_rotate_size: int = field(default=DEFAULT_RECORD_ROTATE_SIZE)
+    """Size in MiB after which a recorded segment is closed and a new one is started."""
+    record_rotate_interval: float = field(
+        default=DEFAULT_RECORD_ROTATE_INTERVAL)
+    """Seconds after which a recorded segment is closed and a new one is started."""
 
     def __post_init__(self):
         if not self.actions:
             self.actions = ['print']
 
+        if self.workers < 0:
+            raise ValueError('Invalid number of workers {}'.format(
+                self.workers))
+        if self.spool_max_size <= 0:
+            raise ValueError('Invalid spool size {}'.format(
+                self.spool_max_size))
+
+        if self.record_format not in RECORD_FORMATS:
+            raise ValueError('Invalid record format {}'.format(
+                self.record_format))
+
         for action in self.actions:
             if action not in VALID_ACTIONS:
                 raise Exception('Invalid action \'{}\''.format(action))
@@ -64,165 +117,282 @@ class _PrintAction(_BaseAction):
 class _UploadAction(_BaseAction):
 
     def initialize(self, options: Options) -> None:
-        self._influxdb_client = _UploadAction._build_influxdb_client(
-            options.influxdb_config)
-        self._write_api = self._influxdb_client.write_api(SYNCHRONOUS)
+        self._influxdb_client = build_influxdb_client(options.influxdb_config)
+        write_api = self._influxdb_client.write_api(SYNCHRONOUS)
+        self._lines: list[str] = []
+        self._writer = BatchingWriter(lambda records: write_api.write(
+            bucket=INFLUXDB_BUCKET, record=records),
+                                      batch_size=options.batch_size,
+                                      flush_interval=options.flush_interval,
+                                      concurrency=options.concurrency,
+                                      max_retries=options.max_retries)
 
     def handle_event(self, event: TracingEvent) -> None:
-        formatter = _UploadAction._event_formatters.get(event.probe)
-        if formatter is None:
+        # Reuse the same list for each event, as most events produce a single line
+        lines = self._lines
+        if not format_event(event, lines):
             logger.warn('Cannot recognize probe type \'%s\'; ignoring',
-                        event.probe)
-        else:
-            point_or_points = formatter(self, event)
-            if not isinstance(point_or_points, Iterable):
-                points = [point_or_points]
-            else:
-                points = point_or_points
-            for point in points:
-                logger.debug('Uploading record %s', point)
-                self._write_api.write(bucket='network_subsystem', record=point)
-
-    def _format_delay_analysis_out(self, event: TracingEvent):
-        timestamp: Integral = event.timestamp  # type: ignore
-        return Point('delay_analysis_out') \
-            .time(timestamp) \
-            .field('SADDR', event.event['parsed']['saddr']) \
-            .field('SPORT', event.event['parsed']['sport']) \
-            .field('DADDR', event.event['parsed']['daddr']) \
-            .field('DPORT', event.event['parsed']['dport']) \
-            .field('SEQ', event.event['parsed']['seq']) \
-            .field('ACK', event.event['parsed']['ack']) \
-            .field('TIME_TOTAL', event.event['parsed']['total_time']) \
-            .field('TIME_QDisc', event.event['parsed']['qdisc_time']) \
-            .field('TIME_IP', event.event['parsed']['ip_time']) \
-            .field('TIME_TCP', event.event['parsed']['tcp_time'])
-
-    def _format_delay_analysis_out_v6(self, event: TracingEvent):
-        timestamp: Integral = event.timestamp  # type: ignore
-        return Point('delay_analysis_out_v6') \
-            .time(timestamp) \
-            .field('SADDR', event.event['parsed']['saddr']) \
-            .field('SPORT', event.event['parsed']['sport']) \
-            .field('DADDR', event.event['parsed']['daddr']) \
-            .field('DPORT', event.event['parsed']['dport']) \
-            .field('SEQ', event.event['parsed']['seq']) \
-            .field('ACK', event.event['parsed']['ack']) \
-            .field('TIME_TOTAL', event.event['parsed']['total_time']) \
-            .field('TIME_QDisc', event.event['parsed']['qdisc_time']) \
-            .field('TIME_IP', event.event['parsed']['ip_time']) \
-            .field('TIME_TCP', event.event['parsed']['tcp_time'])
-
-    def _format_retsnoop(self, event: TracingEvent):
+                        event.shape)
+        elif lines:
+            self._writer.add(*lines)
+            lines.clear()
+
+    def close(self) -> None:
+        self._writer.close()
+        self._influxdb_client.close()
+
+    def _format_delay_analysis_out(self,
+                                   event: TracingEvent,
+                                   lines: list[str],
+                                   tags: Optional[dict[str, Any]] = None):
+        self._format_delay_analysis_out_measurement(_DELAY_ANALYSIS_OUT_FORMAT,
+                                                    event, lines, tags)
+
+    def _format_delay_analysis_out_v6(self,
+                                      event: TracingEvent,
+                                      lines: list[str],
+                                      tags: Optional[dict[str, Any]] = None):
+        self._format_delay_analysis_out_measurement(
+            _DELAY_ANALYSIS_OUT_V6_FORMAT, event, lines, tags)
+
+    def _format_delay_analysis_out_dual(self,
+                                        event: TracingEvent,
+                                        lines: list[str],
+                                        tags: Optional[dict[str, Any]] = None):
+        # Keep dual-stack events in the same measurements as single-stack ones, so that dashboards work with either
+        line_format = _DELAY_ANALYSIS_OUT_FORMAT if event.event['parsed'][
+            'family'] == 'ipv4' else _DELAY_ANALYSIS_OUT_V6_FORMAT
+        self._format_delay_analysis_out_measurement(line_format, event, lines,
+                                                    tags)
+
+    def _format_delay_analysis_out_measurement(
+            self,
+            line_format: LineFormat,
+            event: TracingEvent,
+            lines: list[str],
+            tags: Optional[dict[str, Any]] = None):
+        parsed = event.event['parsed']
+        _append_line(
+            lines,
+            line_format.format(
+                {
+                    'SADDR': parsed['saddr'],
+                    'SPORT': parsed['sport'],
+                    'DADDR': parsed['daddr'],
+                    'DPORT': parsed['dport'],
+                    'SEQ': parsed['seq'],
+                    'ACK': parsed['ack'],
+                    'TIME_TOTAL': parsed['total_time'],
+                    'TIME_QDisc': parsed['qdisc_time'],
+                    'TIME_IP': parsed['ip_time'],
+                    'TIME_TCP': parsed['tcp_time'],
+                    'SAMPLE_RATIO': event.event.get('sample_ratio', 1.0),
+                }, event.timestamp, tags))
+
+    def _format_retsnoop(self,
+                         event: TracingEvent,
+                         lines: list[str],
+                         tags: Optional[dict[str, Any]] = None):
         timestamp = event.timestamp
-        data: dict[str, Any] = deepcopy(event.event)
-        data.pop('timestamp')
-        data['time_stamp'] = timestamp
-        data['PID'] = data.pop('pid')
-        data['TID'] = data.pop('tid')
-        data['PNAME'] = data.pop('pname')
-        data['TNAME'] = data.pop('tname')
-
-        functions = data.pop('functions')
-        if not functions:
-            return []
-        data.update(functions)
+        data: dict[str, Any] = event.event
 
-        flows = data.pop('flows')
+        functions = data['functions']
+        if not functions:
+            return
 
-        points: list[Point] = []
+        fields = {
+            key: value
+            for key, value in data.items() if key not in _RETSNOOP_EVENT_KEYS
+        }
+        fields['time_stamp'] = timestamp
+        fields['PID'] = data['pid']
+        fields['TID'] = data['tid']
+        fields['PNAME'] = data['pname']
+        fields['TNAME'] = data['tname']
+        fields.update(functions)
 
-        # points.append(
-        #     Point.from_dict({
-        #         'measurement': 'function_duration',
-        #         'time': timestamp,
-        #         'fields': data,
-        #     }))
+        # A `function_duration` measurement without tags used to be written here as well
 
         column_name = '{}:{}_{}:{}'.format(
-            data['PID'],
-            data['TID'],
-            data['PNAME'],
-            data['TNAME'],
+            fields['PID'],
+            fields['TID'],
+            fields['PNAME'],
+            fields['TNAME'],
         )
-        points.append(
-            Point.from_dict({
-                'measurement': 'function_duration_bar',
-                'time': timestamp,
-                'tags': {
-                    'column_name': column_name,
-                },
-                'fields': data,
-            }))
-
-        for flow_data in flows:
-            flow_data['time_stamp'] = timestamp
-            flow_data['SADDR'] = flow_data.pop('saddr')
-            flow_data['SPORT'] = flow_data.pop('sport')
-            flow_data['DADDR'] = flow_data.pop('daddr')
-            flow_data['DPORT'] = flow_data.pop('dport')
-
-            flow_functions = flow_data.pop('functions')
+        _append_line(
+            lines,
+            format_line('function_duration_bar',
+                        fields,
+                        timestamp,
+                        tags={
+                            'column_name': column_name,
+                            **(tags or {})
+                        }))
+
+        for flow_data in data['flows']:
+            flow_functions = flow_data['functions']
             if not flow_functions:
                 continue
-            flow_data.update(flow_functions)
 
-            # points.append(
-            #     Point.from_dict({
-            #         'measurement': 'function_duration_flow',
-            #         'time': timestamp,
-            #         'fields': flow_data,
-            #     }))
+            flow_fields = {
+                key: value
+                for key, value in flow_data.items()
+                if key not in _RETSNOOP_FLOW_KEYS
+            }
+            flow_fields['time_stamp'] = timestamp
+            flow_fields['SADDR'] = flow_data['saddr']
+            flow_fields['SPORT'] = flow_data['sport']
+            flow_fields['DADDR'] = flow_data['daddr']
+            flow_fields['DPORT'] = flow_data['dport']
+            flow_fields.update(flow_functions)
+
+            # Likewise for `function_duration_flow`
 
             column_name = '{}:{}_{}:{}'.format(
-                flow_data['SADDR'],
-                flow_data['SPORT'],
-                flow_data['DADDR'],
-                flow_data['DPORT'],
+                flow_fields['SADDR'],
+                flow_fields['SPORT'],
+                flow_fields['DADDR'],
+                flow_fields['DPORT'],
             )
-            points.append(
-                Point.from_dict({
-                    'measurement': 'function_duration_flow_bar',
-                    'time': timestamp,
-                    'tags': {
-                        'column_name': column_name,
-                    },
-                    'fields': flow_data,
-                }))
-
-        return points
-
-    def _format_runqslower(self, event: TracingEvent):
-        timestamp: Integral = event.timestamp  # type: ignore
+            _append_line(
+                lines,
+                format_line('function_duration_flow_bar',
+                            flow_fields,
+                            timestamp,
+                            tags={
+                                'column_name': column_name,
+                                **(tags or {})
+                            }))
+
+    def _format_runqslower(self,
+                           event: TracingEvent,
+                           lines: list[str],
+                           tags: Optional[dict[str, Any]] = None):
+        timestamp = event.timestamp
+        data = event.event
+        if data.get('kind', 'event') == 'summary':
+            fields = {
+                'interval': data['interval'],
+                'count': data['count'],
+            }
+            # Name each bucket after its exclusive upper bound in us
+            for slot, count in enumerate(data['slots']):
+                fields[_hist_field_name(slot)] = count
+            _append_line(
+                lines,
+                format_line('runqueue_delay_hist',
+                            fields,
+                            timestamp,
+                            tags={
+                                'tgid': data['tgid'],
+                                'cpu': data['cpu'],
+                                **(tags or {})
+                            }))
+            return
+
         # eBPF 获取到的 PID 在用户态看实际是线程 ID（TID）
-        return Point('runqueue_delay') \
-            .time(timestamp) \
-            .field('task', event.event['task']) \
-            .field('tid', event.event['pid']) \
-            .field('delta_us', event.event['delta_us'])
+        _append_line(
+            lines,
+            _RUNQUEUE_DELAY_FORMAT.format(
+                {
+                    'task': data['task'],
+                    'tid': data['pid'],
+                    'delta_us': data['delta_us'],
+                }, timestamp, tags))
 
     _event_formatters = {
         'delay_analysis_out': _format_delay_analysis_out,
         'delay_analysis_out_v6': _format_delay_analysis_out_v6,
+        'delay_analysis_out_dual': _format_delay_analysis_out_dual,
         'retsnoop': _format_retsnoop,
         'runqslower': _format_runqslower,
     }
+    """Formatters by the probe whose events they format, which for synthetic events is their `shape`."""
+
 
-    @staticmethod
-    def _build_influxdb_client(
-            influxdb_config_path: Optional[str]) -> InfluxDBClient:
-        if influxdb_config_path is None:
-            default_org = '-'  # to be compatible with InfluxDB 1.8
-            return InfluxDBClient('http://localhost:8086', org=default_org)
-        elif influxdb_config_path == ':env:':
-            return InfluxDBClient.from_env_properties()
-        else:
-            return InfluxDBClient.from_config_file(influxdb_config_path)
+# Formatters keep no state, so a single uninitialized instance serves all callers
+_FORMATTING_ACTION = _UploadAction()
 
 
+def format_event(event: TracingEvent, lines: list[str]) -> bool:
+    """Append lines of InfluxDB line protocol of an event to `lines`, as uploaded by action 'upload'. Return `False` if the probe of the event is not recognized.
+
+    Synthetic events are written to the measurements of the probe they imitate, tagged with `synthetic=true` to keep them apart from real ones.
+    """
+    shape = event.shape
+    formatter = _UploadAction._event_formatters.get(shape)
+    if formatter is None:
+        return False
+    tags = _SYNTHETIC_TAGS if shape != event.probe else None
+    formatter(_FORMATTING_ACTION, event, lines, tags)
+    return True
+
+
+def build_influxdb_client(
+        influxdb_config_path: Optional[str]) -> InfluxDBClient:
+    if influxdb_config_path is None:
+        default_org = '-'  # to be compatible with InfluxDB 1.8
+        return InfluxDBClient('http://localhost:8086', org=default_org)
+    elif influxdb_config_path == ':env:':
+        return InfluxDBClient.from_env_properties()
+    else:
+        return InfluxDBClient.from_config_file(influxdb_config_path)
+
+
+class _RecordAction(_BaseAction):
+
+    def initialize(self, options: Options) -> None:
+        try:
+            from network_tracing.cli.recording import Recorder
+        except ImportError as e:
+            raise RuntimeError(
+                'Action \'record\' requires pyarrow; install it with '
+                '`pip install network-tracing[record]`') from e
+
+        self._recorder = Recorder(
+            options.record_path,
+            format=options.record_format,
+            rotate_size=options.record_rotate_size * 1024 * 1024,
+            rotate_interval=options.record_rotate_interval)
+
+    def handle_event(self, event: TracingEvent) -> None:
+        self._recorder.add(event.probe, event.timestamp, event.event)
+
+    def close(self) -> None:
+        self._recorder.close()
+
+
+def _append_line(lines: list[str], line: Optional[str]) -> None:
+    if line is not None:
+        lines.append(line)
+
+
+@cache
+def _hist_field_name(slot: int) -> str:
+    # Slot i holds [2^i, 2^(i+1)) us, or [0, 2) us for slot 0
+    return 'lt_{}'.format(2**(slot + 1))
+
+
+_DELAY_ANALYSIS_OUT_FIELDS = ('SADDR', 'SPORT', 'DADDR', 'DPORT', 'SEQ', 'ACK',
+                              'TIME_TOTAL', 'TIME_QDisc', 'TIME_IP',
+                              'TIME_TCP', 'SAMPLE_RATIO')
+_DELAY_ANALYSIS_OUT_FORMAT = LineFormat('delay_analysis_out',
+                                        _DELAY_ANALYSIS_OUT_FIELDS)
+_DELAY_ANALYSIS_OUT_V6_FORMAT = LineFormat('delay_analysis_out_v6',
+                                           _DELAY_ANALYSIS_OUT_FIELDS)
+_RUNQUEUE_DELAY_FORMAT = LineFormat('runqueue_delay',
+                                    ('task', 'tid', 'delta_us'))
+
+_RETSNOOP_EVENT_KEYS = frozenset(('timestamp', 'pid', 'tid', 'pname', 'tname',
+                                  'functions', 'flows', 'shape'))
+_SYNTHETIC_TAGS = {'synthetic': 'true'}
+_RETSNOOP_FLOW_KEYS = frozenset(
+    ('saddr', 'sport', 'daddr', 'dport', 'functions'))
+
 _action_classes: dict[str, type[_BaseAction]] = {
     'print': _PrintAction,
     'upload': _UploadAction,
+    'record': _RecordAction,
 }
 
 VALID_ACTIONS = _action_classes.keys()
@@ -264,62 +434,214 @@ def configure_subparsers(subparsers: _SubParsersAction):
         'https://influxdb-client.readthedocs.io/en/stable/api.html#influxdb_client.InfluxDBClient.from_config_file.'
     )
 
+    parser.add_argument(
+        '--batch-size',
+        metavar='N',
+        type=int,
+        help='maximum number of records uploaded to InfluxDB at once; '
+        'defaults to {}'.format(DEFAULT_BATCH_SIZE))
+
+    parser.add_argument(
+        '--flush-interval',
+        metavar='SECONDS',
+        type=float,
+        help='maximum time records wait for a batch to fill before being '
+        'uploaded; defaults to {}'.format(DEFAULT_FLUSH_INTERVAL))
+
+    parser.add_argument(
+        '--concurrency',
+        metavar='N',
+        type=int,
+        help='number of batches uploaded in parallel; defaults to {}'.format(
+            DEFAULT_CONCURRENCY))
+
+    parser.add_argument(
+        '--max-retries',
+        metavar='N',
+        type=int,
+        help='number of times a failed batch is retried, with exponential '
+        'backoff, before being dropped; defaults to {}'.format(
+            DEFAULT_MAX_RETRIES))
+
+    parser.add_argument(
+        '-w',
+        '--workers',
+        metavar='N',
+        type=int,
+        help='number of processes decoding events and taking actions, while '
+        'the main process only reads events; defaults to 0, which does '
+        'everything in the main process. Events may be handled out of order '
+        'if greater than 1.')
+
+    parser.add_argument(
+        '--spool',
+        metavar='PATH',
+        dest='spool_path',
+        help='directory to keep events in when the buffer is full, instead of '
+        'dropping them. Spooled events are handled in order once actions '
+        'catch up, including those left from a previous run.')
+
+    parser.add_argument(
+        '--spool-max-size',
+        metavar='MIB',
+        type=int,
+        help='maximum disk usage of the spool in MiB; events are dropped '
+        'when it is reached. Defaults to {}'.format(DEFAULT_SPOOL_MAX_SIZE))
+
+    parser.add_argument(
+        '--record-path',
+        metavar='PATH',
+        help='directory to write recorded events to, in a subdirectory per '
+        'probe; defaults to {}'.format(DEFAULT_RECORD_PATH))
+
+    parser.add_argument(
+        '--record-format',
+        metavar='FORMAT',
+        choices=RECORD_FORMATS,
+        help='format of recorded segments; can be one of {}. Defaults to {}'.
+        format(', '.join(RECORD_FORMATS), DEFAULT_RECORD_FORMAT))
+
+    parser.add_argument(
+        '--record-rotate-size',
+        metavar='MIB',
+        type=int,
+        help='size in MiB after which a new recorded segment is started; '
+        'defaults to {}'.format(DEFAULT_RECORD_ROTATE_SIZE))
+
+    parser.add_argument(
+        '--record-rotate-interval',
+        metavar='SECONDS',
+        type=float,
+        help='time after which a new recorded segment is started; defaults '
+        'to {}'.format(DEFAULT_RECORD_ROTATE_INTERVAL))
+
     parser.add_argument('id',
                         metavar='ID',
                         help='ID of tracing task to view events')
 
 
 def run(options: Union[dict[str, Any], Options]):
+    pool: Optional[WorkerPool] = None
+    spool: Optional[Spool] = None
     try:
         if isinstance(options, dict):
             options = Options.from_dict(options)
 
-        events = ApiClient.get_instance().get_tracing_events(options.id)
-        event_buffer: Queue[TracingEvent] = Queue(maxsize=options.buffer_size)
+        if options.workers:
+            # Fork workers before opening connections or starting threads
+            pool = WorkerPool(options.workers, partial(_build_actions,
+                                                       options))
+            pool.start()
+
+        if options.spool_path is not None:
+            max_size = options.spool_max_size * 1024 * 1024
+            spool = Spool(options.spool_path,
+                          max_size=max_size,
+                          segment_size=min(DEFAULT_SPOOL_SEGMENT_SIZE,
+                                           max_size // 4))
+
+        # Keep events as undecoded lines if they are to be decoded elsewhere or written to the spool
+        raw = pool is not None or spool is not None
+        reader = EventStreamReader(options.id, raw=raw)
+        reader.connect()
+        event_buffer: Queue[Any] = Queue(maxsize=options.buffer_size)
+        reader_stats = {'events': 0, 'dropped': 0}
+
+        # Guards offering events against the main thread stopping to take them on exit
+        offer_lock = Lock()
+        accepting = [True]
+
+        def offer_event(event: Any) -> bool:
+            with offer_lock:
+                if not accepting[0]:
+                    return False
+                return offer_event_locked(event)
+
+        def offer_event_locked(event: Any) -> bool:
+            if spool is not None and not spool.empty:
+                # Keep events in order while earlier ones are still in the spool
+                return spool.append(event)
+            try:
+                event_buffer.put_nowait(event)
+                return True
+            except Full:
+                return spool is not None and spool.append(event)
+
+        running = [True]
+        reader_error: list[Optional[Exception]] = [None]
 
         def poll_event():
             dropped = 0
-            while True:
-                for event in events:
-                    try:
-                        event_buffer.put_nowait(event)
+            try:
+                for event in reader:
+                    reader_stats['events'] += 1
+                    if offer_event(event):
                         if dropped:
                             logger.warn(
                                 'Dropped %d event(s) as the buffer is full',
                                 dropped)
                             dropped = 0
-                    except Full:
+                    else:
                         dropped += 1
+                        reader_stats['dropped'] += 1
+            except Exception as e:
+                reader_error[0] = e
+                running[0] = False
 
         thread = Thread(target=poll_event, daemon=True)
         thread.start()
 
-        running = [True]
-
         def handle_signal(sig, stack):
             running[0] = False
+            reader.stop()
 
         signal(SIGINT, handle_signal)
         signal(SIGTERM, handle_signal)
 
-        actions = [
-            action_class() for name, action_class in _action_classes.items()
-            if name in options.actions
-        ]
-
-        for action in actions:
-            action.initialize(options)
-
-        while running[0]:
-            try:
-                event = event_buffer.get(block=True, timeout=0.5)
+        actions = _build_actions(options) if pool is None else []
+        # Marks of batches from the spool submitted to workers, with the spool position after each, to commit once workers have handled them
+        pending: deque[_PendingCommit] = deque()
+
+        def handle_events(batch: list[Any], from_spool: bool) -> None:
+            if pool is not None:
+                pool.submit(batch)
+                if from_spool:
+                    pending.append(
+                        (pool.mark(), spool.position))  # type: ignore
+                _commit_handled(pool, spool, pending)
+                return
+
+            if raw and batch:
+                batch, _ = decode_events(b'\n'.join(batch))
+            for event in batch:
                 for action in actions:
                     action.handle_event(event)
-            except Empty:
-                pass
+            if from_spool:
+                spool.commit()  # type: ignore
+
+        reported_at = monotonic()
+        while running[0]:
+            handle_events(*_take_events(event_buffer, spool))
+
+            if monotonic() - reported_at >= STATS_INTERVAL:
+                reported_at = monotonic()
+                _report_stats(reader_stats, reader, pool, spool)
+
+        # Stop taking events, and handle those left in the buffer, which are older than any in the spool; the spool is left for the next run
+        with offer_lock:
+            accepting[0] = False
+        while batch := _take_buffered_events(event_buffer):
+            handle_events(batch, False)
 
         for action in actions:
             action.close()
+        if pool is not None:
+            pool.close()
+            _commit_handled(pool, spool, pending)
+            pool = None
+
+        if reader_error[0] is not None:
+            raise reader_error[0]
 
     except Exception as e:
         print('{}: error: failed to get events: {}'.format(
@@ -329,3 +651,77 @@ def run(options: Union[dict[str, Any], Options]):
               file=sys.stderr)
         logger.debug('Exception information:', exc_info=e)
         return 1
+
+    finally:
+        if pool is not None:
+            pool.close()
+        if spool is not None:
+            spool.close()
+
+
+def _build_actions(options: Options) -> list[_BaseAction]:
+    actions = [
+        action_class() for name, action_class in _action_classes.items()
+        if name in options.actions
+    ]
+
+    for action in actions:
+        action.initialize(options)
+
+    return actions
+
+
+def _take_events(event_buffer: Queue[Any],
+                 spool: Optional[Spool]) -> tuple[list[Any], bool]:
+    """Take a batch of events, and tell whether they are from the spool.
+
+    Events in the buffer are always older than those in the spool, as the spool is only used once the buffer is full and until it is drained.
+    """
+    batch = _take_buffered_events(event_buffer)
+    if batch:
+        return batch, False
+
+    if spool is not None and not spool.empty:
+        return spool.read(EVENT_BATCH_SIZE), True
+
+    try:
+        return [event_buffer.get(block=True, timeout=0.5)], False
+    except Empty:
+        return [], False
+
+
+def _take_buffered_events(event_buffer: Queue[Any]) -> list[Any]:
+    batch = []
+    try:
+        while len(batch) < EVENT_BATCH_SIZE:
+            batch.append(event_buffer.get_nowait())
+    except Empty:
+        pass
+    return batch
+
+
+def _commit_handled(pool: WorkerPool, spool: Optional[Spool],
+                    pending: deque[_PendingCommit]) -> None:
+    """Commit the spool up to the last batch from it that workers have handled, so that a crash never loses records handed to workers but not yet handled."""
+    position = None
+    while pending and pool.handled(pending[0][0]):
+        position = pending.popleft()[1]
+    if position is not None:
+        spool.commit(position)  # type: ignore
+
+
+def _report_stats(reader_stats: dict[str, int], reader: EventStreamReader,
+                  pool: Optional[WorkerPool], spool: Optional[Spool]) -> None:
+    message = 'Read {} event(s), dropped {}'.format(reader_stats['events'],
+                                                    reader_stats['dropped'])
+    if reader.reconnects:
+        message += '; reconnected {} time(s), {:.1f} s down'.format(
+            reader.reconnects, reader.downtime)
+    if spool is not None:
+        spool_stats = spool.stats
+        message += '; spool depth {} event(s) ({:.1f} MiB), {:.1f} MiB on disk'.format(
+            spool_stats.records, spool_stats.bytes / 1024 / 1024,
+            spool_stats.disk_bytes / 1024 / 1024)
+    if pool is not None:
+        message += '; ' + pool.format_stats()
+    logger.info(message)
@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser, _SubParsersAction
+from collections import deque
+from dataclasses import dataclass, field
+from signal import SIGINT, SIGTERM, signal
+from threading import Event, Lock
+from time import monotonic
+from typing import Any, Optional, Union
+
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from network_tracing.cli.actions.events import (INFLUXDB_BUCKET,
+                                                build_influxdb_client,
+                                                format_event)
+from network_tracing.cli.constants import DEFAULT_PROGRAM_NAME
+from network_tracing.cli.influxdb import (DEFAULT_MAX_RETRIES, BatchingWriter,
+                                          is_retryable)
+from network_tracing.cli.models import BaseOptions
+from network_tracing.cli.recorded import find_files, iter_events
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_CONCURRENCY = 4
+DEFAULT_CHUNK_SIZE = 16384
+CHECKPOINT_SUFFIX = '.import-checkpoint'
+CHECKPOINT_INTERVAL = 5.0
+"""Seconds between saves of the checkpoint while importing."""
+PROGRESS_INTERVAL = 10.0
+
+
+@dataclass(kw_only=True)
+class Options(BaseOptions):
+    paths: list = field(default_factory=list)
+    """Recorded files, or directories to look for them in, e.g. that of `ntctl events -a record`."""
+    influxdb_config: Optional[str] = field(default=None)
+    batch_size: int = field(default=DEFAULT_BATCH_SIZE)
+    concurrency: int = field(default=DEFAULT_CONCURRENCY)
+    max_retries: int = field(default=DEFAULT_MAX_RETRIES)
+    chunk_size: int = field(default=DEFAULT_CHUNK_SIZE)
+    """Number of events loaded into memory at once."""
+    checkpoint: Optional[str] = field(default=None)
+    """Path of the file to keep progress in. If `None`, the first path suffixed with `.import-checkpoint`."""
+    restart: bool = field(default=False)
+    """Whether to import from the start, ignoring any checkpoint."""
+
+    def __post_init__(self):
+        if not self.paths:
+            raise ValueError('No recorded files to import')
+        if self.batch_size <= 0:
+            raise ValueError('Invalid batch size {}'.format(self.batch_size))
+        if self.concurrency <= 0:
+            raise ValueError('Invalid concurrency {}'.format(self.concurrency))
+        if self.max_retries < 0:
+            raise ValueError('Invalid maximum number of retries {}'.format(
+                self.max_retries))
+        if self.chunk_size <= 0:
+            raise ValueError('Invalid chunk size {}'.format(self.chunk_size))
+        if self.checkpoint is None:
+            self.checkpoint = self.paths[0].rstrip('/') + CHECKPOINT_SUFFIX
+
+
+class _ProgressTracker:
+    """Track the position in recorded files up to which all lines are written, as batches may be written out of order.
+
+    Lines are numbered in the order they are added to the writer, and each batch holds consecutive numbers. The position advances past a chunk of events once all lines before its end are written.
+    """
+
+    def __init__(self, position: tuple[int, int]) -> None:
+        self._lock = Lock()
+        self._position = position
+        self._added = 0
+        self._written = 0
+        """Number of lines, counted from the first one, all of which are written."""
+        self._done: dict[int, int] = {}
+        """Last numbers of written batches not yet contiguous with `_written`, by their first numbers."""
+        self._chunks: deque[tuple[int, tuple[int, int]]] = deque()
+        """Number of lines added up to the end of each chunk not yet passed, with the position of its end."""
+        self.failed: Optional[Exception] = None
+        """Error of a batch that could not be written, past which the position never advances."""
+
+    @property
+    def position(self) -> tuple[int, int]:
+        with self._lock:
+            return self._position
+
+    def add(self, lines: list[str],
+            position: tuple[int, int]) -> list[tuple[int, str]]:
+        """Number lines of a chunk ending at the specified position, to be added to the writer."""
+        with self._lock:
+            start = self._added
+            self._added += len(lines)
+            self._chunks.append((self._added, position))
+            self._advance()
+        return list(enumerate(lines, start))
+
+    def handle_batch_done(self, batch: list[tuple[int, str]],
+                          error: Optional[Exception]) -> None:
+        if error is not None and is_retryable(error):
+            # Lines may be written if retried later; keep the position before them
+            self.failed = error
+            return
+        # Lines rejected by InfluxDB would be rejected again, so move on as if written
+        with self._lock:
+            self._done[batch[0][0]] = batch[-1][0]
+            while self._written in self._done:
+                self._written = self._done.pop(self._written) + 1
+            self._advance()
+
+    def _advance(self) -> None:
+        chunks = self._chunks
+        while chunks and chunks[0][0] <= self._written:
+            self._position = chunks.popleft()[1]
+
+
+def configure_subparsers(subparsers: _SubParsersAction):
+    parser: ArgumentParser = subparsers.add_parser(
+        'import',
+        help='upload recorded events to InfluxDB, resuming from where a '
+        'previous import stopped')
+
+    parser.add_argument(
+        '-i',
+        '--influxdb-config',
+        metavar='PATH',
+        help=
+        'path to configuration file of InfluxDB Client, or use `:env:` to load '
+        'config from environment variables. If not specified, a default client '
+        'connecting to http://localhost:8086 will be created.')
+
+    parser.add_argument(
+        '--batch-size',
+        metavar='N',
+        type=int,
+        help='maximum number of records uploaded to InfluxDB at once; '
+        'defaults to {}'.format(DEFAULT_BATCH_SIZE))
+
+    parser.add_argument(
+        '--concurrency',
+        metavar='N',
+        type=int,
+        help='number of batches uploaded in parallel; defaults to {}'.format(
+            DEFAULT_CONCURRENCY))
+
+    parser.add_argument(
+        '--max-retries',
+        metavar='N',
+        type=int,
+        help='number of times a failed batch is retried, with exponential '
+        'backoff, before the import stops; defaults to {}'.format(
+            DEFAULT_MAX_RETRIES))
+
+    parser.add_argument(
+        '--chunk-size',
+        metavar='N',
+        type=int,
+        help='number of events loaded into memory at once; defaults to {}'.
+        format(DEFAULT_CHUNK_SIZE))
+
+    parser.add_argument(
+        '-c',
+        '--checkpoint',
+        metavar='PATH',
+        help='file to keep progress in, so that an interrupted or failed '
+        'import resumes where it stopped; defaults to the first path '
+        'suffixed with `{}`'.format(CHECKPOINT_SUFFIX))
+
+    parser.add_argument('--restart',
+                        action='store_true',
+                        default=None,
+                        help='import from the start, ignoring any checkpoint')
+
+    parser.add_argument(
+        'paths',
+        metavar='PATH',
+        nargs='+',
+        help='recorded files to import, or directories to look for them in; '
+        'can be Parquet or Arrow segments written by `events -a record`, or '
+        'JSON lines of events as streamed by the daemon')
+
+
+def run(options: Union[dict[str, Any], Options]):
+    try:
+        if isinstance(options, dict):
+            options = Options.from_dict(options)
+
+        files = find_files(options.paths)
+        if not files:
+            raise Exception('No recorded files found')
+        position = (0, 0)
+        if not options.restart:
+            position = _load_checkpoint(options.checkpoint, files)
+        if position[0] >= len(files):
+            print('All {} file(s) already imported; use --restart to import '
+                  'them again'.format(len(files)))
+            return
+        if position != (0, 0):
+            logger.info('Resuming from row %d of %s', position[1],
+                        files[position[0]])
+
+        influxdb_client = build_influxdb_client(options.influxdb_config)
+    except Exception as e:
+        print('{}: error: failed to import events: {}'.format(
+            DEFAULT_PROGRAM_NAME,
+            e,
+        ),
+              file=sys.stderr)
+        logger.debug('Exception information:', exc_info=e)
+        return 1
+
+    stopped = Event()
+
+    def handle_signal(sig, stack):
+        stopped.set()
+
+    signal(SIGINT, handle_signal)
+    signal(SIGTERM, handle_signal)
+
+    write_api = influxdb_client.write_api(SYNCHRONOUS)
+    tracker = _ProgressTracker(position)
+    # Lines are written by batch, so the whole batch size is filled before a flush is due
+    writer = BatchingWriter(lambda records: write_api.write(
+        bucket=INFLUXDB_BUCKET, record=[line for _, line in records]),
+                            batch_size=options.batch_size,
+                            concurrency=options.concurrency,
+                            max_retries=options.max_retries,
+                            on_batch_done=tracker.handle_batch_done)
+
+    events = 0
+    lines_added = 0
+    malformed = 0
+    unknown_probes: set[str] = set()
+    started_at = monotonic()
+    saved_at = reported_at = started_at
+    error: Optional[Exception] = None
+    try:
+        for index in range(position[0], len(files)):
+            skip = position[1] if index == position[0] else 0
+            for rows, chunk in iter_events(files[index], options.chunk_size,
+                                           skip):
+                lines: list[str] = []
+                for event in chunk:
+                    count = len(lines)
+                    try:
+                        recognized = format_event(event, lines)
+                    except (KeyError, TypeError, ValueError,
+                            AttributeError) as e:
+                        # Skip malformed events rather than stopping at the same chunk on every rerun
+                        del lines[count:]
+                        if not malformed:
+                            logger.warn(
+                                'Skipping event of probe \'%s\' that cannot be formatted: %s',
+                                event.probe, e)
+                        malformed += 1
+                        continue
+                    if not recognized and event.shape not in unknown_probes:
+                        unknown_probes.add(event.shape)
+                        logger.warn(
+                            'Cannot recognize probe type \'%s\'; ignoring',
+                            event.shape)
+                events += len(chunk)
+                lines_added += len(lines)
+                writer.add(*tracker.add(lines, (index, rows)))
+
+                now = monotonic()
+                if now - saved_at >= CHECKPOINT_INTERVAL:
+                    _save_checkpoint(options.checkpoint, files,
+                                     tracker.position)
+                    saved_at = now
+                if now - reported_at >= PROGRESS_INTERVAL:
+                    logger.info('Imported %d event(s) at %.0f/s, reading %s',
+                                events, events / (now - started_at),
+                                files[index])
+                    reported_at = now
+                if stopped.is_set() or tracker.failed is not None:
+                    break
+            else:
+                # Mark the file as finished even if it ends with events of unknown probes
+                writer.add(*tracker.add([], (index + 1, 0)))
+                continue
+            break
+    except Exception as e:
+        error = e
+
+    stats = writer.close()
+    influxdb_client.close()
+    position = tracker.position
+    try:
+        _save_checkpoint(options.checkpoint, files, position)
+    except Exception as e:
+        logger.warn('Failed to save checkpoint', exc_info=e)
+    elapsed = monotonic() - started_at
+
+    print('Read {} event(s) into {} line(s) in {:.1f} s ({:.0f} events/s)'.
+          format(events, lines_added, elapsed, events / max(elapsed, 1e-9)))
+    if malformed:
+        print('Skipped {} event(s) that could not be formatted'.format(
+            malformed))
+    print(stats.format())
+
+    error = error or tracker.failed
+    if error is not None:
+        print('{}: error: failed to import events: {}; rerun to resume from '
+              'checkpoint {}'.format(DEFAULT_PROGRAM_NAME, error,
+                                     options.checkpoint),
+              file=sys.stderr)
+        logger.debug('Exception information:', exc_info=error)
+        return 1
+    if position[0] < len(files):
+        print('Stopped at row {} of {}; rerun to resume from checkpoint {}'.
+              format(position[1], files[position[0]], options.checkpoint))
+        return 1
+
+
+def _load_checkpoint(path: str, files: list[str]) -> tuple[int, int]:
+    if not os.path.exists(path):
+        return (0, 0)
+    with open(path, 'r', encoding='utf-8') as fp:
+        checkpoint = json.load(fp)
+    if checkpoint.get('files', None) != files:
+        raise Exception(
+            'Checkpoint {} was saved for other files; use --restart to import '
+            'from the start, or --checkpoint to use another one'.format(path))
+    return (checkpoint['file'], checkpoint['rows'])
+
+
+def _save_checkpoint(path: str, files: list[str], position: tuple[int, int]):
+    # Replace the checkpoint at once, so that it is never left half written
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as fp:
+        json.dump({
+            'files': files,
+            'file': position[0],
+            'rows': position[1],
+        }, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temporary_path, path)
@@ -0,0 +1,210 @@
+import logging
+import shutil
+import sys
+from argparse import ArgumentParser, _SubParsersAction
+from dataclasses import dataclass, field
+from signal import SIGINT, SIGTERM, signal
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Optional, TextIO, Union
+
+from network_tracing.cli.aggregation import (DEFAULT_MAX_KEYS, SORT_KEYS,
+                                             Aggregator, StatsTable)
+from network_tracing.cli.constants import DEFAULT_PROGRAM_NAME
+from network_tracing.cli.models import BaseOptions
+from network_tracing.cli.stream import EventStreamReader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 1.0
+DEFAULT_SORT_KEY = 'p99'
+
+_CLEAR_SCREEN = '\x1b[H\x1b[2J'
+_ROW_FORMAT = '{:>10} {:>10} {:>10} {:>10} {:>10}  {}'
+
+
+@dataclass(kw_only=True)
+class Options(BaseOptions):
+    id: str
+    interval: float = field(default=DEFAULT_REFRESH_INTERVAL)
+    """Seconds between redraws, regardless of the rate of events."""
+    sort: str = field(default=DEFAULT_SORT_KEY)
+    limit: Optional[int] = field(default=None)
+    """Maximum number of rows of each table. If `None`, fit tables in the terminal."""
+    max_keys: int = field(default=DEFAULT_MAX_KEYS)
+    """Maximum number of flows, tasks or functions kept in memory each; those with the fewest events are evicted first."""
+
+    def __post_init__(self):
+        if self.interval <= 0:
+            raise ValueError('Invalid refresh interval {}'.format(
+                self.interval))
+        if self.sort not in SORT_KEYS:
+            raise ValueError('Invalid sort key {}'.format(self.sort))
+        if self.limit is not None and self.limit <= 0:
+            raise ValueError('Invalid limit {}'.format(self.limit))
+        if self.max_keys <= 0:
+            raise ValueError('Invalid maximum number of keys {}'.format(
+                self.max_keys))
+
+
+def configure_subparsers(subparsers: _SubParsersAction):
+    parser: ArgumentParser = subparsers.add_parser(
+        'top',
+        help='view flows, tasks and kernel functions with the worst latency '
+        'in a tracing task, updated live')
+
+    parser.add_argument('-n',
+                        '--interval',
+                        metavar='SECONDS',
+                        type=float,
+                        help='time between redraws; defaults to {}'.format(
+                            DEFAULT_REFRESH_INTERVAL))
+
+    parser.add_argument(
+        '-s',
+        '--sort',
+        metavar='KEY',
+        choices=SORT_KEYS,
+        help='statistic to rank rows by; can be one of {}. Defaults to {}'.
+        format(', '.join(SORT_KEYS), DEFAULT_SORT_KEY))
+
+    parser.add_argument(
+        '-l',
+        '--limit',
+        metavar='N',
+        type=int,
+        help='maximum number of rows of each table; defaults to fitting '
+        'tables in the terminal')
+
+    parser.add_argument(
+        '--max-keys',
+        metavar='N',
+        type=int,
+        help='maximum number of flows, tasks or functions each kept in '
+        'memory; defaults to {}'.format(DEFAULT_MAX_KEYS))
+
+    parser.add_argument('id',
+                        metavar='ID',
+                        help='ID of tracing task to view events')
+
+
+def run(options: Union[dict[str, Any], Options]):
+    try:
+        if isinstance(options, dict):
+            options = Options.from_dict(options)
+
+        reader = EventStreamReader(options.id)
+        reader.connect()
+    except Exception as e:
+        print('{}: error: failed to get events: {}'.format(
+            DEFAULT_PROGRAM_NAME,
+            e,
+        ),
+              file=sys.stderr)
+        logger.debug('Exception information:', exc_info=e)
+        return 1
+
+    aggregator = Aggregator(options.max_keys)
+    lock = Lock()
+    stopped = Event()
+    reader_error: list[Optional[Exception]] = [None]
+
+    def poll_event():
+        try:
+            for event in reader:
+                with lock:
+                    aggregator.add(event)
+        except Exception as e:
+            reader_error[0] = e
+        finally:
+            stopped.set()
+
+    thread = Thread(target=poll_event, daemon=True)
+    thread.start()
+
+    def handle_signal(sig, stack):
+        stopped.set()
+        reader.stop()
+
+    signal(SIGINT, handle_signal)
+    signal(SIGTERM, handle_signal)
+
+    interactive = sys.stdout.isatty()
+    started_at = monotonic()
+    while not stopped.wait(options.interval):
+        with lock:
+            screen = _render(aggregator, options, reader,
+                             monotonic() - started_at)
+        _draw(screen, sys.stdout, interactive)
+    if interactive:
+        # Leave the last screen in place, with the prompt below it
+        print()
+
+    if reader_error[0] is not None:
+        print('{}: error: failed to get events: {}'.format(
+            DEFAULT_PROGRAM_NAME,
+            reader_error[0],
+        ),
+              file=sys.stderr)
+        logger.debug('Exception information:', exc_info=reader_error[0])
+        return 1
+
+
+def _render(aggregator: Aggregator, options: Options,
+            reader: EventStreamReader, elapsed: float) -> list[str]:
+    tables = [
+        ('FLOW', 'Flows (total time, us)', aggregator.flows),
+        ('TASK', 'Tasks (run queue delay, us)', aggregator.tasks),
+        ('FUNCTION', 'Kernel functions (time, us)', aggregator.functions),
+    ]
+    # Hide tables of probes not in the task
+    tables = [(name, title, table) for name, title, table in tables if table]
+
+    limit = options.limit
+    if limit is None:
+        # Each table takes a blank line, a title and a header besides rows
+        height = shutil.get_terminal_size().lines - 2
+        limit = max((height - 3 * len(tables)) // max(len(tables), 1), 1)
+
+    status = '{} event(s), {:.0f}/s, sorted by {}'.format(
+        aggregator.events, aggregator.events / max(elapsed, 1e-9),
+        options.sort)
+    if aggregator.ignored:
+        status += ', {} ignored'.format(aggregator.ignored)
+    if reader.reconnects:
+        status += ', {} reconnect(s)'.format(reader.reconnects)
+    lines = [status]
+    if not tables:
+        lines.append('Waiting for events of delay_analysis_*, runqslower or '
+                     'retsnoop...')
+
+    for name, title, table in tables:
+        lines.append('')
+        lines.append(_format_title(title, table))
+        lines.append(
+            _ROW_FORMAT.format('COUNT', 'P50', 'P90', 'P99', 'MAX', name))
+        for stats in table.top(limit, options.sort):
+            lines.append(
+                _ROW_FORMAT.format(stats.count,
+                                   '{:.1f}'.format(stats.quantile(0.5)),
+                                   '{:.1f}'.format(stats.quantile(0.9)),
+                                   '{:.1f}'.format(stats.quantile(0.99)),
+                                   '{:.1f}'.format(stats.max), stats.label))
+    return lines
+
+
+def _format_title(title: str, table: StatsTable) -> str:
+    title = '{} - {}'.format(title, len(table))
+    if table.evicted:
+        title += ' ({} evicted)'.format(table.evicted)
+    return title
+
+
+def _draw(lines: list[str], output: TextIO, interactive: bool) -> None:
+    if interactive:
+        # Cut lines to the terminal, so that wrapping does not scroll the screen
+        width = shutil.get_terminal_size().columns
+        output.write(_CLEAR_SCREEN + '\n'.join(line[:width] for line in lines))
+    else:
+        output.write('\n'.join(lines) + '\n\n')
+    output.flush()
@@ -0,0 +1,53 @@
+import logging
+import sys
+from argparse import ArgumentParser, _SubParsersAction
+from dataclasses import dataclass
+from typing import Any, Union
+
+from network_tracing.cli.actions import start
+from network_tracing.cli.api import ApiClient
+from network_tracing.cli.constants import DEFAULT_PROGRAM_NAME
+from network_tracing.common.models import UpdateTracingTaskRequest
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(kw_only=True)
+class Options(start.Options):
+    id: str
+
+    def to_request(self) -> UpdateTracingTaskRequest:
+        return UpdateTracingTaskRequest.from_dict(self.to_request_dict())
+
+
+def configure_subparsers(subparsers: _SubParsersAction):
+    parser: ArgumentParser = subparsers.add_parser(
+        'update', help='update options of probes in a running tracing task')
+
+    parser.add_argument('id',
+                        metavar='ID',
+                        help='ID of tracing task to update')
+    parser.add_argument(
+        'options',
+        metavar='OPTIONS',
+        nargs='+',
+        help=
+        'options to update, in the format KEY=VALUE (e.g. probes.delay_analysis_out.sport=80)'
+    )
+
+
+def run(options: Union[dict[str, Any], Options]):
+    if isinstance(options, dict):
+        options = Options.from_dict(options)
+
+    try:
+        request = options.to_request()
+        ApiClient.get_instance().update_tracing_task(options.id, request)
+    except Exception as e:
+        print('{}: error: failed to update tracing task: {}'.format(
+            DEFAULT_PROGRAM_NAME,
+            e,
+        ),
+              file=sys.stderr)
+        logger.debug('Exception information:', exc_info=e)
+        return 1
@@ -43,3 +43,12 @@ def run(options: Union[dict[str, Any], Options]):
     print(f'Probes ({len(tracing_task.options.probes)}):')
     for probe_type, probe_options in tracing_task.options.probes.items():
         print(f'  {probe_type}: {probe_options}')
+    if tracing_task.details:
+        print(f'Details ({len(tracing_task.details)}):')
+        for probe_type, probe_details in tracing_task.details.items():
+            print(f'  {probe_type}:')
+            for key, value in probe_details.items():
+                if isinstance(value, list):
+                    value = '{} ({})'.format(', '.join(map(str, value)),
+                                             len(value))
+                print(f'    {key}: {value}')
@@ -0,0 +1,222 @@
+"""In-memory aggregation of events into latency statistics by flow, task and function, as shown by `ntctl top`."""
+
+import heapq
+import math
+from typing import Any, Callable, Hashable, Iterable
+
+from network_tracing.common.models import TracingEvent
+
+BUCKETS_PER_OCTAVE = 8
+"""Resolution of histograms; values are estimated within about 4.4% of the true ones."""
+
+DEFAULT_MAX_KEYS = 65536
+
+SORT_KEYS = ('p50', 'p90', 'p99', 'max', 'mean', 'count')
+_QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+_ZERO_BUCKET = -2**31
+"""Bucket of zero and negative values, which have no logarithm."""
+
+
+def slot_midpoint(slot: int) -> float:
+    """Return the middle of a log2 slot of `runqslower` summaries in us; slot i holds [2^i, 2^(i+1)) us, except that slot 0 holds [0, 2) us."""
+    return 1.0 if slot == 0 else 1.5 * 2**slot
+
+
+class LatencyStats:
+    """Count, sum and maximum of values, with a sparse histogram of logarithmic buckets to estimate quantiles."""
+
+    __slots__ = ('count', 'total', 'max', 'label', '_buckets')
+
+    def __init__(self, label: str) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.label = label
+        self._buckets: dict[int, int] = {}
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, value: float, count: int = 1) -> None:
+        if value > 0:
+            bucket = math.floor(math.log2(value) * BUCKETS_PER_OCTAVE)
+        else:
+            bucket = _ZERO_BUCKET
+        buckets = self._buckets
+        buckets[bucket] = buckets.get(bucket, 0) + count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Estimate the value below which a fraction `q` of values fall, by the middle of its bucket."""
+        if not self.count:
+            return 0.0
+        # Walk from the end closer to the quantile, as high ones are asked for more often
+        if q >= 0.5:
+            rank = self.count * (1 - q)
+            seen = 0
+            for bucket in sorted(self._buckets, reverse=True):
+                seen += self._buckets[bucket]
+                if seen > rank:
+                    return self._estimate(bucket)
+        else:
+            rank = self.count * q
+            seen = 0
+            for bucket in sorted(self._buckets):
+                seen += self._buckets[bucket]
+                if seen > rank:
+                    return self._estimate(bucket)
+        return self.max
+
+    def get(self, sort_key: str) -> float:
+        """Return the statistic named by a sort key."""
+        if sort_key == 'max':
+            return self.max
+        elif sort_key == 'mean':
+            return self.mean
+        elif sort_key == 'count':
+            return self.count
+        return self.quantile(_QUANTILES[sort_key])
+
+    def _estimate(self, bucket: int) -> float:
+        if bucket == _ZERO_BUCKET:
+            return 0.0
+        # Never estimate above the largest value seen
+        return min(2**((bucket + 0.5) / BUCKETS_PER_OCTAVE), self.max)
+
+
+class StatsTable:
+    """Latency statistics by key, keeping at most `max_keys` keys by evicting those with the fewest values."""
+
+    def __init__(self, max_keys: int = DEFAULT_MAX_KEYS) -> None:
+        if max_keys <= 0:
+            raise ValueError(
+                'Invalid maximum number of keys {}'.format(max_keys))
+
+        self._max_keys = max_keys
+        self._stats: dict[Hashable, LatencyStats] = {}
+        self.evicted = 0
+        """Number of keys evicted so far."""
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def add(self,
+            key: Hashable,
+            label: Callable[[], str],
+            value: float,
+            count: int = 1) -> None:
+        """Add a value to statistics of a key. `label` is called only for keys not seen before."""
+        stats = self._stats.get(key, None)
+        if stats is None:
+            if len(self._stats) >= self._max_keys:
+                self._evict()
+            stats = LatencyStats(label())
+            self._stats[key] = stats
+        stats.add(value, count)
+
+    def top(self, limit: int, sort_key: str) -> list[LatencyStats]:
+        """Return up to `limit` statistics with the greatest value of the sort key, in descending order."""
+        if sort_key not in _QUANTILES:
+            return heapq.nlargest(limit,
+                                  self._stats.values(),
+                                  key=lambda stats: stats.get(sort_key))
+
+        # Quantiles cost a walk over buckets; as none exceeds the maximum, visit keys by maximum and stop once no key left can make it
+        q = _QUANTILES[sort_key]
+        heap: list[tuple[float, int, LatencyStats]] = []
+        for index, stats in enumerate(
+                sorted(self._stats.values(),
+                       key=lambda stats: stats.max,
+                       reverse=True)):
+            if len(heap) >= limit and stats.max <= heap[0][0]:
+                break
+            item = (stats.quantile(q), index, stats)
+            if len(heap) < limit:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+        return [stats for _, _, stats in sorted(heap, reverse=True)]
+
+    def _evict(self) -> None:
+        # Evict half at once, so that eviction is amortized over many new keys
+        keep = self._max_keys // 2
+        kept = heapq.nlargest(keep,
+                              self._stats.items(),
+                              key=lambda item: item[1].count)
+        self.evicted += len(self._stats) - len(kept)
+        self._stats = dict(kept)
+
+
+class Aggregator:
+    """Aggregate events into per-flow total time of `delay_analysis_*` probes, per-task run queue delay of `runqslower`, and per-function time of `retsnoop`, all in microseconds."""
+
+    def __init__(self, max_keys: int = DEFAULT_MAX_KEYS) -> None:
+        self.flows = StatsTable(max_keys)
+        self.tasks = StatsTable(max_keys)
+        self.functions = StatsTable(max_keys)
+        self.events = 0
+        self.ignored = 0
+        """Number of events not aggregated into any table, e.g. of other probes or malformed."""
+
+    def add(self, event: TracingEvent) -> None:
+        self.events += 1
+        # Synthetic events are aggregated as those of the probe they imitate
+        shape = event.shape
+        handler = self._handlers.get(shape, None)
+        if handler is None and shape.startswith('delay_analysis_'):
+            handler = Aggregator._add_delay_analysis
+        if handler is None:
+            self.ignored += 1
+            return
+        try:
+            handler(self, event.event)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            self.ignored += 1
+
+    def add_all(self, events: Iterable[TracingEvent]) -> None:
+        for event in events:
+            self.add(event)
+
+    def _add_delay_analysis(self, data: dict[str, Any]) -> None:
+        parsed = data['parsed']
+        key = (parsed['saddr'], parsed['sport'], parsed['daddr'],
+               parsed['dport'])
+        self.flows.add(key, lambda: _format_flow(*key), parsed['total_time'])
+
+    def _add_runqslower(self, data: dict[str, Any]) -> None:
+        if data.get('kind', 'event') == 'summary':
+            # Summaries only tell the process; take latencies as the middle of their log2 slots
+            tgid = data['tgid']
+            for slot, count in enumerate(data['slots']):
+                if count:
+                    self.tasks.add((tgid, None),
+                                   lambda: 'tgid {}'.format(tgid),
+                                   slot_midpoint(slot), count)
+            return
+
+        # eBPF 获取到的 PID 在用户态看实际是线程 ID（TID）
+        key = (data['pid'], data['task'])
+        self.tasks.add(key, lambda: '{} ({})'.format(key[1], key[0]),
+                       data['delta_us'])
+
+    def _add_retsnoop(self, data: dict[str, Any]) -> None:
+        functions = self.functions
+        for name, duration in data['functions'].items():
+            functions.add(name, lambda: name, duration)
+
+    _handlers: dict[str, Callable[['Aggregator', Any], Any]] = {
+        'retsnoop': _add_retsnoop,
+        'runqslower': _add_runqslower,
+    }
+
+
+def _format_flow(saddr: str, sport: int, daddr: str, dport: int) -> str:
+    # IPv6 addresses are bracketed so that ports stay readable
+    if ':' in saddr:
+        return '[{}]:{} -> [{}]:{}'.format(saddr, sport, daddr, dport)
+    return '{}:{} -> {}:{}'.format(saddr, sport, daddr, dport)
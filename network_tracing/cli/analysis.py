@@ -0,0 +1,528 @@
+"""Vectorized analysis of recorded events, as done by `ntctl analyze`.
+
+Requires `numpy`, which is installed with the `analyze` extra, e.g. `pip install network-tracing[analyze]`. Reading segments written by `ntctl events -a record` also requires `pyarrow`, from the `record` extra; JSON lines of events, as streamed by the daemon, do not.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+from itertools import islice
+from typing import Any, Hashable, Iterable, Iterator, Optional
+
+import numpy as np
+
+from network_tracing.cli.aggregation import slot_midpoint
+from network_tracing.cli.decoding import decode_events
+from network_tracing.cli.recorded import (SEGMENT_EXTENSIONS, TIME_COLUMN,
+                                          find_files, import_pyarrow,
+                                          iter_record_batches)
+from network_tracing.common.constants import SYNTHETIC_PROBE
+from network_tracing.common.models import TracingEvent
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 16384
+DEFAULT_INTERVAL = 60.0
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+BUCKETS_PER_OCTAVE = 8
+"""Resolution of histograms, the same as that of `ntctl top`; values are estimated within about 4.4% of the true ones."""
+
+_MIN_EXPONENT = -4
+_MAX_EXPONENT = 32
+NUM_BUCKETS = (_MAX_EXPONENT - _MIN_EXPONENT) * BUCKETS_PER_OCTAVE + 1
+"""Buckets of values from 2^-4 to 2^32 us, and one more for zero and values below. Values above are counted in the last bucket."""
+
+_QUANTILE_BLOCK_ROWS = 4096
+"""Rows of histograms whose quantiles are computed at once, to bound the memory of temporary arrays."""
+
+TOTAL_TIME_COLUMN = 'parsed.total_time'
+FLOW_COLUMNS = ('parsed.saddr', 'parsed.sport', 'parsed.daddr', 'parsed.dport')
+STAGES = ('mac_time', 'qdisc_time', 'ip_time', 'tcp_time')
+"""Stages of `delay_analysis_*` events, of which `total_time` is the sum; each probe has some of them."""
+RUNQUEUE_COLUMNS = ('pid', 'task', 'delta_us', 'kind', 'tgid', 'slots')
+
+DELAY = 'delay'
+RUNQUEUE = 'runqueue'
+
+SHAPE_COLUMN = 'shape'
+"""Column of segments of the synthetic probe naming the probe each event imitates."""
+
+_COLUMNS = (TIME_COLUMN, TOTAL_TIME_COLUMN) + FLOW_COLUMNS + tuple(
+    'parsed.' + stage for stage in STAGES) + RUNQUEUE_COLUMNS
+"""Columns read from segments; others are skipped without being decoded."""
+
+Columns = dict[str, np.ndarray]
+
+
+class Histograms:
+    """Log-bucket histograms of values, one per key, as rows of a matrix grown as keys are seen. Sums of other values of each key may be kept along.
+
+    Memory is bounded by the number of keys, at about 2.3 KiB each, whatever the number of values.
+    """
+
+    def __init__(self, sums: Iterable[str] = ()) -> None:
+        self._keys: dict[Hashable, int] = {}
+        self._capacity = 0
+        self._counts = np.zeros((0, NUM_BUCKETS), dtype=np.int64)
+        self._maxima = np.zeros(0)
+        self._sums = {name: np.zeros(0) for name in ('', *sums)}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def keys(self) -> list[Hashable]:
+        return list(self._keys)
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._counts[:len(self)].sum(axis=1)
+
+    @property
+    def maxima(self) -> np.ndarray:
+        return self._maxima[:len(self)]
+
+    @property
+    def means(self) -> np.ndarray:
+        counts = self.counts
+        return np.divide(self.sum(''),
+                         counts,
+                         out=np.zeros(len(counts)),
+                         where=counts > 0)
+
+    def sum(self, name: str) -> np.ndarray:
+        """Return sums of values added with specified name for all keys, or of histogram values if the name is empty."""
+        return self._sums[name][:len(self)]
+
+    def row(self, key: Hashable) -> int:
+        """Return the row index of a key, adding a row if it is not seen before."""
+        row = self._keys.setdefault(key, len(self._keys))
+        self._reserve(len(self._keys))
+        return row
+
+    def rows(self, keys: Iterable[Hashable]) -> np.ndarray:
+        """Return row indices of keys, adding rows for those not seen before."""
+        mapping = self._keys
+        rows = np.fromiter(
+            (mapping.setdefault(key, len(mapping)) for key in keys),
+            dtype=np.int64)
+        self._reserve(len(mapping))
+        return rows
+
+    def add(self,
+            rows: np.ndarray,
+            values: np.ndarray,
+            weights: Optional[np.ndarray] = None,
+            sums: Optional[dict[str, np.ndarray]] = None) -> None:
+        """Add values to histograms of rows, and other values to sums of the same rows. Values are counted `weights` times each if given."""
+        flat_counts = self._counts.reshape(-1)
+        indices = rows * NUM_BUCKETS + bucket_indices(values)
+        if weights is None:
+            # Much cheaper than `np.add.at()`, with repeated indices summed up front
+            indices, counts = np.unique(indices, return_counts=True)
+            flat_counts[indices] += counts
+            np.add.at(self._sums[''], rows, values)
+        else:
+            np.add.at(flat_counts, indices, weights)
+            np.add.at(self._sums[''], rows, values * weights)
+        np.maximum.at(self._maxima, rows, values)
+        for name, extra_values in (sums or {}).items():
+            np.add.at(self._sums[name], rows, extra_values)
+
+    def quantiles(self, qs: Iterable[float] = QUANTILES) -> np.ndarray:
+        """Estimate quantiles of each key by the middle of buckets, as an array of keys by quantiles."""
+        qs = tuple(qs)
+        size = len(self)
+        result = np.zeros((size, len(qs)))
+        for start in range(0, size, _QUANTILE_BLOCK_ROWS):
+            end = min(start + _QUANTILE_BLOCK_ROWS, size)
+            cumulative = self._counts[start:end].cumsum(axis=1)
+            totals = cumulative[:, -1:]
+            for index, q in enumerate(qs):
+                # First bucket in which the cumulative count exceeds the rank
+                buckets = (cumulative > totals * q).argmax(axis=1)
+                result[start:end, index] = bucket_values(buckets)
+            result[start:end][totals[:, 0] == 0] = 0
+        # Never estimate above the largest value seen
+        return np.minimum(result, self.maxima[:, np.newaxis])
+
+    def octaves(self) -> np.ndarray:
+        """Return counts of values in [2^i, 2^(i+1)) us for each key, as an array of keys by octaves from i = 0; lower values are counted in the first octave."""
+        counts = self._counts[:len(self)]
+        first = -_MIN_EXPONENT * BUCKETS_PER_OCTAVE + 1
+        # Buckets are aligned to octaves, so that grouping them is exact
+        octaves = counts[:, first:].reshape(len(self), _MAX_EXPONENT,
+                                            BUCKETS_PER_OCTAVE).sum(axis=2)
+        octaves[:, 0] += counts[:, :first].sum(axis=1)
+        return octaves
+
+    def _reserve(self, size: int) -> None:
+        if size <= self._capacity:
+            return
+        # Grow geometrically, so that copying is amortized over many keys
+        capacity = max(size, self._capacity * 2, 64)
+        self._counts = _grow(self._counts, capacity)
+        self._maxima = _grow(self._maxima, capacity)
+        self._sums = {
+            name: _grow(sums, capacity)
+            for name, sums in self._sums.items()
+        }
+        self._capacity = capacity
+
+
+class DelayAnalysis:
+    """Statistics of `total_time` of `delay_analysis_*` events overall, by flow and by interval, with sums of stages to tell their contributions."""
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL) -> None:
+        if interval <= 0:
+            raise ValueError('Invalid interval {}'.format(interval))
+
+        self.interval = interval
+        self.overall = Histograms(STAGES)
+        self.flows = Histograms(STAGES)
+        self.intervals = Histograms(STAGES)
+        self.first_time: Optional[int] = None
+        self.last_time: Optional[int] = None
+        self.skipped = 0
+        """Number of events without a valid total time or flow."""
+
+    def add(self, columns: Columns) -> None:
+        total_time = columns[TOTAL_TIME_COLUMN].astype(np.float64)
+        valid = np.isfinite(total_time)
+        for name in FLOW_COLUMNS:
+            valid &= _valid(columns[name])
+        self.skipped += len(valid) - int(valid.sum())
+        if not valid.any():
+            return
+
+        total_time = total_time[valid]
+        time = columns[TIME_COLUMN][valid].astype(np.int64)
+        # Stages missing from events of a probe count as 0
+        stages = {
+            stage:
+            np.nan_to_num(columns['parsed.' + stage][valid].astype(np.float64))
+            if 'parsed.' + stage in columns else np.zeros(len(total_time))
+            for stage in STAGES
+        }
+
+        self.overall.add(np.full(len(total_time), self.overall.row(None)),
+                         total_time,
+                         sums=stages)
+        self.flows.add(_flow_rows(self.flows, columns, valid),
+                       total_time,
+                       sums=stages)
+        interval_ns = int(self.interval * 1e9)
+        starts, inverse = np.unique(time // interval_ns * interval_ns,
+                                    return_inverse=True)
+        self.intervals.add(self.intervals.rows(
+            starts.tolist())[inverse.reshape(-1)],
+                           total_time,
+                           sums=stages)
+
+        first, last = int(time.min()), int(time.max())
+        if self.first_time is None or first < self.first_time:
+            self.first_time = first
+        if self.last_time is None or last > self.last_time:
+            self.last_time = last
+
+    def stage_shares(self, histograms: Histograms) -> dict[str, np.ndarray]:
+        """Return the share of each stage in the sum of total time of each key. Stages not seen at all are left out."""
+        totals = histograms.sum('')
+        shares = {}
+        for stage in STAGES:
+            sums = histograms.sum(stage)
+            if not sums.any():
+                continue
+            shares[stage] = np.divide(sums,
+                                      totals,
+                                      out=np.zeros(len(totals)),
+                                      where=totals > 0)
+        return shares
+
+
+class RunqueueAnalysis:
+    """Distribution of run queue delay of `runqslower` events overall and by task.
+
+    Summaries only tell the process and log2 slots of delays, which are counted as the middle of each slot under the process.
+    """
+
+    def __init__(self) -> None:
+        self.overall = Histograms()
+        self.tasks = Histograms()
+        self.skipped = 0
+        """Number of events without a valid delay."""
+
+    def add(self, columns: Columns) -> None:
+        size = len(next(iter(columns.values())))
+        if 'kind' in columns:
+            summary = columns['kind'] == 'summary'
+        else:
+            summary = np.zeros(size, dtype=bool)
+
+        if summary.any():
+            self._add_summaries({
+                name: column[summary]
+                for name, column in columns.items()
+            })
+
+        if not {'delta_us', 'pid', 'task'}.issubset(columns):
+            return
+        delta_us = columns['delta_us'].astype(np.float64)
+        valid = ~summary & np.isfinite(delta_us) & _valid(
+            columns['pid']) & _valid(columns['task'])
+        self.skipped += int((~summary).sum()) - int(valid.sum())
+        if not valid.any():
+            return
+
+        delta_us = delta_us[valid]
+        self.overall.add(np.full(len(delta_us), self.overall.row(None)),
+                         delta_us)
+        # eBPF 获取到的 PID 在用户态看实际是线程 ID（TID）
+        pids = columns['pid'][valid].astype(np.int64)
+        tasks = columns['task'][valid]
+        unique_pids, indices, inverse = np.unique(pids,
+                                                  return_index=True,
+                                                  return_inverse=True)
+        # Name each task after its first event in the chunk, as names may change on exec
+        keys = [(int(pid), str(tasks[index]))
+                for pid, index in zip(unique_pids, indices)]
+        self.tasks.add(self.tasks.rows(keys)[inverse.reshape(-1)], delta_us)
+
+    def _add_summaries(self, columns: Columns) -> None:
+        if 'slots' not in columns or 'tgid' not in columns:
+            return
+        rows, values, weights = [], [], []
+        for tgid, slots in zip(columns['tgid'], columns['slots']):
+            # Recorded segments keep lists as JSON
+            if isinstance(slots, str):
+                slots = json.loads(slots)
+            if not _valid_value(tgid) or not slots:
+                continue
+            for slot, count in enumerate(slots):
+                if count:
+                    rows.append(('tgid', int(tgid)))
+                    values.append(slot_midpoint(slot))
+                    weights.append(count)
+        if not rows:
+            return
+
+        values_array = np.array(values)
+        weights_array = np.array(weights, dtype=np.int64)
+        self.overall.add(np.full(len(values), self.overall.row(None)),
+                         values_array, weights_array)
+        self.tasks.add(self.tasks.rows(rows), values_array, weights_array)
+
+
+def bucket_indices(values: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buckets = np.floor(
+            (np.log2(values) - _MIN_EXPONENT) * BUCKETS_PER_OCTAVE) + 1
+    buckets = np.nan_to_num(buckets, nan=0, neginf=0, posinf=NUM_BUCKETS - 1)
+    return np.clip(buckets, 0, NUM_BUCKETS - 1).astype(np.int64)
+
+
+def bucket_values(buckets: np.ndarray) -> np.ndarray:
+    values = 2**((buckets - 0.5) / BUCKETS_PER_OCTAVE + _MIN_EXPONENT)
+    return np.where(buckets == 0, 0.0, values)
+
+
+def format_time(timestamp: Optional[int]) -> str:
+    if timestamp is None:
+        return '-'
+    return datetime.fromtimestamp(
+        timestamp / 1e9).astimezone().isoformat(timespec='seconds')
+
+
+def iter_chunks(
+        paths: Iterable[str],
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[tuple[str, Columns]]:
+    """Read recorded events in chunks of at most `chunk_size` events, and yield columns of each as arrays, with whether they are of `DELAY` or `RUNQUEUE` events. Events of other probes are skipped."""
+    if chunk_size <= 0:
+        raise ValueError('Invalid chunk size {}'.format(chunk_size))
+
+    for path in find_files(paths):
+        logger.info('Reading %s', path)
+        if path.endswith(SEGMENT_EXTENSIONS):
+            chunks = _iter_segment_chunks(path, chunk_size)
+        else:
+            chunks = _iter_json_lines_chunks(path, chunk_size)
+        for kind, columns in chunks:
+            if columns and len(next(iter(columns.values()))):
+                yield kind, columns
+
+
+def _iter_segment_chunks(path: str,
+                         chunk_size: int) -> Iterator[tuple[str, Columns]]:
+    pa = import_pyarrow(path)
+    # Segments are written to a directory per probe
+    probe = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    synthetic = probe == SYNTHETIC_PROBE
+    kind = _kind_of_probe(probe)
+    if kind is None and not synthetic:
+        return
+    wanted = _COLUMNS + (SHAPE_COLUMN, ) if synthetic else _COLUMNS
+
+    if path.endswith('.parquet'):
+        parquet_file = pa.parquet.ParquetFile(path)
+        names = set(parquet_file.schema_arrow.names)
+        batches: Iterable[Any] = parquet_file.iter_batches(
+            batch_size=chunk_size,
+            columns=[name for name in wanted if name in names])
+    else:
+        reader = pa.ipc.open_file(path)
+        names = set(reader.schema.names)
+        batches = iter_record_batches(reader, chunk_size)
+    if synthetic and SHAPE_COLUMN not in names:
+        return
+
+    for batch in batches:
+        columns = {}
+        for name in wanted:
+            if name not in names:
+                continue
+            column = batch.column(name)
+            if pa.types.is_timestamp(column.type):
+                column = column.cast(pa.int64())
+            columns[name] = column.to_numpy(zero_copy_only=False)
+
+        if not synthetic:
+            if _has_columns(kind, names):  # type: ignore
+                yield kind, columns  # type: ignore
+            continue
+        # Split events of the synthetic probe by the probe they imitate
+        shapes = columns.pop(SHAPE_COLUMN)
+        kinds = {
+            shape: _kind_of_probe(shape)
+            for shape in set(shapes.tolist()) if isinstance(shape, str)
+        }
+        for kind_of_shapes in (DELAY, RUNQUEUE):
+            if not _has_columns(kind_of_shapes, names):
+                continue
+            mask = np.isin(shapes, [
+                shape for shape, shape_kind in kinds.items()
+                if shape_kind == kind_of_shapes
+            ])
+            if mask.any():
+                yield kind_of_shapes, {
+                    name: column[mask]
+                    for name, column in columns.items()
+                }
+
+
+def _iter_json_lines_chunks(path: str,
+                            chunk_size: int) -> Iterator[tuple[str, Columns]]:
+    with open(path, 'rb') as fp:
+        while lines := list(islice(fp, chunk_size)):
+            events, _ = decode_events(b''.join(lines).rstrip(b'\r\n'))
+            delay_events = []
+            runqueue_events = []
+            for event in events:
+                kind = _kind_of_event(event)
+                if kind == DELAY:
+                    delay_events.append(event)
+                elif kind == RUNQUEUE:
+                    runqueue_events.append(event)
+
+            if delay_events:
+                yield DELAY, _delay_columns(delay_events)
+            if runqueue_events:
+                yield RUNQUEUE, _runqueue_columns(runqueue_events)
+
+
+def _delay_columns(events: list[TracingEvent]) -> Columns:
+    parsed = [event.event['parsed'] for event in events]
+    columns = {
+        TIME_COLUMN:
+        np.array([event.timestamp for event in events], dtype=np.int64),
+    }
+    for name in (TOTAL_TIME_COLUMN, ) + tuple('parsed.' + stage
+                                              for stage in STAGES):
+        key = name[len('parsed.'):]
+        columns[name] = np.array([data.get(key, None) for data in parsed],
+                                 dtype=np.float64)
+    for name in FLOW_COLUMNS:
+        key = name[len('parsed.'):]
+        columns[name] = np.array([data.get(key, None) for data in parsed],
+                                 dtype=object)
+    return columns
+
+
+def _runqueue_columns(events: list[TracingEvent]) -> Columns:
+    data = [event.event for event in events]
+    columns = {
+        TIME_COLUMN:
+        np.array([event.timestamp for event in events], dtype=np.int64),
+        'delta_us':
+        np.array([item.get('delta_us', None) for item in data],
+                 dtype=np.float64),
+    }
+    for name in ('pid', 'task', 'kind', 'tgid', 'slots'):
+        column = np.empty(len(data), dtype=object)
+        column[:] = [item.get(name, None) for item in data]
+        columns[name] = column
+    return columns
+
+
+def _kind_of_probe(probe: str) -> Optional[str]:
+    if probe.startswith('delay_analysis_'):
+        return DELAY
+    elif probe == 'runqslower':
+        return RUNQUEUE
+    return None
+
+
+def _has_columns(kind: str, names: set[str]) -> bool:
+    if kind == DELAY:
+        return TOTAL_TIME_COLUMN in names and names.issuperset(FLOW_COLUMNS)
+    return 'delta_us' in names or 'slots' in names
+
+
+def _kind_of_event(event: TracingEvent) -> Optional[str]:
+    data = event.event
+    if not isinstance(data, dict):
+        return None
+    # Synthetic events are analyzed as those of the probe they imitate
+    kind = _kind_of_probe(event.shape)
+    if kind == DELAY and not isinstance(data.get('parsed', None), dict):
+        return None
+    return kind
+
+
+def _flow_rows(histograms: Histograms, columns: Columns,
+               valid: np.ndarray) -> np.ndarray:
+    saddrs, saddr_codes = np.unique(columns['parsed.saddr'][valid].astype(str),
+                                    return_inverse=True)
+    daddrs, daddr_codes = np.unique(columns['parsed.daddr'][valid].astype(str),
+                                    return_inverse=True)
+    # Flows as rows of integers, which are much cheaper to find unique ones of than tuples
+    codes = np.stack([
+        saddr_codes.reshape(-1),
+        columns['parsed.sport'][valid].astype(np.int64),
+        daddr_codes.reshape(-1),
+        columns['parsed.dport'][valid].astype(np.int64),
+    ],
+                     axis=1)
+    unique_codes, inverse = np.unique(codes, axis=0, return_inverse=True)
+    keys = [(str(saddrs[saddr]), int(sport), str(daddrs[daddr]), int(dport))
+            for saddr, sport, daddr, dport in unique_codes]
+    return histograms.rows(keys)[inverse.reshape(-1)]
+
+
+def _valid(column: np.ndarray) -> np.ndarray:
+    if column.dtype.kind == 'f':
+        return np.isfinite(column)
+    elif column.dtype.kind == 'O':
+        return np.not_equal(column, None)
+    return np.ones(len(column), dtype=bool)
+
+
+def _valid_value(value: Any) -> bool:
+    return value is not None and value == value
+
+
+def _grow(array: np.ndarray, capacity: int) -> np.ndarray:
+    grown = np.zeros((capacity, ) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
@@ -1,15 +1,20 @@
 import logging
 import random
-from typing import Callable, Optional
+from itertools import chain
+from typing import Callable, Iterable, Iterator, Optional
 from urllib.parse import quote, urljoin
 
 import requests
+from requests.models import ITER_CHUNK_SIZE
 
 from network_tracing.cli.constants import DEFAULT_BASE_URL
+from network_tracing.cli.decoding import (READ_SIZE, Buffer, decode_events,
+                                          split_lines)
 from network_tracing.common.models import (
     CreateTracingTaskRequest, CreateTracingTaskResponse, DaemonInfoResponse,
     ErrorResponse, GetTracingEventsResponse, GetTracingTaskResponse,
-    ListTracingTasksResponse, TracingEvent, TracingTaskResponse)
+    ListTracingTasksResponse, TracingEvent, TracingTaskResponse,
+    UpdateTracingTaskRequest, UpdateTracingTaskResponse)
 from network_tracing.common.utilities import Metadata
 
 logger = logging.getLogger(__name__)
@@ -45,9 +50,13 @@ class ApiClient:
             lambda: self.get_tracing_task_raw(id))
         return GetTracingTaskResponse.from_dict(response.json())
 
-    def get_tracing_events_raw(self, task_id: str):
+    def get_tracing_events_raw(self,
+                               task_id: str,
+                               after: Optional[int] = None):
+        params = {} if after is None else {'after': after}
         response = self.http.get('/tracing_tasks/{}/events'.format(
             quote(task_id)),
+                                 params=params,
                                  stream=True)
 
         if response.encoding is None:
@@ -55,25 +64,40 @@ class ApiClient:
 
         return response
 
-    def get_tracing_events(self, task_id: str) -> GetTracingEventsResponse:
+    def get_tracing_events(
+            self,
+            task_id: str,
+            after: Optional[int] = None) -> GetTracingEventsResponse:
+        """Get events of a tracing task as a stream. If `after` is given, skip events buffered by the daemon with sequence numbers up to it."""
+        return chain.from_iterable(
+            self.get_tracing_event_batches(task_id, after))
+
+    def get_tracing_event_batches(
+            self,
+            task_id: str,
+            after: Optional[int] = None) -> Iterator[list[TracingEvent]]:
+        """Like `get_tracing_events()`, but yield lists of events as they are read, which is cheaper for consumers handling events in bulk."""
         response = self._call_and_check_response(
-            lambda: self.get_tracing_events_raw(task_id))
+            lambda: self.get_tracing_events_raw(task_id, after))
 
         def generate():
-            for line in response.iter_lines():
-                try:
-                    yield TracingEvent.from_json(line)
-                except Exception as e:
-                    logger.warn(
-                        'Dropped an event because an error ocurred while parsing it (maybe malformed)'
-                    )
-                    logger.debug('Event (before parsing): %s', line)
-                    logger.debug(
-                        'Exception encountered while parsing the event:',
-                        exc_info=e)
+            for block in self._iter_line_blocks(response):
+                events, _ = decode_events(block)
+                if events:
+                    yield events
 
         return generate()
 
+    def get_tracing_event_lines(
+            self,
+            task_id: str,
+            after: Optional[int] = None) -> Iterable[bytes]:
+        """Like `get_tracing_events()`, but yield each event as an undecoded JSON line."""
+        response = self._call_and_check_response(
+            lambda: self.get_tracing_events_raw(task_id, after))
+        return (line for block in self._iter_line_blocks(response)
+                for line in bytes(block).split(b'\n') if line.strip())
+
     def create_tracing_task_raw(self, payload: CreateTracingTaskRequest):
         return self.http.post('/tracing_tasks', json=payload.to_dict())
 
@@ -84,6 +108,18 @@ class ApiClient:
             lambda: self.create_tracing_task_raw(payload))
         return CreateTracingTaskResponse.from_dict(response.json())
 
+    def update_tracing_task_raw(self, id: str,
+                                payload: UpdateTracingTaskRequest):
+        return self.http.patch('/tracing_tasks/{}'.format(quote(id)),
+                               json=payload.to_dict())
+
+    def update_tracing_task(
+            self, id: str,
+            payload: UpdateTracingTaskRequest) -> UpdateTracingTaskResponse:
+        response = self._call_and_check_response(
+            lambda: self.update_tracing_task_raw(id, payload))
+        return UpdateTracingTaskResponse.from_dict(response.json())
+
     def remove_tracing_task_raw(self, id: str):
         return self.http.delete('/tracing_tasks/{}'.format(quote(id)))
 
@@ -129,6 +165,15 @@ class ApiClient:
         except requests.RequestException as e:
             raise ApiException(e) from e
 
+    @staticmethod
+    def _iter_line_blocks(response: requests.Response) -> Iterator[Buffer]:
+        # Chunked responses are read a chunk at a time, however large the read size is; others are read until the read size is reached, which would hold back events of a slow stream
+        if getattr(response.raw, 'chunked', True):
+            read_size = READ_SIZE
+        else:
+            read_size = ITER_CHUNK_SIZE
+        return split_lines(response.iter_content(chunk_size=read_size))
+
     @staticmethod
     def _build_default_headers() -> dict[str, str]:
         return {
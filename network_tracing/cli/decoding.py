@@ -0,0 +1,79 @@
+"""Decoding of streamed events in batches.
+
+`orjson` is used if installed, e.g. with the `fast` extra (`pip install network-tracing[fast]`); otherwise the standard `json` module is.
+"""
+
+import json
+import logging
+from typing import Any, Callable, Iterable, Iterator, Union
+
+from network_tracing.common.models import TracingEvent
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 256 * 1024
+"""Bytes to read from a stream at once."""
+
+_loads: Callable[[bytes], Any] = json.loads if orjson is None else orjson.loads
+
+Buffer = Union[bytes, memoryview]
+"""Bytes or a view of them, as blocks of lines are passed around without copying."""
+
+
+def split_lines(chunks: Iterable[bytes]) -> Iterator[Buffer]:
+    """Join chunks into blocks of complete lines, so that each line is split only once it is decoded.
+
+    Each block yielded ends with the last complete line of a chunk, without the trailing newline. Blocks are views into chunks, which are only copied to join a line spanning several chunks with the block of the chunk it ends in.
+    """
+    remainder: Buffer = b''
+    for chunk in chunks:
+        end = chunk.rfind(b'\n')
+        if end < 0:
+            remainder = b''.join((remainder, chunk))
+            continue
+        view = memoryview(chunk)
+        if remainder:
+            block: Buffer = b''.join((remainder, view[:end]))
+        else:
+            block = view[:end]
+        remainder = view[end + 1:]
+        # Blocks of whitespace only are left to decoders, which skip blank lines anyway
+        if block:
+            yield block
+    if remainder:
+        yield remainder
+
+
+def decode_events(block: Buffer) -> tuple[list[TracingEvent], int]:
+    """Decode newline-separated events, and return them with the number of those dropped as malformed.
+
+    Events are decoded as a single JSON array, which costs one call into the JSON backend instead of one per event. This relies on JSON lines never containing raw newlines. If any line is malformed, lines are decoded one by one instead, so that only malformed ones are dropped.
+    """
+    try:
+        # Newlines are replaced in a copy, as views cannot be changed in place
+        items = _loads(b''.join((b'[', block, b']')).replace(b'\n', b','))
+        return [TracingEvent.from_dict(item) for item in items], 0
+    except Exception:
+        pass
+
+    events = []
+    dropped = 0
+    for line in bytes(block).split(b'\n'):
+        if not line.strip():
+            continue
+        try:
+            events.append(TracingEvent.from_dict(_loads(line)))
+        except Exception as e:
+            dropped += 1
+            logger.warn(
+                'Dropped an event because an error ocurred while parsing it (maybe malformed)'
+            )
+            logger.debug('Event (before parsing): %s', line)
+            logger.debug('Exception encountered while parsing the event:',
+                         exc_info=e)
+    return events, dropped
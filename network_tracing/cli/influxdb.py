@@ -0,0 +1,224 @@
+import logging
+import random
+from dataclasses import dataclass, field
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Optional
+
+from network_tracing.cli.aggregation import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_CONCURRENCY = 2
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_INTERVAL = 1.0
+
+MAX_RETRY_INTERVAL = 30.0
+"""Upper bound of the interval in seconds between retries, however many times a batch has failed."""
+
+
+def is_retryable(e: Exception) -> bool:
+    """Tell whether a failed write may succeed if retried, e.g. not if InfluxDB rejected the data itself."""
+    status = getattr(e, 'status', None)
+    if isinstance(status, int) and 400 <= status < 500:
+        # Too Many Requests is the only client error caused by timing
+        return status == 429
+    return True
+
+
+@dataclass
+class BatchingWriterStats:
+    batches: int = field(default=0)
+    """Number of batches written successfully."""
+
+    records: int = field(default=0)
+    """Number of records written successfully."""
+
+    failed_batches: int = field(default=0)
+    """Number of batches dropped after failing and running out of retries."""
+
+    failed_records: int = field(default=0)
+    """Number of records in dropped batches."""
+
+    retries: int = field(default=0)
+    """Number of retried writes."""
+
+    latencies: LatencyStats = field(
+        default_factory=lambda: LatencyStats('batch'))
+    """Seconds from each batch being complete to being written, including time waiting for a free writer and retries, kept as a histogram so that memory use does not grow with the number of batches."""
+
+    def format(self) -> str:
+        latencies = self.latencies
+        summary = '{} record(s) in {} batch(es) written, {} record(s) in {} batch(es) failed, {} retry(ies)'.format(
+            self.records, self.batches, self.failed_records,
+            self.failed_batches, self.retries)
+        if latencies.count:
+            summary += '; batch latency in ms: mean {:.1f}, p50 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+                latencies.mean * 1000,
+                latencies.quantile(0.5) * 1000,
+                latencies.quantile(0.99) * 1000, latencies.max * 1000)
+        return summary
+
+
+class BatchingWriter:
+    """Group records into batches and write them with a pool of threads, retrying failed batches with exponential backoff.
+
+    `add()` blocks when all writers are busy and `concurrency` batches are already waiting, so that a slow InfluxDB shows up as a full event buffer upstream rather than unbounded memory use here.
+
+    If given, `on_batch_done` is called from writer threads with each batch once it is written, or with the last exception once it is dropped. Batches are written in parallel, so they may be done out of order.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[list[Any]], Any],
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_interval: float = DEFAULT_RETRY_INTERVAL,
+        retryable: Callable[[Exception], bool] = is_retryable,
+        on_batch_done: Optional[Callable[[list[Any], Optional[Exception]],
+                                         Any]] = None
+    ) -> None:
+        if batch_size <= 0:
+            raise ValueError('Invalid batch size {}'.format(batch_size))
+        if flush_interval <= 0:
+            raise ValueError(
+                'Invalid flush interval {}'.format(flush_interval))
+        if concurrency <= 0:
+            raise ValueError('Invalid concurrency {}'.format(concurrency))
+        if max_retries < 0:
+            raise ValueError(
+                'Invalid maximum number of retries {}'.format(max_retries))
+
+        self._write = write
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._retry_interval = retry_interval
+        self._retryable = retryable
+        self._on_batch_done = on_batch_done
+
+        self._lock = Lock()
+        self._batch: list[Any] = []
+        self._batch_started: Optional[float] = None
+        self._batches: Queue[Optional[tuple[list[Any], float]]] = Queue(
+            maxsize=concurrency)
+        self._stats = BatchingWriterStats()
+        self._closed = Event()
+
+        self._writers = [
+            Thread(target=self._run_writer, daemon=True)
+            for _ in range(concurrency)
+        ]
+        for writer in self._writers:
+            writer.start()
+        self._flusher = Thread(target=self._run_flusher, daemon=True)
+        self._flusher.start()
+
+    @property
+    def stats(self) -> BatchingWriterStats:
+        return self._stats
+
+    def add(self, *records: Any) -> None:
+        if self._closed.is_set():
+            raise RuntimeError('Writer is closed')
+
+        for record in records:
+            with self._lock:
+                if not self._batch:
+                    self._batch_started = monotonic()
+                self._batch.append(record)
+                if len(self._batch) < self._batch_size:
+                    continue
+                batch = self._take_batch()
+            # Enqueue outside the lock, as this may block
+            self._batches.put(batch)
+
+    def flush(self) -> None:
+        """Hand the current partial batch over to writers without waiting for it to be written."""
+        with self._lock:
+            if not self._batch:
+                return
+            batch = self._take_batch()
+        self._batches.put(batch)
+
+    def close(self) -> BatchingWriterStats:
+        """Write remaining records, stop all threads and log statistics."""
+        if self._closed.is_set():
+            return self._stats
+
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        for _ in self._writers:
+            self._batches.put(None)
+        for writer in self._writers:
+            writer.join()
+
+        logger.info('Upload finished: %s', self._stats.format())
+        return self._stats
+
+    def _take_batch(self) -> tuple[list[Any], float]:
+        batch, self._batch = self._batch, []
+        return batch, monotonic()
+
+    def _run_flusher(self) -> None:
+        while not self._closed.wait(self._flush_interval / 2):
+            with self._lock:
+                due = self._batch_started is not None and self._batch \
+                    and monotonic() - self._batch_started >= self._flush_interval
+            if due:
+                self.flush()
+
+    def _run_writer(self) -> None:
+        while (item := self._batches.get()) is not None:
+            batch, completed_at = item
+            error = self._write_batch(batch, completed_at)
+            if self._on_batch_done is not None:
+                try:
+                    self._on_batch_done(batch, error)
+                except Exception as e:
+                    logger.warn('Encountered an error in batch callback',
+                                exc_info=e)
+
+    def _write_batch(self, batch: list[Any],
+                     completed_at: float) -> Optional[Exception]:
+        """Write a batch, retrying if needed, and return the last exception if it is dropped."""
+        attempt = 0
+        while True:
+            try:
+                self._write(batch)
+            except Exception as e:
+                if attempt >= self._max_retries or not self._retryable(e):
+                    logger.warn(
+                        'Dropped batch of %d record(s) after %d attempt(s)',
+                        len(batch),
+                        attempt + 1,
+                        exc_info=e)
+                    with self._lock:
+                        self._stats.failed_batches += 1
+                        self._stats.failed_records += len(batch)
+                    return e
+
+                # Full jitter, so that concurrent writers do not retry in lockstep
+                interval = random.uniform(
+                    0,
+                    min(self._retry_interval * 2**attempt, MAX_RETRY_INTERVAL))
+                logger.debug('Failed to write batch (%s); retrying in %.2f s',
+                             e, interval)
+                attempt += 1
+                with self._lock:
+                    self._stats.retries += 1
+                # Keep retrying while closing, so that remaining records are not lost
+                sleep(interval)
+                continue
+
+            with self._lock:
+                self._stats.batches += 1
+                self._stats.records += len(batch)
+                self._stats.latencies.add(monotonic() - completed_at)
+            return None
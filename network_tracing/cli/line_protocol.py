@@ -0,0 +1,146 @@
+"""Formatting of InfluxDB line protocol without building `Point` objects.
+
+Output is the same as that of `influxdb_client.Point.to_line_protocol()`: tags and fields are sorted by name, `None` and non-finite values are skipped, and lines without fields are omitted.
+"""
+
+import math
+from functools import cache, lru_cache
+from typing import Any, Iterable, Optional
+
+_ESCAPE_MEASUREMENT = str.maketrans({
+    ',': r'\,',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+_ESCAPE_KEY = str.maketrans({
+    ',': r'\,',
+    '=': r'\=',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+_ESCAPE_STRING = str.maketrans({
+    '"': r'\"',
+    '\\': r'\\',
+})
+
+
+@cache
+def escape_measurement(measurement: str) -> str:
+    return measurement.translate(_ESCAPE_MEASUREMENT)
+
+
+@cache
+def escape_key(key: str) -> str:
+    """Escape a tag or field name."""
+    return key.translate(_ESCAPE_KEY)
+
+
+# Tag values, e.g. flow identifiers, are not bounded as names are
+@lru_cache(maxsize=65536)
+def escape_tag_value(value: str) -> str:
+    escaped = value.translate(_ESCAPE_KEY)
+    if escaped.endswith('\\'):
+        escaped += ' '
+    return escaped
+
+
+def format_field_value(value: Any) -> Optional[str]:
+    """Return the field value as in line protocol, or `None` if the field should be skipped."""
+    value_type = type(value)
+    if value_type is float:
+        if not math.isfinite(value):
+            return None
+        formatted = str(value)
+        # Whole numbers are written without the trailing `.0`
+        return formatted[:-2] if formatted.endswith('.0') else formatted
+    elif value_type is int:
+        return '{}i'.format(value)
+    elif value_type is str:
+        if '"' in value or '\\' in value:
+            value = value.translate(_ESCAPE_STRING)
+        return '"{}"'.format(value)
+    elif value is None:
+        return None
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    # Subclasses, e.g. of `int`, are rare enough to go through the generic path
+    elif isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        formatted = str(value)
+        return formatted[:-2] if formatted.endswith('.0') else formatted
+    elif isinstance(value, int):
+        return '{}i'.format(str(value))
+    elif isinstance(value, str):
+        return '"{}"'.format(str(value).translate(_ESCAPE_STRING))
+    raise ValueError('Type: "{}" of field value {} is not supported'.format(
+        value_type, value))
+
+
+def format_tags(tags: Optional[dict[str, Any]]) -> str:
+    """Return tags as in line protocol, including the leading comma and the trailing space."""
+    if not tags:
+        return ' '
+    formatted = []
+    for key in sorted(tags):
+        value = tags[key]
+        if value is None:
+            continue
+        escaped_key = escape_key(key)
+        # Convert first, as cache keys such as `1` and `True` compare equal
+        escaped_value = escape_tag_value(str(value))
+        if escaped_key and escaped_value:
+            formatted.append('{}={}'.format(escaped_key, escaped_value))
+    if not formatted:
+        return ' '
+    return ',{} '.format(','.join(formatted))
+
+
+def format_line(measurement: str,
+                fields: dict[str, Any],
+                timestamp: Optional[int] = None,
+                tags: Optional[dict[str, Any]] = None) -> Optional[str]:
+    """Return a line of specified point, or `None` if it has no field to write."""
+    formatted_fields = []
+    for key in sorted(fields):
+        value = format_field_value(fields[key])
+        if value is not None:
+            formatted_fields.append('{}={}'.format(escape_key(key), value))
+    return _join_line(escape_measurement(measurement), format_tags(tags),
+                      formatted_fields, timestamp)
+
+
+class LineFormat:
+    """A measurement with a fixed set of fields, whose names are escaped and sorted once rather than on each line."""
+
+    def __init__(self, measurement: str, field_names: Iterable[str]) -> None:
+        self._measurement = escape_measurement(measurement)
+        self._fields = [(name, escape_key(name) + '=')
+                        for name in sorted(field_names)]
+
+    def format(self,
+               fields: dict[str, Any],
+               timestamp: Optional[int] = None,
+               tags: Optional[dict[str, Any]] = None) -> Optional[str]:
+        """Return a line of specified point, or `None` if it has no field to write. Fields not given are skipped."""
+        formatted_fields = []
+        for name, prefix in self._fields:
+            value = format_field_value(fields.get(name, None))
+            if value is not None:
+                formatted_fields.append(prefix + value)
+        return _join_line(self._measurement, format_tags(tags),
+                          formatted_fields, timestamp)
+
+
+def _join_line(measurement: str, tags: str, fields: list[str],
+               timestamp: Optional[int]) -> Optional[str]:
+    if not fields:
+        return None
+    line = measurement + tags + ','.join(fields)
+    if timestamp is not None:
+        line += ' {}'.format(int(timestamp))
+    return line
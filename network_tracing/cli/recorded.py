@@ -0,0 +1,135 @@
+"""Reading of recorded events, either segments written by `ntctl events -a record`, or JSON lines of events as streamed by the daemon.
+
+Segments require `pyarrow`, which is installed with the `record` extra; JSON lines do not.
+"""
+
+import json
+import os
+from itertools import islice
+from typing import Any, Iterable, Iterator
+
+from network_tracing.cli.decoding import decode_events
+from network_tracing.common.models import TracingEvent
+
+SEGMENT_EXTENSIONS = ('.parquet', '.arrow')
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson', '.json')
+
+TIME_COLUMN = 'time'
+"""Column of event timestamps in segments, as written by `Recorder`."""
+
+
+def find_files(paths: Iterable[str]) -> list[str]:
+    """Return recorded files at specified paths in order, looking into directories recursively. Segments still being written are skipped."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            for name in sorted(names):
+                if name.endswith(SEGMENT_EXTENSIONS + JSON_LINES_EXTENSIONS):
+                    files.append(os.path.join(directory, name))
+    return files
+
+
+def import_pyarrow(path: str) -> Any:
+    """Import `pyarrow` to read a segment at specified path, or raise a `RuntimeError` telling how to install it."""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError(
+            'Reading {} requires pyarrow; install it with '
+            '`pip install network-tracing[record]`'.format(path)) from e
+    return pyarrow
+
+
+def iter_record_batches(reader: Any, chunk_size: int) -> Iterator[Any]:
+    """Yield record batches of an Arrow IPC file in slices of at most `chunk_size` rows."""
+    for index in range(reader.num_record_batches):
+        batch = reader.get_batch(index)
+        for offset in range(0, batch.num_rows, chunk_size):
+            yield batch.slice(offset, chunk_size)
+
+
+def iter_events(path: str,
+                chunk_size: int,
+                skip: int = 0) -> Iterator[tuple[int, list[TracingEvent]]]:
+    """Read events of a recorded file in chunks of at most `chunk_size` rows, after skipping the first `skip` ones. Yield events of each chunk with the number of rows read so far, including skipped and malformed ones.
+
+    A row is a line of JSON lines, or a row of a segment, so that positions in a file stay the same however it is read.
+    """
+    if path.endswith(SEGMENT_EXTENSIONS):
+        yield from _iter_segment_events(path, chunk_size, skip)
+    else:
+        yield from _iter_json_lines_events(path, chunk_size, skip)
+
+
+def _iter_json_lines_events(
+        path: str, chunk_size: int,
+        skip: int) -> Iterator[tuple[int, list[TracingEvent]]]:
+    with open(path, 'rb') as fp:
+        rows = sum(1 for _ in islice(fp, skip))
+        yield rows, []
+        while lines := list(islice(fp, chunk_size)):
+            rows += len(lines)
+            events, _ = decode_events(b''.join(lines).rstrip(b'\r\n'))
+            yield rows, events
+
+
+def _iter_segment_events(
+        path: str, chunk_size: int,
+        skip: int) -> Iterator[tuple[int, list[TracingEvent]]]:
+    pyarrow = import_pyarrow(path)
+    # Segments are written to a directory per probe
+    probe = os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+    if path.endswith('.parquet'):
+        batches = pyarrow.parquet.ParquetFile(path).iter_batches(
+            batch_size=chunk_size)
+    else:
+        batches = iter_record_batches(pyarrow.ipc.open_file(path), chunk_size)
+
+    rows = 0
+    yield rows, []
+    for batch in batches:
+        if rows + batch.num_rows <= skip:
+            rows += batch.num_rows
+            continue
+        if rows < skip:
+            batch = batch.slice(skip - rows)
+            rows = skip
+        rows += batch.num_rows
+
+        index = batch.schema.get_field_index(TIME_COLUMN)
+        timestamps = batch.column(index).cast(pyarrow.int64()).to_pylist()
+        batch = batch.remove_column(index)
+        events = [
+            TracingEvent(timestamp=timestamp,
+                         probe=probe,
+                         event=unflatten_event(row))
+            for timestamp, row in zip(timestamps, batch.to_pylist())
+        ]
+        yield rows, events
+
+
+def unflatten_event(row: dict[str, Any]) -> dict[str, Any]:
+    """Undo `flatten_event()` of `recording` for a row of a segment. Fields missing from the event, which are null in the row, are left out."""
+    event: dict[str, Any] = {}
+    for name, value in row.items():
+        if value is None:
+            continue
+        # Lists and objects of `JSON_FIELDS` are recorded as JSON, and no other string field of events looks like one
+        if type(value) is str and value.startswith(('[', '{')):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        target = event
+        *parents, key = name.split('.')
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[key] = value
+    return event
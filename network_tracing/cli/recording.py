@@ -0,0 +1,296 @@
+"""Recording of events into columnar files, one series of segments per probe.
+
+Requires `pyarrow`, which is installed with the `record` extra, e.g. `pip install network-tracing[record]`.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Optional
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('parquet', 'arrow')
+DEFAULT_FORMAT = 'parquet'
+DEFAULT_COMPRESSION = 'zstd'
+DEFAULT_BATCH_SIZE = 65536
+DEFAULT_ROTATE_SIZE = 256 * 1024 * 1024
+DEFAULT_ROTATE_INTERVAL = 3600.0
+ROTATE_CHECK_INTERVAL = 10.0
+"""Maximum seconds between checks for segments due to be rotated by time, so that those of probes with no new events are closed too."""
+
+TIME_COLUMN = 'time'
+"""Column of event timestamps, in addition to fields of events."""
+
+PARTIAL_SUFFIX = '.partial'
+"""Suffix of segments being written, removed once they are complete and readable."""
+
+JSON_FIELDS = frozenset(('functions', ))
+"""Fields of objects keyed by arbitrary names, which are kept as JSON rather than flattened, as names such as kernel symbols like `tcp_sendmsg_locked.isra.0` may contain `.`."""
+
+_FILE_EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+
+def flatten_event(event: dict[str, Any],
+                  row: dict[str, Any],
+                  prefix: str = '') -> dict[str, Any]:
+    """Add fields of an event to a row, with fields of nested objects joined by `.`, e.g. `parsed.saddr`, and lists and objects of `JSON_FIELDS` as JSON."""
+    for key, value in event.items():
+        # Events are decoded from JSON, so exact types suffice
+        value_type = type(value)
+        if value_type is dict and key not in JSON_FIELDS:
+            flatten_event(value, row, prefix + key + '.')
+        elif value_type is list or value_type is dict:
+            row[prefix + key] = json.dumps(value)
+        else:
+            row[prefix + key] = value
+    return row
+
+
+class _Segment:
+
+    def __init__(self, path: str, format: str, schema: pa.Schema,
+                 compression: str) -> None:
+        self.path = path
+        self.schema = schema
+        self.opened_at = monotonic()
+        self._sink = pa.OSFile(path + PARTIAL_SUFFIX, 'wb')
+        if format == 'parquet':
+            self._writer: Any = pyarrow.parquet.ParquetWriter(
+                self._sink, schema, compression=compression)
+        else:
+            self._writer = pyarrow.ipc.new_file(
+                self._sink,
+                schema,
+                options=pyarrow.ipc.IpcWriteOptions(compression=compression))
+
+    @property
+    def size(self) -> int:
+        return self._sink.tell()
+
+    def write(self, table: pa.Table) -> None:
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        self._writer.close()
+        self._sink.close()
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+
+
+class _ProbeRecorder:
+
+    def __init__(self, recorder: 'Recorder', probe: str) -> None:
+        self._recorder = recorder
+        self._probe = probe
+        # Buffer values by column, as building tables from columns is much cheaper than from rows
+        self._columns: dict[str, list[Any]] = {}
+        self._count = 0
+        self._batch_started_at = 0.0
+        self._segment: Optional[_Segment] = None
+        self._sequence = 0
+
+    def add(self, timestamp: int, event: Any) -> None:
+        row = {TIME_COLUMN: timestamp}
+        if isinstance(event, dict):
+            flatten_event(event, row)
+        else:
+            row['event'] = event
+
+        columns = self._columns
+        if row.keys() == columns.keys():
+            for name, value in row.items():
+                columns[name].append(value)
+        else:
+            self._add_with_new_fields(row)
+        if not self._count:
+            self._batch_started_at = monotonic()
+        self._count += 1
+
+        if self._count >= self._recorder.batch_size:
+            self.flush()
+        elif self._segment is not None and monotonic(
+        ) - self._segment.opened_at >= self._recorder.rotate_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._count:
+            columns, self._columns = self._columns, {}
+            self._count = 0
+            table = self._build_table(columns)
+            self._get_segment(table.schema).write(table)
+
+        segment = self._segment
+        if segment is not None and (segment.size >= self._recorder.rotate_size
+                                    or monotonic() - segment.opened_at
+                                    >= self._recorder.rotate_interval):
+            self._close_segment()
+
+    def rotate_if_due(self) -> None:
+        """Write buffered events and close the segment if either has been open for `rotate_interval`."""
+        now = monotonic()
+        rotate_interval = self._recorder.rotate_interval
+        if (self._segment is not None
+                and now - self._segment.opened_at >= rotate_interval) or (
+                    self._count
+                    and now - self._batch_started_at >= rotate_interval):
+            self.close()
+
+    def close(self) -> None:
+        self.flush()
+        self._close_segment()
+
+    def _add_with_new_fields(self, row: dict[str, Any]) -> None:
+        columns = self._columns
+        for name, value in row.items():
+            column = columns.get(name, None)
+            if column is None:
+                # Earlier events in the batch do not have this field
+                column = [None] * self._count
+                columns[name] = column
+            column.append(value)
+        for name, column in columns.items():
+            if name not in row:
+                column.append(None)
+
+    def _build_table(self, columns: dict[str, list[Any]]) -> pa.Table:
+        # Keep the schema of the current segment if columns fit in it, so that fields missing from some events do not start a new segment
+        if self._segment is not None:
+            schema = self._segment.schema
+            names = set(schema.names)
+            if names.issuperset(columns):
+                try:
+                    return pa.Table.from_pydict(
+                        {
+                            name:
+                            columns.get(name, None)
+                            or [None] * len(columns[TIME_COLUMN])
+                            for name in schema.names
+                        },
+                        schema=schema)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError,
+                        OverflowError):
+                    pass
+
+        table = pa.Table.from_pydict(columns)
+        time_type = pa.timestamp('ns', tz='UTC')
+        index = table.schema.get_field_index(TIME_COLUMN)
+        return table.set_column(
+            index, pa.field(TIME_COLUMN, time_type, nullable=False),
+            table.column(index).cast(time_type))
+
+    def _get_segment(self, schema: pa.Schema) -> _Segment:
+        if self._segment is not None and not self._segment.schema.equals(
+                schema):
+            logger.debug('Fields of %s events changed; starting a new segment',
+                         self._probe)
+            self._close_segment()
+
+        if self._segment is None:
+            directory = os.path.join(self._recorder.path, self._probe)
+            os.makedirs(directory, exist_ok=True)
+            # Process ID keeps names unique when several processes record the same task
+            name = '{}-{}-{}-{:04d}{}'.format(
+                self._probe,
+                datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid(),
+                self._sequence, _FILE_EXTENSIONS[self._recorder.format])
+            self._sequence += 1
+            self._segment = _Segment(os.path.join(directory,
+                                                  name), self._recorder.format,
+                                     schema, self._recorder.compression)
+        return self._segment
+
+    def _close_segment(self) -> None:
+        if self._segment is None:
+            return
+        segment, self._segment = self._segment, None
+        try:
+            segment.close()
+        except Exception as e:
+            logger.warn('Encountered an error while closing segment %s',
+                        segment.path,
+                        exc_info=e)
+        else:
+            logger.info('Recorded segment %s (%d byte(s))', segment.path,
+                        os.path.getsize(segment.path))
+
+
+class Recorder:
+    """Buffer events of each probe into columnar batches, and write them to segments rotated by size or time.
+
+    Segments are written to `<path>/<probe>/` with the suffix `.partial` until they are complete, so that only complete ones are picked up by analysis tools. Segments due to be rotated by time are also closed by a background thread, as probes may stop sending events.
+    """
+
+    def __init__(self,
+                 path: str,
+                 format: str = DEFAULT_FORMAT,
+                 compression: str = DEFAULT_COMPRESSION,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 rotate_size: int = DEFAULT_ROTATE_SIZE,
+                 rotate_interval: float = DEFAULT_ROTATE_INTERVAL) -> None:
+        if format not in FORMATS:
+            raise ValueError('Invalid format {}'.format(format))
+        if batch_size <= 0:
+            raise ValueError('Invalid batch size {}'.format(batch_size))
+        if rotate_size <= 0:
+            raise ValueError('Invalid rotate size {}'.format(rotate_size))
+        if rotate_interval <= 0:
+            raise ValueError(
+                'Invalid rotate interval {}'.format(rotate_interval))
+
+        self.path = path
+        self.format = format
+        self.compression = compression
+        self.batch_size = batch_size
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self._probes: dict[str, _ProbeRecorder] = {}
+        self._lock = Lock()
+        self._stopped = Event()
+        self._rotator = Thread(target=self._rotate_periodically,
+                               name='recorder-rotator',
+                               daemon=True)
+        self._rotator.start()
+
+    def add(self, probe: str, timestamp: int, event: Any) -> None:
+        with self._lock:
+            probe_recorder = self._probes.get(probe, None)
+            if probe_recorder is None:
+                probe_recorder = _ProbeRecorder(self, probe)
+                self._probes[probe] = probe_recorder
+            probe_recorder.add(timestamp, event)
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._rotator.join()
+        with self._lock:
+            for probe_recorder in self._probes.values():
+                try:
+                    probe_recorder.close()
+                except Exception as e:
+                    logger.warn(
+                        'Encountered an error while recording %s events',
+                        probe_recorder._probe,
+                        exc_info=e)
+
+    def _rotate_periodically(self) -> None:
+        while not self._stopped.wait(
+                min(self.rotate_interval, ROTATE_CHECK_INTERVAL)):
+            with self._lock:
+                for probe_recorder in self._probes.values():
+                    try:
+                        probe_recorder.rotate_if_due()
+                    except Exception as e:
+                        logger.warn(
+                            'Encountered an error while recording %s events',
+                            probe_recorder._probe,
+                            exc_info=e)
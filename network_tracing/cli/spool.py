@@ -0,0 +1,291 @@
+import logging
+import os
+import struct
+import zlib
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+SEGMENT_SUFFIX = '.seg'
+OFFSET_FILE_NAME = 'offset'
+
+_HEADER = struct.Struct('<II')
+"""Length and CRC-32 of the payload, preceding each record."""
+
+
+@dataclass
+class SpoolStats:
+    records: int = field(default=0)
+    """Number of records appended but not read yet."""
+
+    bytes: int = field(default=0)
+    """Size of records appended but not read yet, including headers."""
+
+    disk_bytes: int = field(default=0)
+    """Total size of segment files, including records read but not deleted yet."""
+
+    dropped: int = field(default=0)
+    """Number of records refused because the spool is full."""
+
+
+class Spool:
+    """An append-only log of records on disk, split into segments, which are read back in order.
+
+    Records are framed by their length and checksum, so that a torn write at the end of the log is detected and truncated on the next open. The read position is saved by `commit()` to a separate file, replaced atomically, and segments before it are deleted, along with the segment it is at the end of; records read but not committed before a crash are read again. Records are not synced to disk on append, so those written shortly before a power loss may be lost.
+
+    Safe to use from one appending thread and one reading thread at the same time.
+    """
+
+    def __init__(self,
+                 path: str,
+                 max_size: int = DEFAULT_MAX_SIZE,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE) -> None:
+        if max_size <= 0:
+            raise ValueError('Invalid maximum size {}'.format(max_size))
+        if segment_size <= 0 or segment_size > max_size:
+            raise ValueError('Invalid segment size {}'.format(segment_size))
+
+        self._path = path
+        self._max_size = max_size
+        self._segment_size = segment_size
+        self._lock = Lock()
+        self._stats = SpoolStats()
+
+        # Segment indices in order, and size of each as appended
+        self._segments: list[int] = []
+        self._segment_sizes: dict[int, int] = {}
+        self._writer: Optional[BinaryIO] = None
+        self._writer_dirty = False
+        self._reader: Optional[BinaryIO] = None
+        self._read_segment = 0
+        self._read_position = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._recover()
+
+    @property
+    def empty(self) -> bool:
+        """Whether all appended records have been read."""
+        return self._stats.records == 0
+
+    @property
+    def stats(self) -> SpoolStats:
+        return self._stats
+
+    @property
+    def position(self) -> tuple[int, int]:
+        """Position after records returned by `read()` so far, which may be passed to `commit()` once they are handled."""
+        with self._lock:
+            return self._read_segment, self._read_position
+
+    def append(self, record: bytes) -> bool:
+        """Append a record, or return `False` if the spool is full."""
+        size = _HEADER.size + len(record)
+        with self._lock:
+            if self._stats.disk_bytes + size > self._max_size:
+                self._stats.dropped += 1
+                return False
+
+            segment = self._segments[-1]
+            if self._segment_sizes[segment] > 0 \
+                    and self._segment_sizes[segment] + size > self._segment_size:
+                segment = self._open_writer(segment + 1)
+
+            writer: BinaryIO = self._writer  # type: ignore
+            writer.write(_HEADER.pack(len(record), zlib.crc32(record)))
+            writer.write(record)
+            self._writer_dirty = True
+            self._segment_sizes[segment] += size
+            self._stats.records += 1
+            self._stats.bytes += size
+            self._stats.disk_bytes += size
+            return True
+
+    def read(self, max_records: int) -> list[bytes]:
+        """Return up to `max_records` records following those returned previously."""
+        records: list[bytes] = []
+        with self._lock:
+            while len(records) < max_records and self._stats.records > 0:
+                if self._read_position >= self._segment_sizes.get(
+                        self._read_segment, 0):
+                    self._advance_reader()
+                    continue
+                if self._read_segment == self._segments[-1] \
+                        and self._writer_dirty:
+                    self._writer.flush()  # type: ignore
+                    self._writer_dirty = False
+
+                reader = self._get_reader()
+                length, checksum = _HEADER.unpack(reader.read(_HEADER.size))
+                record = reader.read(length)
+                if len(record) != length or zlib.crc32(record) != checksum:
+                    # Appended records are checked on opening, so this means the file was changed by someone else
+                    raise RuntimeError(
+                        'Corrupted record in segment {} at {}'.format(
+                            self._segment_path(self._read_segment),
+                            self._read_position))
+                records.append(record)
+                size = _HEADER.size + length
+                self._read_position += size
+                self._stats.records -= 1
+                self._stats.bytes -= size
+        return records
+
+    def commit(self, position: Optional[tuple[int, int]] = None) -> None:
+        """Save a position taken from `position`, or by default the position after records returned by `read()`, and delete segments before it."""
+        with self._lock:
+            if position is None:
+                position = self._read_segment, self._read_position
+            segment, offset = position
+            if offset > 0 and offset >= self._segment_sizes[segment]:
+                # Move past a fully handled segment so that it is deleted, even if it is the one being appended to
+                if segment == self._segments[-1]:
+                    self._open_writer(segment + 1)
+                if segment == self._read_segment:
+                    self._advance_reader()
+                segment, offset = self._segments[self._segments.index(segment)
+                                                 + 1], 0
+            self._write_offset(segment, offset)
+            while self._segments[0] < segment:
+                handled = self._segments.pop(0)
+                self._stats.disk_bytes -= self._segment_sizes.pop(handled)
+                try:
+                    os.remove(self._segment_path(handled))
+                except OSError as e:
+                    logger.warn('Cannot remove spool segment %s',
+                                self._segment_path(handled),
+                                exc_info=e)
+
+    def close(self) -> None:
+        """Close files without committing; records read since the last `commit()` are read again next time."""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def _recover(self) -> None:
+        segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self._path)
+            if name.endswith(SEGMENT_SUFFIX)
+            and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        offset = self._read_offset()
+        if offset is not None and offset[0] in segments:
+            self._read_segment, self._read_position = offset
+        elif segments:
+            self._read_segment, self._read_position = segments[0], 0
+        else:
+            self._read_segment, self._read_position = 0, 0
+
+        for segment in segments:
+            if segment < self._read_segment:
+                os.remove(self._segment_path(segment))
+                continue
+            self._segments.append(segment)
+            self._segment_sizes[segment] = self._scan_segment(
+                segment,
+                self._read_position if segment == self._read_segment else 0)
+            self._stats.disk_bytes += self._segment_sizes[segment]
+
+        if not self._segments:
+            self._segments.append(self._read_segment)
+            self._segment_sizes[self._read_segment] = 0
+        self._open_writer(self._segments[-1])
+
+        if self._stats.records:
+            logger.info(
+                'Found %d spooled record(s) (%d byte(s)) in %s to be replayed',
+                self._stats.records, self._stats.bytes, self._path)
+
+    def _scan_segment(self, segment: int, start: int) -> int:
+        """Count records from `start` and return the size of valid data, truncating anything after it."""
+        path = self._segment_path(segment)
+        position = 0
+        with open(path, 'r+b') as fp:
+            # Records before `start` are already read; only check they are there
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() < start:
+                logger.warn('Spool segment %s is shorter than its offset',
+                            path)
+                start = fp.tell()
+            fp.seek(start)
+            position = start
+            while True:
+                header = fp.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, checksum = _HEADER.unpack(header)
+                record = fp.read(length)
+                if len(record) != length or zlib.crc32(record) != checksum:
+                    break
+                position += _HEADER.size + length
+                self._stats.records += 1
+                self._stats.bytes += _HEADER.size + length
+
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() > position:
+                logger.warn(
+                    'Truncating %d byte(s) of incomplete or corrupted records from spool segment %s',
+                    fp.tell() - position, path)
+                fp.truncate(position)
+        return position
+
+    def _open_writer(self, segment: int) -> int:
+        if self._writer is not None:
+            self._writer.close()
+        if segment not in self._segment_sizes:
+            self._segments.append(segment)
+            self._segment_sizes[segment] = 0
+        self._writer = open(self._segment_path(segment), 'ab')
+        self._writer_dirty = False
+        return segment
+
+    def _get_reader(self) -> BinaryIO:
+        if self._reader is None:
+            self._reader = open(self._segment_path(self._read_segment), 'rb')
+            self._reader.seek(self._read_position)
+        return self._reader
+
+    def _advance_reader(self) -> None:
+        index = self._segments.index(self._read_segment)
+        if index + 1 >= len(self._segments):
+            raise RuntimeError('Spool has pending records beyond its end')
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._read_segment = self._segments[index + 1]
+        self._read_position = 0
+
+    def _read_offset(self) -> Optional[tuple[int, int]]:
+        try:
+            with open(os.path.join(self._path, OFFSET_FILE_NAME), 'r') as fp:
+                segment, position = map(int, fp.read().split())
+                return segment, position
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warn('Ignoring unreadable spool offset in %s',
+                        self._path,
+                        exc_info=e)
+            return None
+
+    def _write_offset(self, segment: int, position: int) -> None:
+        path = os.path.join(self._path, OFFSET_FILE_NAME)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as fp:
+            fp.write('{} {}\n'.format(segment, position))
+            fp.flush()
+            os.fsync(fp.fileno())
+        # Either the old or the new offset survives a crash, never a partial one
+        os.replace(temporary_path, path)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._path,
+                            '{:020d}{}'.format(segment, SEGMENT_SUFFIX))
@@ -0,0 +1,108 @@
+import json
+import logging
+import random
+from threading import Event
+from time import monotonic
+from typing import Any, Iterable, Iterator, Optional
+
+import requests
+
+from network_tracing.cli.api import ApiClient, ApiException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INITIAL_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+
+class EventStreamReader:
+    """Iterate events of a tracing task, reconnecting with jittered exponential backoff whenever the stream ends or fails.
+
+    On reconnecting, events already seen are skipped by passing the sequence number of the last one to the daemon, which drops buffered events up to it. Daemons without support for this replay their buffer, so some events may then be seen twice.
+
+    Failing to connect the first time, or the task being gone, is an error rather than a reason to reconnect.
+    """
+
+    def __init__(self,
+                 task_id: str,
+                 raw: bool = False,
+                 initial_backoff: float = DEFAULT_INITIAL_BACKOFF,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF) -> None:
+        self._task_id = task_id
+        self._raw = raw
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._stop_event = Event()
+        self._events: Optional[Iterable[Any]] = None
+        self._last_event: Any = None
+        self.reconnects = 0
+        self.downtime = 0.0
+        """Total seconds spent disconnected."""
+
+    def connect(self) -> None:
+        self._events = self._open()
+
+    def stop(self) -> None:
+        """Stop waiting to reconnect. Does not interrupt reading a connected stream."""
+        self._stop_event.set()
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._events is None:
+            self.connect()
+
+        backoff = self._initial_backoff
+        while True:
+            try:
+                for event in self._events:  # type: ignore
+                    self._last_event = event
+                    # Back off further if streams keep ending without events
+                    backoff = self._initial_backoff
+                    yield event
+                reason = 'stream ended'
+            except requests.RequestException as e:
+                reason = str(e)
+
+            disconnected_at = monotonic()
+            while True:
+                # Full jitter, so that many clients do not reconnect in lockstep after a daemon restart
+                delay = random.uniform(0, backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+                logger.warn(
+                    'Event stream of task %s interrupted (%s); reconnecting in %.1f s',
+                    self._task_id, reason, delay)
+                if self._stop_event.wait(delay):
+                    return
+
+                try:
+                    self._events = self._open()
+                    break
+                except ApiException as e:
+                    response = e.raw_response
+                    if response is not None and response.status_code == 404:
+                        raise
+                    reason = str(e.__cause__ or e)
+
+            downtime = monotonic() - disconnected_at
+            self.reconnects += 1
+            self.downtime += downtime
+            logger.info(
+                'Reconnected to event stream of task %s after %.1f s; %d reconnect(s) and %.1f s of downtime so far',
+                self._task_id, downtime, self.reconnects, self.downtime)
+
+    def _open(self) -> Iterable[Any]:
+        after = self._last_seq()
+        client = ApiClient.get_instance()
+        if self._raw:
+            return client.get_tracing_event_lines(self._task_id, after=after)
+        return client.get_tracing_events(self._task_id, after=after)
+
+    def _last_seq(self) -> Optional[int]:
+        if self._last_event is None:
+            return None
+        if not self._raw:
+            return self._last_event.seq
+        # Lines are decoded only here, once per reconnection
+        try:
+            return json.loads(self._last_event).get('seq', None)
+        except (ValueError, AttributeError):
+            return None
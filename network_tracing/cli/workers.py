@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+from signal import SIG_IGN, SIGINT, signal
+from time import monotonic, perf_counter_ns
+from typing import Any, Callable, Iterable, Protocol
+
+from network_tracing.cli.decoding import decode_events
+from network_tracing.common.models import TracingEvent
+
+logger = logging.getLogger(__name__)
+
+STATS_FIELDS = ('batches', 'events', 'decode_errors', 'decode_ns', 'handle_ns')
+"""Counters kept by each worker in shared memory, so that they can be read without asking workers."""
+
+
+class EventSink(Protocol):
+
+    def handle_event(self, event: TracingEvent) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+SinkFactory = Callable[[], Iterable[EventSink]]
+"""Build sinks in a worker process. Must be picklable if processes are not forked."""
+
+
+class WorkerPool:
+    """Decode events and pass them to sinks in worker processes, so that neither is bound by the GIL of the process reading events.
+
+    Batches of undecoded lines are sent to workers in turn through pipes as single byte strings, so that nothing is pickled per event. Events from different batches may be handled out of order.
+    """
+
+    def __init__(self, workers: int, sink_factory: SinkFactory) -> None:
+        if workers <= 0:
+            raise ValueError('Invalid number of workers {}'.format(workers))
+
+        context = multiprocessing.get_context()
+        self._connections: list[Connection] = []
+        self._processes: list[multiprocessing.process.BaseProcess] = []
+        self._counters: list[Any] = []
+        self._receivers: list[Connection] = []
+        for index in range(workers):
+            receiver, sender = context.Pipe(duplex=False)
+            counters = context.Array('Q', len(STATS_FIELDS), lock=False)
+            process = context.Process(target=_run_worker,
+                                      args=(receiver, counters, sink_factory),
+                                      name='worker-{}'.format(index),
+                                      daemon=True)
+            self._connections.append(sender)
+            self._processes.append(process)
+            self._counters.append(counters)
+            self._receivers.append(receiver)
+        self._next = 0
+        self._submitted = [0] * workers
+        self._started_at = monotonic()
+
+    def start(self) -> None:
+        for process in self._processes:
+            process.start()
+        # Receiving ends now belong to workers
+        for receiver in self._receivers:
+            receiver.close()
+        self._receivers.clear()
+        self._started_at = monotonic()
+
+    def submit(self, lines: list[bytes]) -> None:
+        """Send a batch of lines to the next worker, blocking while its pipe is full."""
+        if not lines:
+            return
+        connection = self._connections[self._next]
+        connection.send_bytes(b'\n'.join(lines))
+        self._submitted[self._next] += 1
+        self._next = (self._next + 1) % len(self._connections)
+
+    def mark(self) -> tuple[int, ...]:
+        """Return numbers of batches submitted to each worker so far, to tell by `handled()` when all of them are handled."""
+        return tuple(self._submitted)
+
+    def handled(self, mark: tuple[int, ...]) -> bool:
+        """Tell whether all batches submitted before a `mark()` have been handled by sinks of workers."""
+        batches_index = STATS_FIELDS.index('batches')
+        return all(counters[batches_index] >= submitted
+                   for counters, submitted in zip(self._counters, mark))
+
+    def stats(self) -> dict[str, int]:
+        """Sum counters over all workers."""
+        totals = dict.fromkeys(STATS_FIELDS, 0)
+        for counters in self._counters:
+            for index, name in enumerate(STATS_FIELDS):
+                totals[name] += counters[index]
+        return totals
+
+    def format_stats(self) -> str:
+        stats = self.stats()
+        elapsed = max(monotonic() - self._started_at, 1e-9)
+        workers = len(self._processes)
+        return '{} event(s) in {} batch(es) ({:.0f}/s), {} decode error(s); workers busy decoding {:.0%}, handling {:.0%}'.format(
+            stats['events'], stats['batches'], stats['events'] / elapsed,
+            stats['decode_errors'],
+            stats['decode_ns'] / 1e9 / elapsed / workers,
+            stats['handle_ns'] / 1e9 / elapsed / workers)
+
+    def close(self, timeout: float = 30) -> None:
+        """Let workers finish queued batches and close their sinks, then stop them."""
+        for connection in self._connections:
+            try:
+                # An empty message tells the worker to stop
+                connection.send_bytes(b'')
+                connection.close()
+            except OSError:
+                pass
+
+        deadline = monotonic() + timeout
+        for process in self._processes:
+            process.join(max(deadline - monotonic(), 0))
+            if process.is_alive():
+                logger.warn('Worker %s does not stop in time; terminating',
+                            process.name)
+                process.terminate()
+            elif process.exitcode:
+                logger.warn('Worker %s exited with code %d', process.name,
+                            process.exitcode)
+
+        logger.info('Workers finished: %s', self.format_stats())
+
+
+def _run_worker(connection: Connection, counters: Any,
+                sink_factory: SinkFactory) -> None:
+    # Interrupts go to the whole process group; stop only when told by the parent, so that sinks are flushed
+    signal(SIGINT, SIG_IGN)
+
+    sinks = list(sink_factory())
+    batches_index, events_index, errors_index, decode_index, handle_index = range(
+        len(STATS_FIELDS))
+    try:
+        while data := connection.recv_bytes():
+            start = perf_counter_ns()
+            events, dropped = decode_events(data)
+            counters[errors_index] += dropped
+            decoded = perf_counter_ns()
+
+            for event in events:
+                for sink in sinks:
+                    sink.handle_event(event)
+            handled = perf_counter_ns()
+
+            counters[batches_index] += 1
+            counters[events_index] += len(events)
+            counters[decode_index] += decoded - start
+            counters[handle_index] += handled - decoded
+    except EOFError:
+        pass
+    finally:
+        for sink in sinks:
+            sink.close()
@@ -1 +1,4 @@
 DEFAULT_API_SERVER_PORT = 10032
+
+SYNTHETIC_PROBE = 'synthetic'
+"""Type of the probe generating events shaped like those of other probes, which name the imitated probe in their `shape` field."""
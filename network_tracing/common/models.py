@@ -2,6 +2,7 @@ from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Any, Iterable, Optional
 
+from network_tracing.common.constants import SYNTHETIC_PROBE
 from network_tracing.common.utilities import DataclassConversionMixin
 
 
@@ -12,6 +13,15 @@ class TracingEvent(DataclassConversionMixin):
 
     probe: str
     event: Any
+    seq: Optional[int] = field(default=None)
+    """Position of the event among those of its tracing task, assigned by the daemon. Unlike timestamps, which come from different clocks of probes, it increases in the order events are streamed."""
+
+    @property
+    def shape(self) -> str:
+        """Probe whose events this event is shaped like: the `shape` named by events of the synthetic probe, or the probe of the event otherwise."""
+        if self.probe == SYNTHETIC_PROBE and isinstance(self.event, dict):
+            return self.event.get('shape', SYNTHETIC_PROBE)
+        return self.probe
 
     @property
     def time(self) -> datetime:
@@ -35,6 +45,12 @@ class TracingTaskOptions(DataclassConversionMixin):
             self.events = TracingTaskEventOptions.from_dict(self.events)
 
 
+@dataclass
+class UpdateTracingTaskRequest(DataclassConversionMixin):
+    probes: dict[str, Any] = field(default_factory=dict)
+    """Options to update, keyed by probe type. Only options given here are changed."""
+
+
 @dataclass
 class ErrorResponse(DataclassConversionMixin):
     message: Optional[str] = field(default=None)
@@ -44,6 +60,8 @@ class ErrorResponse(DataclassConversionMixin):
 class TracingTaskResponse(DataclassConversionMixin):
     id: str
     options: TracingTaskOptions
+    details: dict[str, Any] = field(default_factory=dict)
+    """Information determined by probes at runtime, keyed by probe type."""
 
     def __post_init__(self):
         if isinstance(self.options, dict):
@@ -69,4 +87,6 @@ GetTracingTaskResponse = TracingTaskResponse
 
 CreateTracingTaskResponse = IdResponse
 
+UpdateTracingTaskResponse = TracingTaskResponse
+
 GetTracingEventsResponse = Iterable[TracingEvent]
@@ -1,7 +1,8 @@
 import importlib.metadata
 import json
 from dataclasses import asdict, fields, is_dataclass
-from typing import Any, NoReturn
+from functools import cache
+from typing import Any, NoReturn, Optional
 
 
 class DataclassConversionMixin:
@@ -9,15 +10,13 @@ class DataclassConversionMixin:
 
     @classmethod
     def from_dict(cls, data: dict[str, Any]):
-        # This is to prevent the type checker deducing `cls` to `Type[DataclassInstance] | Type[Self@DataclassConversionMixin]`
-        _cls = cls
-        if is_dataclass(_cls):
-            field_names = set(map(lambda f: f.name, fields(_cls)))
-            filtered_data = {
+        field_names = _get_field_names(cls)
+        # Only build a filtered copy if there are unknown keys, which is rare
+        if field_names is not None and not data.keys() <= field_names:
+            data = {
                 key: value
                 for key, value in data.items() if key in field_names
             }
-            data = filtered_data
 
         return cls(**data)
 
@@ -47,6 +46,14 @@ class DataclassConversionMixin:
             return o
 
 
+@cache
+def _get_field_names(cls: type) -> Optional[frozenset[str]]:
+    """Return names of fields of a `@dataclass`-decorated class, or `None` for other classes."""
+    if not is_dataclass(cls):
+        return None
+    return frozenset(f.name for f in fields(cls))
+
+
 class Metadata:
 
     def __new__(cls: type['Metadata']) -> NoReturn:
@@ -1,19 +1,20 @@
+from queue import Empty
 from typing import Any, cast
 from uuid import uuid4
 
 from flask import Blueprint, request
 
-from network_tracing.common.models import (CreateTracingTaskRequest,
-                                           CreateTracingTaskResponse,
-                                           GetTracingTaskResponse,
-                                           ListTracingTasksResponse,
-                                           TracingTaskOptions,
-                                           TracingTaskResponse)
+from network_tracing.common.models import (
+    CreateTracingTaskRequest, CreateTracingTaskResponse,
+    GetTracingTaskResponse, ListTracingTasksResponse, TracingTaskOptions,
+    TracingTaskResponse, UpdateTracingTaskRequest, UpdateTracingTaskResponse)
 from network_tracing.daemon.api.exceptions import ApiException
 from network_tracing.daemon.tracing.task import TracingTask
 from network_tracing.daemon.utilities import global_state
 
 TRACING_TASK_PREFIX = 'tracing_tasks/'
+EVENTS_PER_CHUNK = 1024
+"""Maximum number of events sent in a chunk of the event stream."""
 
 tracing_tasks = Blueprint('tracing_tasks',
                           __name__,
@@ -65,7 +66,7 @@ def insert_tracing_task(task: TracingTask) -> str:
 @tracing_tasks.get('/')
 def list_tracing_tasks() -> ListTracingTasksResponse:
     return [
-        TracingTaskResponse(id=id, options=task.options)
+        TracingTaskResponse(id=id, options=task.options, details=task.details)
         for id, task in find_all_tracing_tasks().items()
     ]
 
@@ -74,19 +75,29 @@ def list_tracing_tasks() -> ListTracingTasksResponse:
 def get_tracing_task(id: str):
     _, task = find_tracing_task(id)
     # .to_dict() is added here only to make type checker happy
-    return GetTracingTaskResponse(id=id, options=task.options).to_dict()
+    return GetTracingTaskResponse(id=id,
+                                  options=task.options,
+                                  details=task.details).to_dict()
 
 
 @tracing_tasks.get('/<id>/events')
 def get_tracing_events(id: str):
     _, task = find_tracing_task(id)
-    event_poller = task.get_event_poller()
+    after = request.args.get('after', default=None, type=int)
+    event_poller = task.get_event_poller(after=after)
 
     def generate():
         with event_poller:
             while True:
-                event = event_poller.poll_event(block=True)
-                yield event.to_json() + '\n'
+                lines = [event_poller.poll_event(block=True).to_json()]
+                # Send events already queued in the same chunk, so that clients read them at once
+                try:
+                    while len(lines) < EVENTS_PER_CHUNK:
+                        lines.append(event_poller.poll_event().to_json())
+                except Empty:
+                    pass
+                lines.append('')
+                yield '\n'.join(lines)
 
     return generate(), {
         'Content-Type': 'application/json-lines+json; encoding=utf-8',
@@ -105,6 +116,21 @@ def create_tracing_task():
     return CreateTracingTaskResponse(id=id).to_dict()
 
 
+@tracing_tasks.patch('/<id>')
+def update_tracing_task(id: str):
+    _, task = find_tracing_task(id)
+    payload = UpdateTracingTaskRequest.from_dict(
+        cast(dict[str, Any], request.json))
+    try:
+        task.update(payload.probes)
+    except (ValueError, TypeError, NotImplementedError) as e:
+        raise ApiException(str(e), 400)
+
+    return UpdateTracingTaskResponse(id=id,
+                                     options=task.options,
+                                     details=task.details).to_dict()
+
+
 @tracing_tasks.delete('/<id>')
 def remove_tracing_task(id: str):
     task_key, task = find_tracing_task(id)
@@ -9,6 +9,7 @@ from network_tracing.common.utilities import DataclassConversionMixin
 from network_tracing.daemon.api.server import ApiServer, ApiServerConfig
 from network_tracing.daemon.constants import DEFAULT_LOGGING_CONFIG
 from network_tracing.daemon.models import BackgroundTask
+from network_tracing.daemon.tracing.poller import Poller, PollerConfig
 from network_tracing.daemon.utilities import global_state
 
 logger = logging.getLogger(__name__)
@@ -23,12 +24,15 @@ class LoggingConfig(DataclassConversionMixin):
 class ApplicationConfig(DataclassConversionMixin):
     api: ApiServerConfig = field(default_factory=ApiServerConfig)
     logging: LoggingConfig = field(default_factory=LoggingConfig)
+    poller: PollerConfig = field(default_factory=PollerConfig)
 
     def __post_init__(self):
         if isinstance(self.api, dict):
             self.api = ApiServerConfig.from_dict(self.api)
         if isinstance(self.logging, dict):
             self.logging = LoggingConfig.from_dict(self.logging)
+        if isinstance(self.poller, dict):
+            self.poller = PollerConfig.from_dict(self.poller)
 
     @classmethod
     def load_file(cls, path: Union[str, PathLike]) -> 'ApplicationConfig':
@@ -56,6 +60,9 @@ class Application:
     def __init__(self, config: ApplicationConfig) -> None:
         self._config = config
         self._configure_logging(self._config.logging)
+        # Poller is shared by all probes, so it outlives every other task
+        self._poller = Poller(self._config.poller)
+        global_state.poller = self._poller
         self._tasks: dict[str, BackgroundTask] = {}
         # API server should run on start
         self._tasks.update(
@@ -65,7 +72,12 @@ class Application:
     def tasks(self) -> dict[str, BackgroundTask]:
         return self._tasks
 
+    @property
+    def poller(self) -> Poller:
+        return self._poller
+
     def start(self) -> None:
+        self._poller.start()
         for key, task in self._tasks.items():
             logger.debug('Starting initial task \'%s\'', key)
             task.start()
@@ -75,6 +87,7 @@ class Application:
         for key, task in self._tasks.items():
             logger.debug('Stopping task \'%s\'', key)
             task.stop()
+        self._poller.stop()
         logger.debug('Stopped all tasks')
 
     @staticmethod
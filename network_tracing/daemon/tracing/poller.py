@@ -0,0 +1,251 @@
+"""A daemon-wide poll loop shared by all probes reading from BPF perf or ring buffers."""
+
+import ctypes as ct
+import logging
+import os
+import select
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import count
+from threading import Lock, RLock, Thread
+from time import monotonic
+from typing import Any, Callable, Iterable, Optional
+
+from network_tracing.common.utilities import DataclassConversionMixin
+from network_tracing.daemon.models import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 0
+
+
+@dataclass
+class PollerConfig(DataclassConversionMixin):
+    workers: int = field(default=DEFAULT_WORKERS)
+    """Number of threads dispatching ready file descriptors. If 0, dispatch on the polling thread itself."""
+
+    def __post_init__(self):
+        if self.workers < 0:
+            raise ValueError('Invalid number of workers {}'.format(
+                self.workers))
+
+
+class _Registration:
+
+    def __init__(self, fd: int, handler: Callable[[], Any]) -> None:
+        self.fd = fd
+        self.handler = handler
+        self.active = True
+        # Held while the handler runs, so that unregistering waits for an in-progress dispatch
+        self.lock = RLock()
+
+
+class _Timer:
+
+    def __init__(self, interval: float, callback: Callable[[], Any]) -> None:
+        self.interval = interval
+        self.callback = callback
+        self.deadline = monotonic() + interval
+
+
+class Poller(BackgroundTask):
+    """Waits on file descriptors of all registered probes with a single epoll set, and calls their handlers when ready.
+
+    Handlers are called on the polling thread, or on a small thread pool if `PollerConfig.workers` is positive. A handler is never called concurrently with itself, and is never called again once `unregister()` returns.
+    """
+
+    def __init__(self, config: Optional[PollerConfig] = None) -> None:
+        self._config = config if config is not None else PollerConfig()
+        self._epoll = select.epoll()
+        self._wakeup_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self._epoll.register(self._wakeup_fd, select.EPOLLIN)
+        self._registrations: dict[int, _Registration] = {}
+        self._timers: dict[int, _Timer] = {}
+        self._timer_ids = count()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[Thread] = None
+        self._lock = Lock()
+
+    @property
+    def config(self) -> PollerConfig:
+        return self._config
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            if self._config.workers > 0:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._config.workers,
+                    thread_name_prefix='poller')
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                return
+            thread, self._thread = self._thread, None
+            executor, self._executor = self._executor, None
+
+        # Polling thread takes the lock as well, so wait for it outside
+        self._wakeup()
+        thread.join()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def register(self, fd: int, handler: Callable[[], Any]) -> None:
+        """Call `handler` whenever `fd` becomes readable. The handler should consume whatever is readable without blocking."""
+        with self._lock:
+            if fd in self._registrations:
+                raise ValueError(
+                    'File descriptor {} is already registered'.format(fd))
+            self._registrations[fd] = _Registration(fd, handler)
+            self._epoll.register(fd, self._event_mask)
+
+    def unregister(self, fd: int) -> None:
+        """Stop watching `fd`. When this returns, its handler is not running and will not be called again."""
+        with self._lock:
+            registration = self._registrations.pop(fd, None)
+            if registration is None:
+                return
+            try:
+                self._epoll.unregister(fd)
+            except (OSError, ValueError):
+                pass
+
+        with registration.lock:
+            registration.active = False
+
+    def register_bpf(self, bpf: Any) -> list[int]:
+        """Register all perf buffers opened on a BCC `BPF` object, and return their file descriptors."""
+        from bcc.libbcc import lib
+
+        fds = []
+        for reader in bpf.perf_buffers.values():
+            fd = lib.perf_reader_fd(reader)
+            readers = (ct.c_void_p * 1)(reader)
+            # Polling a single reader with zero timeout just consumes what is already there
+            self.register(
+                fd,
+                lambda readers=readers: lib.perf_reader_poll(1, readers, 0))
+            fds.append(fd)
+        return fds
+
+    def register_ring_buffer(self, bpf: Any, name: str) -> int:
+        """Register a ring buffer opened on a BCC `BPF` object with `open_ring_buffer()`, and return its file descriptor."""
+        fd = bpf[name].map_fd
+        self.register(fd, bpf.ring_buffer_consume)
+        return fd
+
+    def unregister_all(self, fds: Iterable[int]) -> None:
+        for fd in fds:
+            self.unregister(fd)
+
+    def add_timer(self, interval: float, callback: Callable[[], Any]) -> int:
+        """Call `callback` on the polling thread every `interval` seconds, and return an ID for `remove_timer()`."""
+        if interval <= 0:
+            raise ValueError('Invalid timer interval {}'.format(interval))
+
+        with self._lock:
+            timer_id = next(self._timer_ids)
+            self._timers[timer_id] = _Timer(interval, callback)
+        self._wakeup()
+        return timer_id
+
+    def remove_timer(self, timer_id: int) -> None:
+        with self._lock:
+            self._timers.pop(timer_id, None)
+
+    @property
+    def _event_mask(self) -> int:
+        # With a pool, re-arm each descriptor only after its handler returns, so that it is never dispatched twice at once
+        if self._config.workers > 0:
+            return select.EPOLLIN | select.EPOLLONESHOT
+        return select.EPOLLIN
+
+    def _run(self) -> None:
+        while self._thread is not None:
+            try:
+                events = self._epoll.poll(self._next_timeout())
+            except InterruptedError:
+                continue
+
+            for fd, _ in events:
+                if fd == self._wakeup_fd:
+                    self._drain_wakeup()
+                    continue
+                registration = self._registrations.get(fd, None)
+                if registration is None:
+                    continue
+                executor = self._executor
+                if executor is not None:
+                    executor.submit(self._dispatch, registration)
+                else:
+                    self._dispatch(registration)
+
+            self._run_due_timers()
+
+    def _dispatch(self, registration: _Registration) -> None:
+        with registration.lock:
+            if not registration.active:
+                return
+            try:
+                registration.handler()
+            except Exception:
+                logger.error('Handler of file descriptor %d failed',
+                             registration.fd,
+                             exc_info=True)
+
+            if self._config.workers > 0:
+                try:
+                    self._epoll.modify(registration.fd, self._event_mask)
+                except (OSError, ValueError):
+                    # Unregistered meanwhile
+                    pass
+
+    def _next_timeout(self) -> float:
+        with self._lock:
+            if not self._timers:
+                return -1
+            deadline = min(timer.deadline for timer in self._timers.values())
+        return max(deadline - monotonic(), 0)
+
+    def _run_due_timers(self) -> None:
+        now = monotonic()
+        with self._lock:
+            due = [
+                timer for timer in self._timers.values()
+                if timer.deadline <= now
+            ]
+            for timer in due:
+                timer.deadline += timer.interval
+                # Skip missed ticks rather than firing them in a burst
+                if timer.deadline <= now:
+                    timer.deadline = now + timer.interval
+
+        for timer in due:
+            try:
+                timer.callback()
+            except Exception:
+                logger.error('Timer callback failed', exc_info=True)
+
+    def _wakeup(self) -> None:
+        os.eventfd_write(self._wakeup_fd, 1)
+
+    def _drain_wakeup(self) -> None:
+        try:
+            os.eventfd_read(self._wakeup_fd)
+        except BlockingIOError:
+            pass
+
+
+def get_poller() -> Poller:
+    """Return the poller shared by the whole daemon."""
+    # Imported here because `network_tracing.daemon.utilities` depends on this module
+    from network_tracing.daemon.utilities import global_state
+
+    if global_state.poller is None:
+        raise RuntimeError('Cannot get shared poller instance')
+    return global_state.poller
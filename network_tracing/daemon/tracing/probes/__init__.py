@@ -1,14 +1,32 @@
-from network_tracing.daemon.tracing.probes.models import ProbeFactory
+from importlib import import_module
+from typing import Any
+
+from network_tracing.daemon.tracing.probes.models import (EventCallback,
+                                                          ProbeFactory)
+
+
+def _lazy_factory(module_name: str) -> ProbeFactory:
+    """Import the module of a probe only when it is first built, so that probes not depending on BCC work without it."""
+
+    def factory(event_callback: EventCallback, options: Any):
+        module = import_module('{}.{}'.format(__name__, module_name))
+        return module.Probe(event_callback, options)
+
+    return factory
 
-from . import (delay_analysis_in, delay_analysis_in_v6, delay_analysis_out,
-               delay_analysis_out_v6, demo, retsnoop, runqslower)
 
 probe_factories: dict[str, ProbeFactory] = {
-    'demo': demo.Probe,
-    'delay_analysis_in': delay_analysis_in.Probe,
-    'delay_analysis_in_v6': delay_analysis_in_v6.Probe,
-    'delay_analysis_out': delay_analysis_out.Probe,
-    'delay_analysis_out_v6': delay_analysis_out_v6.Probe,
-    'retsnoop': retsnoop.Probe,
-    'runqslower': runqslower.Probe,
+    probe_type: _lazy_factory(probe_type)
+    for probe_type in (
+        'demo',
+        'delay_analysis_in',
+        'delay_analysis_in_dual',
+        'delay_analysis_in_v6',
+        'delay_analysis_out',
+        'delay_analysis_out_dual',
+        'delay_analysis_out_v6',
+        'retsnoop',
+        'runqslower',
+        'synthetic',
+    )
 }
@@ -0,0 +1,406 @@
+"""Common parts of `delay_analysis_*` probes."""
+
+import ctypes as ct
+import logging
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_ntop
+from threading import Lock
+from typing import Any, Optional, Union
+
+from bcc import BPF
+
+from network_tracing.common.utilities import DataclassConversionMixin
+from network_tracing.daemon.tracing.probes.models import (BaseProbe,
+                                                          EventCallback)
+from network_tracing.daemon.tracing.poller import get_poller
+from network_tracing.daemon.utilities import IPMatcher
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_FILTER_MAX_ENTRIES = 4096
+"""Maximum number of IP addresses or ranges in each of `include` and `exclude`."""
+
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff' * 2
+"""Prefix of IPv4-mapped IPv6 addresses, as which dual-stack probes store IPv4 addresses."""
+
+ATTACH_MODES = ('auto', 'fentry', 'kprobe')
+"""Ways to attach to kernel functions. `auto` prefers fentry and falls back to kprobes."""
+
+DEFAULT_MAP_SIZE = 10240
+DEFAULT_STATS_INTERVAL = 60.0
+DEFAULT_ADAPT_INTERVAL = 1.0
+
+MIN_SAMPLE_RATIO = 2**-20
+"""Lower bound of sampling ratio in adaptive sampling, so that the probe can still notice when traffic drops."""
+
+MAX_SAMPLE_RATIO_STEP = 4.0
+"""Maximum factor by which adaptive sampling changes the sampling ratio in one interval."""
+
+_AddressPrefixes = tuple[tuple[bytes, int], ...]
+
+
+@dataclass
+class ProbeOptions(DataclassConversionMixin):
+
+    sport: Optional[int] = field(default=None)
+    """If not `None`, trace this source port only. Equivalent to the original `--sport` option."""
+
+    dport: Optional[int] = field(default=None)
+    """If not `None`, trace this destination port only. Equivalent to the original `--dport` option."""
+
+    sample: Optional[int] = field(default=None)
+    """If not `None`, enable trace sampling. Equivalent to the original `--sample` option."""
+
+    target_rate: Optional[float] = field(default=None)
+    """If not `None`, enable adaptive sampling, adjusting the sampling ratio every `adapt_interval` seconds to emit about this many events per second."""
+
+    adapt_interval: float = field(default=DEFAULT_ADAPT_INTERVAL)
+    """Interval in seconds to adjust the sampling ratio in adaptive sampling."""
+
+    include: Union[None, str, list[str]] = field(default=None)
+    """If not `None` or empty, trace packets whose source or destination address matches any of given IP addresses or ranges (in CIDR notation) only."""
+
+    exclude: Union[None, str, list[str]] = field(default=None)
+    """If not `None` or empty, do not trace packets whose source or destination address matches any of given IP addresses or ranges (in CIDR notation)."""
+
+    map_size: int = field(default=DEFAULT_MAP_SIZE)
+    """Maximum number of in-flight packets to track. When full, least recently used entries are evicted."""
+
+    stats_interval: Optional[float] = field(default=DEFAULT_STATS_INTERVAL)
+    """Interval in seconds to report occupancy and evictions of in-flight packet maps. If `None`, never report."""
+
+    attach_mode: str = field(default='auto')
+    """One of `auto`, `fentry` and `kprobe`. fentry requires BTF and BPF trampolines, and has less overhead than kprobes."""
+
+    def __post_init__(self):
+        for port in (self.sport, self.dport):
+            if port is not None and not 0 <= port <= 65535:
+                raise ValueError('Invalid port {}'.format(port))
+        if self.sample is not None and not 0 <= self.sample <= 31:
+            raise ValueError('Invalid sample {}'.format(self.sample))
+        if self.target_rate is not None and self.target_rate <= 0:
+            raise ValueError('Invalid target rate {}'.format(self.target_rate))
+        if self.target_rate is not None and self.sample is not None:
+            raise ValueError(
+                'Options \'sample\' and \'target_rate\' are mutually exclusive'
+            )
+        if self.adapt_interval <= 0:
+            raise ValueError('Invalid adapt interval {}'.format(
+                self.adapt_interval))
+        if self.map_size <= 0:
+            raise ValueError('Invalid map size {}'.format(self.map_size))
+        if self.attach_mode not in ATTACH_MODES:
+            raise ValueError('Invalid attach mode {}'.format(self.attach_mode))
+
+
+class Probe(BaseProbe):
+    """Base class of `delay_analysis_*` probes.
+
+    Subclasses should set `_BPF_SOURCE_FILE`, `_IPV6` (or `_DUAL_STACK`) and `_INFLIGHT_MAP_NAMES`, and implement `_get_kprobe_names()` and `_convert_event()`.
+    """
+
+    _BPF_SOURCE_FILE: str
+    _IPV6: bool = False
+    _DUAL_STACK: bool = False
+    """Whether the BPF program handles both address families, with IPv4 addresses mapped into IPv6 ones."""
+    _INFLIGHT_MAP_NAMES: tuple[str, ...]
+    """Names of maps keyed by in-flight packets. The last one is where entries are counted as inserted or completed."""
+    _PERF_BUFFER_NAME = 'timestamp_events'
+    _MAP_STATS_NAME = 'map_stats'
+    _CONFIG_TABLE_NAME = 'config'
+    _INCLUDE_TABLE_NAME = 'include_addrs'
+    _EXCLUDE_TABLE_NAME = 'exclude_addrs'
+    _UPDATABLE_OPTIONS = frozenset(
+        ('sport', 'dport', 'sample', 'target_rate', 'include', 'exclude'))
+
+    def __init__(self, event_callback: EventCallback,
+                 options: Union[None, dict, ProbeOptions]) -> None:
+        super().__init__(event_callback)
+        self._options = self._convert_options(options)
+        self._bpf, self._use_fentry = self._build_bpf(self._options)
+        self._adaptive_ratio = 1.0
+        self._adaptive_events = 0
+        self._populate_address_filters(
+            self._compile_address_filters(self._options))
+        self._write_config(self._options)
+        self._bpf[self._PERF_BUFFER_NAME].open_perf_buffer(
+            self._perf_buffer_callback)
+        self._poller_fds: Optional[list[int]] = None
+        self._stats_timer: Optional[int] = None
+        self._adapt_timer: Optional[int] = None
+        self._lock = Lock()
+        self._last_evicted = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._poller_fds is not None:
+                return
+
+            for fn_name, event in type(self)._get_kprobe_names().items():
+                if self._use_fentry:
+                    self._bpf.attach_kfunc(fn_name=event)
+                else:
+                    self._bpf.attach_kprobe(fn_name=fn_name, event=event)
+
+            poller = get_poller()
+            self._poller_fds = poller.register_bpf(self._bpf)
+            if self._options.stats_interval is not None:
+                self._stats_timer = poller.add_timer(
+                    self._options.stats_interval, self._report_map_stats)
+            self._sync_adapt_timer()
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._poller_fds is None:
+                return
+
+            poller = get_poller()
+            poller.unregister_all(self._poller_fds)
+            self._poller_fds = None
+            if self._stats_timer is not None:
+                poller.remove_timer(self._stats_timer)
+                self._stats_timer = None
+            self._sync_adapt_timer()
+
+            for fn_name, event in type(self)._get_kprobe_names().items():
+                if self._use_fentry:
+                    self._bpf.detach_kfunc(fn_name=event)
+                else:
+                    self._bpf.detach_kprobe(fn_name=fn_name, event=event)
+
+            if self._options.stats_interval is not None:
+                self._report_map_stats()
+
+    def _perf_buffer_callback(self, cpu, data, size):
+        event_data = self._bpf[self._PERF_BUFFER_NAME].event(data)
+        event = self._convert_event(event_data)
+        # Use the config the packet was sampled with, as the ratio may have changed before the event is read
+        event.sample_ratio = self._sample_ratio_of(event_data.sample,
+                                                   event_data.sample_threshold)
+        self._adaptive_events += 1
+        self._submit_event(event)
+
+    def _convert_event(self, event_data: Any) -> Any:
+        raise NotImplementedError
+
+    @staticmethod
+    def _format_address(family: int, address: bytes) -> str:
+        """Format an address reported by a dual-stack probe."""
+        if family == AF_INET:
+            return inet_ntop(AF_INET, address[len(IPV4_MAPPED_PREFIX):])
+        return inet_ntop(AF_INET6, address)
+
+    def _report_map_stats(self) -> None:
+        stats = self._bpf[self._MAP_STATS_NAME]
+        inserted = stats.sum(0).value
+        completed = stats.sum(1).value
+        occupancy = {
+            name: len(self._bpf[name])
+            for name in self._INFLIGHT_MAP_NAMES
+        }
+        # LRU maps evict silently; whatever is neither completed nor still in the map has been evicted
+        evicted = max(
+            inserted - completed - occupancy[self._INFLIGHT_MAP_NAMES[-1]], 0)
+        logger.info(
+            'In-flight packet maps of %s: %s; inserted %d, completed %d, evicted %d (+%d)',
+            type(self).__module__.rsplit('.', maxsplit=1)[-1],
+            ', '.join('{} {}/{}'.format(name, size, self._options.map_size)
+                      for name, size in occupancy.items()), inserted,
+            completed, evicted, evicted - self._last_evicted)
+        self._last_evicted = evicted
+
+    def prepare_options(
+        self, options: dict[str, Any]
+    ) -> tuple[ProbeOptions, dict[str, _AddressPrefixes]]:
+        unsupported = options.keys() - self._UPDATABLE_OPTIONS
+        if unsupported:
+            raise ValueError('Cannot update option(s) {} at runtime'.format(
+                ', '.join(sorted(unsupported))))
+        new_options = replace(self._options, **options)
+        return new_options, self._compile_address_filters(new_options)
+
+    def apply_options(
+            self, prepared: tuple[ProbeOptions,
+                                  dict[str, _AddressPrefixes]]) -> None:
+        new_options, address_filters = prepared
+        with self._lock:
+            if new_options.target_rate != self._options.target_rate:
+                self._adaptive_ratio = 1.0
+            # Keep a filter enabled while repopulating its trie only if it is enabled both before and after, so that no packet meets an enabled filter with an empty trie
+            self._write_config(
+                replace(new_options,
+                        include=new_options.include
+                        if self._options.include else None,
+                        exclude=new_options.exclude
+                        if self._options.exclude else None))
+            self._populate_address_filters(address_filters)
+            self._write_config(new_options)
+            self._options = new_options
+            self._sync_adapt_timer()
+
+    @staticmethod
+    def _sample_ratio_of(sample: int, sample_threshold: int) -> float:
+        """Fraction of packets traced with the given fields of the BPF config, which `sample` and `target_rate` never set at the same time."""
+        if sample:
+            return 2**-sample
+        if sample_threshold:
+            return sample_threshold / 2**32
+        return 1.0
+
+    def _sync_adapt_timer(self) -> None:
+        """Run the adaptive sampling controller if and only if the probe is started with `target_rate` set."""
+        poller = get_poller()
+        wanted = self._poller_fds is not None \
+            and self._options.target_rate is not None
+        if wanted and self._adapt_timer is None:
+            self._adaptive_events = 0
+            self._adapt_timer = poller.add_timer(self._options.adapt_interval,
+                                                 self._adapt_sample_ratio)
+        elif not wanted and self._adapt_timer is not None:
+            poller.remove_timer(self._adapt_timer)
+            self._adapt_timer = None
+
+    def _adapt_sample_ratio(self) -> None:
+        with self._lock:
+            target_rate = self._options.target_rate
+            if target_rate is None:
+                return
+
+            rate = self._adaptive_events / self._options.adapt_interval
+            self._adaptive_events = 0
+            # Scale by how far off the rate was, but within a bound so that a single bursty interval cannot swing it too far
+            factor = target_rate / rate if rate > 0 else MAX_SAMPLE_RATIO_STEP
+            factor = min(max(factor, 1 / MAX_SAMPLE_RATIO_STEP),
+                         MAX_SAMPLE_RATIO_STEP)
+            ratio = min(max(self._adaptive_ratio * factor, MIN_SAMPLE_RATIO),
+                        1.0)
+            if ratio == self._adaptive_ratio:
+                return
+
+            logger.debug(
+                'Adjusting sampling ratio from %g to %g (%.1f events/s, target %.1f)',
+                self._adaptive_ratio, ratio, rate, target_rate)
+            self._adaptive_ratio = ratio
+            self._write_config(self._options)
+
+    def _write_config(self, options: ProbeOptions) -> None:
+        table = self._bpf[self._CONFIG_TABLE_NAME]
+        config = table.Leaf()
+        config.sport = options.sport or 0
+        config.dport = options.dport or 0
+        config.sample = options.sample or 0
+        # Trace packets whose hashed key is below ratio * 2^32; 0 disables adaptive sampling
+        config.sample_threshold = max(int(self._adaptive_ratio * 2**32), 1) \
+            if options.target_rate is not None and self._adaptive_ratio < 1 else 0
+        # An empty filter is no filter, rather than one matching no packet
+        config.include = bool(options.include)
+        config.exclude = bool(options.exclude)
+        table[0] = config
+
+    def _compile_address_filters(
+            self, options: ProbeOptions) -> dict[str, _AddressPrefixes]:
+        """Return prefixes to put into each address filter table, raising `ValueError` if options are invalid."""
+        address_filters: dict[str, _AddressPrefixes] = {}
+        for table_name, ips_or_cidrs in (
+            (self._INCLUDE_TABLE_NAME, options.include),
+            (self._EXCLUDE_TABLE_NAME, options.exclude),
+        ):
+            if not ips_or_cidrs:
+                ips_or_cidrs = []
+
+            ip4_prefixes, ip6_prefixes = IPMatcher.compile_prefixes(
+                ips_or_cidrs)
+            if self._DUAL_STACK:
+                prefixes = ip6_prefixes + tuple(
+                    (IPV4_MAPPED_PREFIX + network, 96 + prefix_length)
+                    for network, prefix_length in ip4_prefixes)
+                ignored_prefixes = ()
+            else:
+                prefixes, ignored_prefixes = (ip6_prefixes, ip4_prefixes) \
+                    if self._IPV6 else (ip4_prefixes, ip6_prefixes)
+            if ignored_prefixes:
+                logger.warn(
+                    'Ignoring %d IP address(es) or range(s) of another address family in \'%s\'',
+                    len(ignored_prefixes), table_name)
+            if len(prefixes) > ADDRESS_FILTER_MAX_ENTRIES:
+                raise ValueError(
+                    'Too many IP addresses or ranges in \'{}\' ({} > {})'.
+                    format(table_name, len(prefixes),
+                           ADDRESS_FILTER_MAX_ENTRIES))
+            address_filters[table_name] = prefixes
+        return address_filters
+
+    def _populate_address_filters(
+            self, address_filters: dict[str, _AddressPrefixes]) -> None:
+        address_length = 16 if self._IPV6 or self._DUAL_STACK else 4
+        for table_name, prefixes in address_filters.items():
+            # Insert new entries before removing stale ones, so that a packet never sees an empty trie while updating
+            table = self._bpf[table_name]
+            for network, prefix_length in prefixes:
+                key = table.Key()
+                key.prefixlen = prefix_length
+                key.addr = (ct.c_ubyte * address_length)(*network)
+                table[key] = table.Leaf(1)
+            for key in list(table.keys()):
+                if (bytes(key.addr), key.prefixlen) not in prefixes:
+                    del table[key]
+
+    @classmethod
+    def _build_bpf(cls, options: ProbeOptions) -> tuple[BPF, bool]:
+        """Compile the BPF program, and return it along with whether it uses fentry instead of kprobes."""
+        with open(Path(__file__).parent / cls._BPF_SOURCE_FILE,
+                  'r',
+                  encoding='utf-8') as fp:
+            bpf_text = fp.read()
+
+        bpf_text = bpf_text.replace('MAP_SIZE', str(options.map_size))
+        bpf_text = bpf_text.replace('ADDRESS_FILTER_MAX_ENTRIES',
+                                    str(ADDRESS_FILTER_MAX_ENTRIES))
+        # fentry programs are named after the function they attach to, which is only known at runtime
+        dev_queue_xmit_event = cls._get_kprobe_names().get(
+            b'on_dev_queue_xmit', None)
+        if dev_queue_xmit_event is not None:
+            bpf_text = bpf_text.replace('DEV_QUEUE_XMIT_EVENT',
+                                        dev_queue_xmit_event.decode())
+
+        if options.attach_mode == 'kprobe':
+            return BPF(text=bpf_text), False
+
+        if not BPF.support_kfunc():
+            if options.attach_mode == 'fentry':
+                raise RuntimeError('fentry is not supported by current kernel')
+            logger.debug('fentry is not supported; using kprobes instead')
+            return BPF(text=bpf_text), False
+
+        try:
+            bpf = BPF(text=bpf_text, cflags=['-DUSE_FENTRY'])
+        except Exception:
+            if options.attach_mode == 'fentry':
+                raise
+            logger.warn('Failed to load %s with fentry; using kprobes instead',
+                        cls._BPF_SOURCE_FILE,
+                        exc_info=True)
+            return BPF(text=bpf_text), False
+
+        # BCC attaches fentry programs as soon as they are loaded; leave that to start()
+        for event in set(cls._get_kprobe_names().values()):
+            bpf.detach_kfunc(fn_name=event)
+        return bpf, True
+
+    @staticmethod
+    def _convert_options(
+            options: Union[None, dict, ProbeOptions]) -> ProbeOptions:
+        if options is None:
+            return ProbeOptions()
+        elif isinstance(options, dict):
+            return ProbeOptions.from_dict(options)
+        elif isinstance(options, ProbeOptions):
+            return options
+        else:
+            raise RuntimeError(
+                'Unrecognized type of options {}'.format(options))
+
+    @staticmethod
+    def _get_kprobe_names() -> dict[bytes, bytes]:
+        raise NotImplementedError
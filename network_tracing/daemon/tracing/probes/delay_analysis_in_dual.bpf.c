@@ -0,0 +1,384 @@
+#include <uapi/linux/ptrace.h>
+#include <linux/tcp.h>
+#include <linux/ip.h>
+#include <linux/ipv6.h>
+#include <uapi/linux/tcp.h>
+#include <uapi/linux/ip.h>
+#include <uapi/linux/if_ether.h>
+#include <net/sock.h>
+#include <bcc/proto.h>
+#include <linux/skbuff.h>
+#include <linux/netdevice.h>
+#include <net/tcp.h>
+#include <net/ip.h>
+
+// IPv4 addresses are stored as IPv4-mapped IPv6 addresses (::ffff:a.b.c.d), so that both families share the same maps
+struct packet_tuple {
+    u8 saddr[16];
+    u8 daddr[16];
+    u16 sport;
+    u16 dport;
+    u32 seq;
+    u32 ack;
+};
+
+struct ktime_info {
+    u64 mac_time;
+    u64 ip_time;
+    u64 tcp_time;
+    u64 app_time;
+    // Sampling config in effect when the packet passed `packet_allowed()`, so that events report the ratio they were sampled at
+    u32 sample;
+    u32 sample_threshold;
+};
+
+struct data_t {
+    u64 ktime;
+    u64 total_time;
+    u64 mac_timestamp;
+    u64 mac_time;
+    u64 ip_time;
+    u64 tcp_time;
+    u8 saddr[16];
+    u8 daddr[16];
+    u16 family;
+    u16 sport;
+    u16 dport;
+    u32 seq;
+    u32 ack;
+    u32 sample;
+    u32 sample_threshold;
+};
+
+BPF_TABLE("lru_hash", struct packet_tuple, struct ktime_info, in_timestamps, MAP_SIZE);
+
+// Counters of in-flight map entries, reported periodically by user space
+#define STAT_INSERTED 0
+#define STAT_COMPLETED 1
+BPF_PERCPU_ARRAY(map_stats, u64, 2);
+
+BPF_PERF_OUTPUT(timestamp_events);
+
+// Filters updatable at runtime; see `ProbeOptions` for meanings of fields
+struct probe_config {
+    u16 sport;
+    u16 dport;
+    u32 sample;
+    u32 sample_threshold;
+    u8 include;
+    u8 exclude;
+};
+
+BPF_ARRAY(config, struct probe_config, 1);
+
+struct addr_lpm_key {
+    u32 prefixlen;
+    u8 addr[16];
+};
+
+BPF_LPM_TRIE(include_addrs, struct addr_lpm_key, u8, ADDRESS_FILTER_MAX_ENTRIES);
+BPF_LPM_TRIE(exclude_addrs, struct addr_lpm_key, u8, ADDRESS_FILTER_MAX_ENTRIES);
+
+// Kernel memory is read explicitly below, so that the same handlers work with both kprobes and fentry
+static inline struct tcphdr *skb_to_tcphdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 transport_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&transport_header, sizeof(transport_header), &skb->transport_header);
+    return (struct tcphdr *)(head + transport_header);
+}
+
+static inline struct iphdr *skb_to_iphdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 network_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&network_header, sizeof(network_header), &skb->network_header);
+    return (struct iphdr *)(head + network_header);
+}
+
+static inline struct ipv6hdr *skb_to_ipv6hdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 network_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&network_header, sizeof(network_header), &skb->network_header);
+    return (struct ipv6hdr *)(head + network_header);
+}
+
+static inline void set_mapped_addr(u8 *dest, u32 addr){
+    __builtin_memset(dest, 0, 10);
+    dest[10] = 0xff;
+    dest[11] = 0xff;
+    __builtin_memcpy(dest + 12, &addr, sizeof(addr));
+}
+
+// Check a packet against filters in `config`, reporting the sampling config it is checked against; only called at the first hook
+static inline int packet_allowed(u16 sport, u16 dport, u32 sampling_key, const void *saddr, const void *daddr, u32 *sample, u32 *sample_threshold){
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL){
+        return 1;
+    }
+    *sample = cfg->sample;
+    *sample_threshold = cfg->sample_threshold;
+
+    if (cfg->sport && sport != cfg->sport){
+        return 0;
+    }
+    if (cfg->dport && dport != cfg->dport){
+        return 0;
+    }
+    if (cfg->sample && (sampling_key << (32 - cfg->sample) >> (32 - cfg->sample)) != ((0x01 << cfg->sample) - 1)){
+        return 0;
+    }
+    // Adaptive sampling: trace packets whose hashed key falls below the threshold set by user space
+    if (cfg->sample_threshold && sampling_key * 2654435761u >= cfg->sample_threshold){
+        return 0;
+    }
+
+    if (!cfg->include && !cfg->exclude){
+        return 1;
+    }
+    struct addr_lpm_key skey = {.prefixlen = sizeof(skey.addr) * 8};
+    struct addr_lpm_key dkey = {.prefixlen = sizeof(dkey.addr) * 8};
+    __builtin_memcpy(skey.addr, saddr, sizeof(skey.addr));
+    __builtin_memcpy(dkey.addr, daddr, sizeof(dkey.addr));
+    if (cfg->exclude && (exclude_addrs.lookup(&skey) != NULL || exclude_addrs.lookup(&dkey) != NULL)){
+        return 0;
+    }
+    if (cfg->include && include_addrs.lookup(&skey) == NULL && include_addrs.lookup(&dkey) == NULL){
+        return 0;
+    }
+    return 1;
+}
+
+static void get_ports(struct packet_tuple *pkt_tuple, struct tcphdr *tcp){
+    u16 sport, dport;
+    u32 seq, ack;
+    bpf_probe_read_kernel(&sport, sizeof(sport), &tcp->source);
+    bpf_probe_read_kernel(&dport, sizeof(dport), &tcp->dest);
+    bpf_probe_read_kernel(&seq, sizeof(seq), &tcp->seq);
+    bpf_probe_read_kernel(&ack, sizeof(ack), &tcp->ack_seq);
+    pkt_tuple->sport = ntohs(sport);
+    pkt_tuple->dport = ntohs(dport);
+    pkt_tuple->seq = ntohl(seq);
+    pkt_tuple->ack = ntohl(ack);
+}
+
+static void get_pkt_tuple_v4(struct packet_tuple *pkt_tuple, struct iphdr *ip, struct tcphdr *tcp){
+    u32 saddr, daddr;
+    bpf_probe_read_kernel(&saddr, sizeof(saddr), &ip->saddr);
+    bpf_probe_read_kernel(&daddr, sizeof(daddr), &ip->daddr);
+    set_mapped_addr(pkt_tuple->saddr, saddr);
+    set_mapped_addr(pkt_tuple->daddr, daddr);
+    get_ports(pkt_tuple, tcp);
+}
+
+static void get_pkt_tuple_v6(struct packet_tuple *pkt_tuple, struct ipv6hdr *ip6h, struct tcphdr *tcp){
+    bpf_probe_read_kernel(pkt_tuple->saddr, sizeof(pkt_tuple->saddr), &ip6h->saddr.in6_u.u6_addr32);
+    bpf_probe_read_kernel(pkt_tuple->daddr, sizeof(pkt_tuple->daddr), &ip6h->daddr.in6_u.u6_addr32);
+    get_ports(pkt_tuple, tcp);
+}
+
+// Fill `pkt_tuple` from headers of `skb`, branching on its protocol; return 0 on success
+static inline int get_pkt_tuple(struct packet_tuple *pkt_tuple, struct sk_buff *skb){
+    u16 protocol;
+    bpf_probe_read_kernel(&protocol, sizeof(protocol), &skb->protocol);
+    if (protocol == htons(ETH_P_IP)){
+        get_pkt_tuple_v4(pkt_tuple, skb_to_iphdr(skb), skb_to_tcphdr(skb));
+    } else if (protocol == htons(ETH_P_IPV6)){
+        get_pkt_tuple_v6(pkt_tuple, skb_to_ipv6hdr(skb), skb_to_tcphdr(skb));
+    } else {
+        return -1;
+    }
+    return 0;
+}
+
+static inline int handle_eth_type_trans(void *ctx, struct sk_buff *skb){
+    unsigned char *skb_data;
+    u16 protocol;
+    bpf_probe_read_kernel(&skb_data, sizeof(skb_data), &skb->data);
+    bpf_probe_read_kernel(&protocol, sizeof(protocol), &((struct ethhdr *)skb_data)->h_proto);
+    struct packet_tuple pkt_tuple = {};
+
+    if (protocol == 8){ // Protocol is IP
+        struct iphdr *ip = (struct iphdr *)(skb_data + 14);
+        // TODO options in hdr
+        struct tcphdr *tcp = (struct tcphdr *)(skb_data + 34);
+        get_pkt_tuple_v4(&pkt_tuple, ip, tcp);
+    } else if (protocol == 0xDD86){ // Protocol is IPv6
+        struct ipv6hdr *ip6h = (struct ipv6hdr *)(skb_data + 14);
+        struct tcphdr *tcp = (struct tcphdr *)(skb_data + sizeof(struct ipv6hdr) + 14);
+        get_pkt_tuple_v6(&pkt_tuple, ip6h, tcp);
+    } else {
+        return 0;
+    }
+
+    u32 len;
+    bpf_probe_read_kernel(&len, sizeof(len), &skb->len);
+    u32 sample = 0, sample_threshold = 0;
+    if (!packet_allowed(pkt_tuple.sport, pkt_tuple.dport, pkt_tuple.seq + pkt_tuple.ack + len, pkt_tuple.saddr, pkt_tuple.daddr, &sample, &sample_threshold)){
+        return 0;
+    }
+
+    struct ktime_info *tinfo, zero={};
+    if ((tinfo = in_timestamps.lookup(&pkt_tuple)) == NULL){
+        if ((tinfo = in_timestamps.lookup_or_try_init(&pkt_tuple, &zero)) == NULL){
+            return 0;
+        }
+        map_stats.increment(STAT_INSERTED);
+    }
+    tinfo->mac_time = bpf_ktime_get_ns();
+    tinfo->sample = sample;
+    tinfo->sample_threshold = sample_threshold;
+
+    return 0;
+}
+
+// Network and transport layer receive functions are family-specific, so each of them still fires once per packet
+static inline int set_ip_time(struct packet_tuple *pkt_tuple){
+    struct ktime_info *tinfo;
+    if ((tinfo = in_timestamps.lookup(pkt_tuple)) == NULL){
+        return 0;
+    }
+    tinfo->ip_time = bpf_ktime_get_ns();
+    return 0;
+}
+
+static inline int set_tcp_time(struct packet_tuple *pkt_tuple){
+    struct ktime_info *tinfo;
+    if ((tinfo = in_timestamps.lookup(pkt_tuple)) == NULL){
+        return 0;
+    }
+    tinfo->tcp_time = bpf_ktime_get_ns();
+    return 0;
+}
+
+static inline int handle_ip_rcv_core(void *ctx, struct sk_buff *skb){
+    if (skb == NULL){
+        return 0;
+    }
+    struct packet_tuple pkt_tuple = {};
+    get_pkt_tuple_v4(&pkt_tuple, skb_to_iphdr(skb), skb_to_tcphdr(skb));
+    return set_ip_time(&pkt_tuple);
+}
+
+static inline int handle_ip6_rcv_core(void *ctx, struct sk_buff *skb){
+    if (skb == NULL){
+        return 0;
+    }
+    struct packet_tuple pkt_tuple = {};
+    get_pkt_tuple_v6(&pkt_tuple, skb_to_ipv6hdr(skb), skb_to_tcphdr(skb));
+    return set_ip_time(&pkt_tuple);
+}
+
+static inline int handle_tcp_v4_rcv(void *ctx, struct sk_buff *skb){
+    if (skb == NULL){
+        return 0;
+    }
+    struct packet_tuple pkt_tuple = {};
+    get_pkt_tuple_v4(&pkt_tuple, skb_to_iphdr(skb), skb_to_tcphdr(skb));
+    return set_tcp_time(&pkt_tuple);
+}
+
+static inline int handle_tcp_v6_rcv(void *ctx, struct sk_buff *skb){
+    if (skb == NULL){
+        return 0;
+    }
+    struct packet_tuple pkt_tuple = {};
+    get_pkt_tuple_v6(&pkt_tuple, skb_to_ipv6hdr(skb), skb_to_tcphdr(skb));
+    return set_tcp_time(&pkt_tuple);
+}
+
+static inline int handle_skb_copy_datagram_iter(void *ctx, struct sk_buff *skb){
+    if (skb == NULL)
+        return 0;
+    struct packet_tuple pkt_tuple = {};
+    if (get_pkt_tuple(&pkt_tuple, skb) != 0){
+        return 0;
+    }
+
+    struct ktime_info *tinfo;
+    if ((tinfo = in_timestamps.lookup(&pkt_tuple)) == NULL){
+        return 0;
+    }
+
+    u16 protocol;
+    bpf_probe_read_kernel(&protocol, sizeof(protocol), &skb->protocol);
+    tinfo->app_time = bpf_ktime_get_ns();
+    struct data_t data = {};
+    data.ktime = bpf_ktime_get_ns();
+    data.mac_timestamp = tinfo->mac_time;
+    data.total_time = tinfo->app_time - tinfo->mac_time;
+    data.mac_time = tinfo->ip_time - tinfo->mac_time;
+    data.ip_time = tinfo->tcp_time - tinfo->ip_time;
+    data.tcp_time = tinfo->app_time - tinfo->tcp_time;
+    data.sample = tinfo->sample;
+    data.sample_threshold = tinfo->sample_threshold;
+
+    __builtin_memcpy(data.saddr, pkt_tuple.saddr, sizeof(data.saddr));
+    __builtin_memcpy(data.daddr, pkt_tuple.daddr, sizeof(data.daddr));
+    data.family = protocol == htons(ETH_P_IP) ? AF_INET : AF_INET6;
+    data.sport = pkt_tuple.sport;
+    data.dport = pkt_tuple.dport;
+    data.seq = pkt_tuple.seq;
+    data.ack = pkt_tuple.ack;
+
+    in_timestamps.delete(&pkt_tuple);
+    map_stats.increment(STAT_COMPLETED);
+    timestamp_events.perf_submit(ctx, &data, sizeof(data));
+    return 0;
+}
+
+#ifdef USE_FENTRY
+
+KFUNC_PROBE(eth_type_trans, struct sk_buff *skb){
+    return handle_eth_type_trans(ctx, skb);
+}
+
+KFUNC_PROBE(ip_rcv_core, struct sk_buff *skb){
+    return handle_ip_rcv_core(ctx, skb);
+}
+
+KFUNC_PROBE(ip6_rcv_core, struct sk_buff *skb){
+    return handle_ip6_rcv_core(ctx, skb);
+}
+
+KFUNC_PROBE(tcp_v4_rcv, struct sk_buff *skb){
+    return handle_tcp_v4_rcv(ctx, skb);
+}
+
+KFUNC_PROBE(tcp_v6_rcv, struct sk_buff *skb){
+    return handle_tcp_v6_rcv(ctx, skb);
+}
+
+KFUNC_PROBE(skb_copy_datagram_iter, struct sk_buff *skb){
+    return handle_skb_copy_datagram_iter(ctx, skb);
+}
+
+#else
+
+int on_eth_type_trans(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_eth_type_trans(ctx, skb);
+}
+
+int on_ip_rcv_core(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_ip_rcv_core(ctx, skb);
+}
+
+int on_ip6_rcv_core(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_ip6_rcv_core(ctx, skb);
+}
+
+int on_tcp_v4_rcv(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_tcp_v4_rcv(ctx, skb);
+}
+
+int on_tcp_v6_rcv(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_tcp_v6_rcv(ctx, skb);
+}
+
+int on_skb_copy_datagram_iter(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_skb_copy_datagram_iter(ctx, skb);
+}
+
+#endif
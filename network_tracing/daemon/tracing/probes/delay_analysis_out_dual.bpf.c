@@ -0,0 +1,389 @@
+#include <uapi/linux/ptrace.h>
+#include <linux/tcp.h>
+#include <linux/ip.h>
+#include <linux/ipv6.h>
+#include <uapi/linux/tcp.h>
+#include <uapi/linux/ip.h>
+#include <uapi/linux/if_ether.h>
+#include <net/sock.h>
+#include <bcc/proto.h>
+#include <linux/skbuff.h>
+#include <linux/netdevice.h>
+#include <net/tcp.h>
+#include <net/ip.h>
+
+// IPv4 addresses are stored as IPv4-mapped IPv6 addresses (::ffff:a.b.c.d), so that both families share the same maps
+struct flow_tuple {
+    u8 saddr[16];
+    u8 daddr[16];
+    u16 sport;
+    u16 dport;
+};
+
+struct packet_tuple {
+    u8 daddr[16];
+    u16 dport;
+    u32 seq;
+    u32 ack;
+};
+
+struct ktime_info {
+    u64 qdisc_time;
+    u64 mac_time;
+    u64 ip_time;
+    u64 tcp_time;
+    // Sampling config in effect when the packet passed `packet_allowed()`, so that events report the ratio they were sampled at
+    u32 sample;
+    u32 sample_threshold;
+};
+
+struct data_t {
+    u64 ktime;
+    u64 total_time;
+    u64 qdisc_timestamp;
+    u64 qdisc_time;
+    u64 ip_time;
+    u64 tcp_time;
+    u8 saddr[16];
+    u8 daddr[16];
+    u16 family;
+    u16 sport;
+    u16 dport;
+    u32 seq;
+    u32 ack;
+    u32 sample;
+    u32 sample_threshold;
+};
+
+BPF_TABLE("lru_hash", struct packet_tuple, struct flow_tuple, flows, MAP_SIZE);
+BPF_TABLE("lru_hash", struct packet_tuple, struct ktime_info, out_timestamps, MAP_SIZE);
+
+// Counters of in-flight map entries, reported periodically by user space
+#define STAT_INSERTED 0
+#define STAT_COMPLETED 1
+BPF_PERCPU_ARRAY(map_stats, u64, 2);
+
+BPF_PERF_OUTPUT(timestamp_events);
+
+// Filters updatable at runtime; see `ProbeOptions` for meanings of fields
+struct probe_config {
+    u16 sport;
+    u16 dport;
+    u32 sample;
+    u32 sample_threshold;
+    u8 include;
+    u8 exclude;
+};
+
+BPF_ARRAY(config, struct probe_config, 1);
+
+struct addr_lpm_key {
+    u32 prefixlen;
+    u8 addr[16];
+};
+
+BPF_LPM_TRIE(include_addrs, struct addr_lpm_key, u8, ADDRESS_FILTER_MAX_ENTRIES);
+BPF_LPM_TRIE(exclude_addrs, struct addr_lpm_key, u8, ADDRESS_FILTER_MAX_ENTRIES);
+
+// Kernel memory is read explicitly below, so that the same handlers work with both kprobes and fentry
+static inline struct tcphdr *skb_to_tcphdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 transport_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&transport_header, sizeof(transport_header), &skb->transport_header);
+    return (struct tcphdr *)(head + transport_header);
+}
+
+static inline struct iphdr *skb_to_iphdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 network_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&network_header, sizeof(network_header), &skb->network_header);
+    return (struct iphdr *)(head + network_header);
+}
+
+static inline struct ipv6hdr *skb_to_ipv6hdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 network_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&network_header, sizeof(network_header), &skb->network_header);
+    return (struct ipv6hdr *)(head + network_header);
+}
+
+static inline void set_mapped_addr(u8 *dest, u32 addr){
+    __builtin_memset(dest, 0, 10);
+    dest[10] = 0xff;
+    dest[11] = 0xff;
+    __builtin_memcpy(dest + 12, &addr, sizeof(addr));
+}
+
+// Check a packet against filters in `config`, reporting the sampling config it is checked against; only called at the first hook
+static inline int packet_allowed(u16 sport, u16 dport, u32 sampling_key, const void *saddr, const void *daddr, u32 *sample, u32 *sample_threshold){
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL){
+        return 1;
+    }
+    *sample = cfg->sample;
+    *sample_threshold = cfg->sample_threshold;
+
+    if (cfg->sport && sport != cfg->sport){
+        return 0;
+    }
+    if (cfg->dport && dport != cfg->dport){
+        return 0;
+    }
+    if (cfg->sample && (sampling_key << (32 - cfg->sample) >> (32 - cfg->sample)) != ((0x01 << cfg->sample) - 1)){
+        return 0;
+    }
+    // Adaptive sampling: trace packets whose hashed key falls below the threshold set by user space
+    if (cfg->sample_threshold && sampling_key * 2654435761u >= cfg->sample_threshold){
+        return 0;
+    }
+
+    if (!cfg->include && !cfg->exclude){
+        return 1;
+    }
+    struct addr_lpm_key skey = {.prefixlen = sizeof(skey.addr) * 8};
+    struct addr_lpm_key dkey = {.prefixlen = sizeof(dkey.addr) * 8};
+    __builtin_memcpy(skey.addr, saddr, sizeof(skey.addr));
+    __builtin_memcpy(dkey.addr, daddr, sizeof(dkey.addr));
+    if (cfg->exclude && (exclude_addrs.lookup(&skey) != NULL || exclude_addrs.lookup(&dkey) != NULL)){
+        return 0;
+    }
+    if (cfg->include && include_addrs.lookup(&skey) == NULL && include_addrs.lookup(&dkey) == NULL){
+        return 0;
+    }
+    return 1;
+}
+
+// Fill `pkt_tuple` from headers of `skb`, branching on its protocol; return 0 on success
+static inline int get_pkt_tuple(struct packet_tuple *pkt_tuple, struct sk_buff *skb){
+    u16 protocol;
+    bpf_probe_read_kernel(&protocol, sizeof(protocol), &skb->protocol);
+    if (protocol == htons(ETH_P_IP)){
+        struct iphdr *ip = skb_to_iphdr(skb);
+        u32 daddr;
+        bpf_probe_read_kernel(&daddr, sizeof(daddr), &ip->daddr);
+        set_mapped_addr(pkt_tuple->daddr, daddr);
+    } else if (protocol == htons(ETH_P_IPV6)){
+        struct ipv6hdr *ip6h = skb_to_ipv6hdr(skb);
+        bpf_probe_read_kernel(pkt_tuple->daddr, sizeof(pkt_tuple->daddr), &ip6h->daddr.in6_u.u6_addr32);
+    } else {
+        return -1;
+    }
+
+    struct tcphdr *tcp = skb_to_tcphdr(skb);
+    u16 dport;
+    u32 seq, ack;
+    bpf_probe_read_kernel(&dport, sizeof(dport), &tcp->dest);
+    bpf_probe_read_kernel(&seq, sizeof(seq), &tcp->seq);
+    bpf_probe_read_kernel(&ack, sizeof(ack), &tcp->ack_seq);
+    pkt_tuple->dport = ntohs(dport);
+    pkt_tuple->seq = ntohl(seq);
+    pkt_tuple->ack = ntohl(ack);
+    return 0;
+}
+
+static inline int handle___tcp_transmit_skb(void *ctx, struct sock *sk, struct sk_buff *skb, u32 rcv_nxt){
+    u16 family;
+    bpf_probe_read_kernel(&family, sizeof(family), &sk->__sk_common.skc_family);
+    struct flow_tuple ftuple = {};
+    struct packet_tuple pkt_tuple = {};
+
+    if (family == AF_INET){
+        u32 saddr, daddr;
+        bpf_probe_read_kernel(&saddr, sizeof(saddr), &sk->__sk_common.skc_rcv_saddr);
+        bpf_probe_read_kernel(&daddr, sizeof(daddr), &sk->__sk_common.skc_daddr);
+        set_mapped_addr(ftuple.saddr, saddr);
+        set_mapped_addr(ftuple.daddr, daddr);
+    } else if (family == AF_INET6){
+        bpf_probe_read_kernel(ftuple.saddr, sizeof(ftuple.saddr), &sk->__sk_common.skc_v6_rcv_saddr.in6_u.u6_addr32);
+        bpf_probe_read_kernel(ftuple.daddr, sizeof(ftuple.daddr), &sk->__sk_common.skc_v6_daddr.in6_u.u6_addr32);
+    } else {
+        return 0;
+    }
+
+    struct tcp_skb_cb *tcb = TCP_SKB_CB(skb);
+    u16 dport;
+    u32 len;
+    bpf_probe_read_kernel(&dport, sizeof(dport), &sk->__sk_common.skc_dport);
+    bpf_probe_read_kernel(&ftuple.sport, sizeof(ftuple.sport), &sk->__sk_common.skc_num);
+    ftuple.dport = ntohs(dport);
+
+    __builtin_memcpy(pkt_tuple.daddr, ftuple.daddr, sizeof(pkt_tuple.daddr));
+    pkt_tuple.dport = ftuple.dport;
+    bpf_probe_read_kernel(&pkt_tuple.seq, sizeof(pkt_tuple.seq), &tcb->seq);
+    pkt_tuple.ack = rcv_nxt;
+    bpf_probe_read_kernel(&len, sizeof(len), &skb->len);
+
+    u32 sample = 0, sample_threshold = 0;
+    if (!packet_allowed(ftuple.sport, pkt_tuple.dport, pkt_tuple.seq + pkt_tuple.ack + len, ftuple.saddr, ftuple.daddr, &sample, &sample_threshold)){
+        return 0;
+    }
+
+    flows.lookup_or_try_init(&pkt_tuple, &ftuple);
+    struct ktime_info *tinfo, zero = {};
+    if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
+        if ((tinfo = out_timestamps.lookup_or_try_init(&pkt_tuple, &zero)) == NULL){
+            return 0;
+        }
+        map_stats.increment(STAT_INSERTED);
+    }
+    tinfo->tcp_time = bpf_ktime_get_ns();
+    tinfo->sample = sample;
+    tinfo->sample_threshold = sample_threshold;
+
+    return 0;
+}
+
+// ip_queue_xmit() and inet6_csk_xmit() are family-specific, so each of them still fires once per packet
+static inline int on_network_xmit(struct packet_tuple *pkt_tuple, struct sock *sk, struct sk_buff *skb){
+    struct tcphdr *tcp = skb_to_tcphdr(skb);
+    u16 dport;
+    u32 seq, ack;
+    bpf_probe_read_kernel(&dport, sizeof(dport), &sk->__sk_common.skc_dport);
+    bpf_probe_read_kernel(&seq, sizeof(seq), &tcp->seq);
+    bpf_probe_read_kernel(&ack, sizeof(ack), &tcp->ack_seq);
+    pkt_tuple->dport = ntohs(dport);
+    pkt_tuple->seq = ntohl(seq);
+    pkt_tuple->ack = ntohl(ack);
+
+    struct ktime_info *tinfo;
+    if ((tinfo = out_timestamps.lookup(pkt_tuple)) == NULL){
+        return 0;
+    }
+    tinfo->ip_time = bpf_ktime_get_ns();
+    return 0;
+}
+
+static inline int handle_ip_queue_xmit(void *ctx, struct sock *sk, struct sk_buff *skb){
+    u16 family;
+    bpf_probe_read_kernel(&family, sizeof(family), &sk->__sk_common.skc_family);
+
+    if (family == AF_INET){
+        struct packet_tuple pkt_tuple = {};
+        u32 daddr;
+        bpf_probe_read_kernel(&daddr, sizeof(daddr), &sk->__sk_common.skc_daddr);
+        set_mapped_addr(pkt_tuple.daddr, daddr);
+        return on_network_xmit(&pkt_tuple, sk, skb);
+    }
+
+    return 0;
+}
+
+static inline int handle_inet6_csk_xmit(void *ctx, struct sock *sk, struct sk_buff *skb){
+    u16 family;
+    bpf_probe_read_kernel(&family, sizeof(family), &sk->__sk_common.skc_family);
+
+    if (family == AF_INET6){
+        struct packet_tuple pkt_tuple = {};
+        bpf_probe_read_kernel(pkt_tuple.daddr, sizeof(pkt_tuple.daddr), &sk->__sk_common.skc_v6_daddr.in6_u.u6_addr32);
+        return on_network_xmit(&pkt_tuple, sk, skb);
+    }
+
+    return 0;
+}
+
+static inline int handle_dev_queue_xmit(void *ctx, struct sk_buff *skb){
+    struct packet_tuple pkt_tuple = {};
+    if (get_pkt_tuple(&pkt_tuple, skb) != 0){
+        return 0;
+    }
+
+    struct ktime_info *tinfo;
+    if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
+        return 0;
+    }
+    tinfo->mac_time = bpf_ktime_get_ns();
+    return 0;
+}
+
+static inline int handle_dev_hard_start_xmit(void *ctx, struct sk_buff *skb){
+    struct packet_tuple pkt_tuple = {};
+    if (get_pkt_tuple(&pkt_tuple, skb) != 0){
+        return 0;
+    }
+
+    struct flow_tuple *ftuple;
+    if ((ftuple = flows.lookup(&pkt_tuple)) == NULL){
+        return 0;
+    }
+
+    struct ktime_info *tinfo;
+    if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
+        return 0;
+    }
+
+    u16 protocol;
+    bpf_probe_read_kernel(&protocol, sizeof(protocol), &skb->protocol);
+    tinfo->qdisc_time = bpf_ktime_get_ns();
+    struct data_t data = {};
+    data.ktime = bpf_ktime_get_ns();
+    data.total_time = tinfo->qdisc_time - tinfo->tcp_time;
+    data.qdisc_timestamp = tinfo->qdisc_time;
+    data.qdisc_time = tinfo->qdisc_time - tinfo->mac_time;
+    data.ip_time = tinfo->mac_time - tinfo->ip_time;
+    data.tcp_time = tinfo->ip_time - tinfo->tcp_time;
+    data.sample = tinfo->sample;
+    data.sample_threshold = tinfo->sample_threshold;
+    __builtin_memcpy(data.saddr, ftuple->saddr, sizeof(data.saddr));
+    __builtin_memcpy(data.daddr, pkt_tuple.daddr, sizeof(data.daddr));
+    data.family = protocol == htons(ETH_P_IP) ? AF_INET : AF_INET6;
+    data.sport = ftuple->sport;
+    data.dport = pkt_tuple.dport;
+    data.seq = pkt_tuple.seq;
+    data.ack = pkt_tuple.ack;
+
+    flows.delete(&pkt_tuple);
+    out_timestamps.delete(&pkt_tuple);
+    map_stats.increment(STAT_COMPLETED);
+    timestamp_events.perf_submit(ctx, &data, sizeof(data));
+    return 0;
+}
+
+#ifdef USE_FENTRY
+
+KFUNC_PROBE(__tcp_transmit_skb, struct sock *sk, struct sk_buff *skb, int clone_it, gfp_t gfp_mask, u32 rcv_nxt){
+    return handle___tcp_transmit_skb(ctx, sk, skb, rcv_nxt);
+}
+
+KFUNC_PROBE(ip_queue_xmit, struct sock *sk, struct sk_buff *skb){
+    return handle_ip_queue_xmit(ctx, sk, skb);
+}
+
+KFUNC_PROBE(inet6_csk_xmit, struct sock *sk, struct sk_buff *skb){
+    return handle_inet6_csk_xmit(ctx, sk, skb);
+}
+
+KFUNC_PROBE(DEV_QUEUE_XMIT_EVENT, struct sk_buff *skb){
+    return handle_dev_queue_xmit(ctx, skb);
+}
+
+KFUNC_PROBE(dev_hard_start_xmit, struct sk_buff *skb){
+    return handle_dev_hard_start_xmit(ctx, skb);
+}
+
+#else
+
+int on___tcp_transmit_skb(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb, int clone_it, gfp_t gfp_mask, u32 rcv_nxt){
+    return handle___tcp_transmit_skb(ctx, sk, skb, rcv_nxt);
+}
+
+int on_ip_queue_xmit(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb){
+    return handle_ip_queue_xmit(ctx, sk, skb);
+}
+
+int on_inet6_csk_xmit(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb){
+    return handle_inet6_csk_xmit(ctx, sk, skb);
+}
+
+int on_dev_queue_xmit(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_dev_queue_xmit(ctx, skb);
+}
+
+int on_dev_hard_start_xmit(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_dev_hard_start_xmit(ctx, skb);
+}
+
+#endif
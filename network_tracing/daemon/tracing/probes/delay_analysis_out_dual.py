@@ -0,0 +1,117 @@
+import logging
+from dataclasses import dataclass, field
+from functools import cache
+from socket import AF_INET
+from typing import Any, cast
+
+from network_tracing.common.utilities import DataclassConversionMixin
+from network_tracing.daemon.tracing.probes import (delay_analysis,
+                                                   delay_analysis_out)
+from network_tracing.daemon.tracing.probes.delay_analysis import ProbeOptions
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProbeEvent(DataclassConversionMixin):
+
+    @dataclass
+    class RawProbeEvent(DataclassConversionMixin):
+        ktime: int
+        family: int
+        sport: int
+        dport: int
+        seq: int
+        ack: int
+        qdisc_timestamp: int
+        total_time: int
+        qdisc_time: int
+        ip_time: int
+        tcp_time: int
+
+    @dataclass
+    class ParsedProbeEvent(DataclassConversionMixin):
+        family: str
+        """Either `ipv4` or `ipv6`."""
+
+        saddr: str
+        sport: int
+        daddr: str
+        dport: int
+        seq: int
+        ack: int
+        qdisc_timestamp: float
+        total_time: float
+        qdisc_time: float
+        ip_time: float
+        tcp_time: float
+
+    raw: RawProbeEvent
+    parsed: ParsedProbeEvent
+    sample_ratio: float = field(default=1.0)
+    """Fraction of packets traced when this packet was sampled at the first hook, by which statistics can be re-weighted."""
+
+    def __post_init__(self):
+        if isinstance(self.raw, dict):
+            self.raw = ProbeEvent.RawProbeEvent.from_dict(
+                cast(dict[str, Any], self.raw))
+        if isinstance(self.parsed, dict):
+            self.parsed = ProbeEvent.ParsedProbeEvent.from_dict(
+                cast(dict[str, Any], self.parsed))
+
+    def __ktime__(self) -> int:
+        return self.raw.ktime
+
+    @classmethod
+    def from_raw_event(cls, raw_event: RawProbeEvent, saddr: str, daddr: str):
+        parsed_event = cls.ParsedProbeEvent(
+            family='ipv4' if raw_event.family == AF_INET else 'ipv6',
+            saddr=saddr,
+            sport=raw_event.sport,
+            daddr=daddr,
+            dport=raw_event.dport,
+            seq=raw_event.seq,
+            ack=raw_event.ack,
+            qdisc_timestamp=raw_event.qdisc_timestamp / 1000,
+            total_time=raw_event.total_time / 1000,
+            qdisc_time=raw_event.qdisc_time / 1000,
+            ip_time=raw_event.ip_time / 1000,
+            tcp_time=raw_event.tcp_time / 1000)
+        return cls(raw=raw_event, parsed=parsed_event)
+
+
+class Probe(delay_analysis.Probe):
+    """Dual-stack variant of `delay_analysis_out` and `delay_analysis_out_v6`, which runs each shared hook once per packet."""
+
+    _BPF_SOURCE_FILE = 'delay_analysis_out_dual.bpf.c'
+    _DUAL_STACK = True
+    _INFLIGHT_MAP_NAMES = ('flows', 'out_timestamps')
+
+    def _convert_event(self, event_data: Any) -> ProbeEvent:
+        raw_event = ProbeEvent.RawProbeEvent(
+            ktime=event_data.ktime,
+            family=event_data.family,
+            sport=event_data.sport,
+            dport=event_data.dport,
+            seq=event_data.seq,
+            ack=event_data.ack,
+            qdisc_timestamp=event_data.qdisc_timestamp,
+            total_time=event_data.total_time,
+            qdisc_time=event_data.qdisc_time,
+            ip_time=event_data.ip_time,
+            tcp_time=event_data.tcp_time)
+        return ProbeEvent.from_raw_event(
+            raw_event,
+            saddr=self._format_address(event_data.family,
+                                       bytes(event_data.saddr)),
+            daddr=self._format_address(event_data.family,
+                                       bytes(event_data.daddr)))
+
+    @cache
+    @staticmethod
+    def _get_kprobe_names() -> dict[bytes, bytes]:
+        return {
+            **delay_analysis_out.Probe._get_kprobe_names(),
+            b'on_inet6_csk_xmit':
+            b'inet6_csk_xmit',
+        }
@@ -30,6 +30,9 @@ struct ktime_info {
     u64 mac_time;
     u64 ip_time;
     u64 tcp_time;
+    // Sampling config in effect when the packet passed `packet_allowed()`, so that events report the ratio they were sampled at
+    u32 sample;
+    u32 sample_threshold;
 };
 
 struct data_t {
@@ -46,71 +49,156 @@ struct data_t {
     u16 dport;
     u32 seq;
     u32 ack;
+    u32 sample;
+    u32 sample_threshold;
 };
 
-BPF_HASH(flows, struct packet_tuple, struct flow_tuple);
-BPF_HASH(out_timestamps, struct packet_tuple, struct ktime_info);
+BPF_TABLE("lru_hash", struct packet_tuple, struct flow_tuple, flows, MAP_SIZE);
+BPF_TABLE("lru_hash", struct packet_tuple, struct ktime_info, out_timestamps, MAP_SIZE);
+
+// Counters of in-flight map entries, reported periodically by user space
+#define STAT_INSERTED 0
+#define STAT_COMPLETED 1
+BPF_PERCPU_ARRAY(map_stats, u64, 2);
+
 BPF_PERF_OUTPUT(timestamp_events);
 
-static struct tcphdr *skb_to_tcphdr(const struct sk_buff *skb){
-    return (struct tcphdr *)(skb->head + skb->transport_header);
+// Filters updatable at runtime; see `ProbeOptions` for meanings of fields
+struct probe_config {
+    u16 sport;
+    u16 dport;
+    u32 sample;
+    u32 sample_threshold;
+    u8 include;
+    u8 exclude;
+};
+
+BPF_ARRAY(config, struct probe_config, 1);
+
+struct addr_lpm_key {
+    u32 prefixlen;
+    u8 addr[16];
+};
+
+BPF_LPM_TRIE(include_addrs, struct addr_lpm_key, u8, ADDRESS_FILTER_MAX_ENTRIES);
+BPF_LPM_TRIE(exclude_addrs, struct addr_lpm_key, u8, ADDRESS_FILTER_MAX_ENTRIES);
+
+// Kernel memory is read explicitly below, so that the same handlers work with both kprobes and fentry
+static inline struct tcphdr *skb_to_tcphdr(const struct sk_buff *skb){
+    unsigned char *head;
+    u16 transport_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&transport_header, sizeof(transport_header), &skb->transport_header);
+    return (struct tcphdr *)(head + transport_header);
 }
 
 static inline struct ipv6hdr *skb_to_ipv6hdr(const struct sk_buff *skb){
-    return (struct ipv6hdr *)(skb->head + skb->network_header);
+    unsigned char *head;
+    u16 network_header;
+    bpf_probe_read_kernel(&head, sizeof(head), &skb->head);
+    bpf_probe_read_kernel(&network_header, sizeof(network_header), &skb->network_header);
+    return (struct ipv6hdr *)(head + network_header);
+}
+
+// Check a packet against filters in `config`, reporting the sampling config it is checked against; only called at the first hook
+static inline int packet_allowed(u16 sport, u16 dport, u32 sampling_key, const void *saddr, const void *daddr, u32 *sample, u32 *sample_threshold){
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL){
+        return 1;
+    }
+    *sample = cfg->sample;
+    *sample_threshold = cfg->sample_threshold;
+
+    if (cfg->sport && sport != cfg->sport){
+        return 0;
+    }
+    if (cfg->dport && dport != cfg->dport){
+        return 0;
+    }
+    if (cfg->sample && (sampling_key << (32 - cfg->sample) >> (32 - cfg->sample)) != ((0x01 << cfg->sample) - 1)){
+        return 0;
+    }
+    // Adaptive sampling: trace packets whose hashed key falls below the threshold set by user space
+    if (cfg->sample_threshold && sampling_key * 2654435761u >= cfg->sample_threshold){
+        return 0;
+    }
+
+    if (!cfg->include && !cfg->exclude){
+        return 1;
+    }
+    struct addr_lpm_key skey = {.prefixlen = sizeof(skey.addr) * 8};
+    struct addr_lpm_key dkey = {.prefixlen = sizeof(dkey.addr) * 8};
+    __builtin_memcpy(skey.addr, saddr, sizeof(skey.addr));
+    __builtin_memcpy(dkey.addr, daddr, sizeof(dkey.addr));
+    if (cfg->exclude && (exclude_addrs.lookup(&skey) != NULL || exclude_addrs.lookup(&dkey) != NULL)){
+        return 0;
+    }
+    if (cfg->include && include_addrs.lookup(&skey) == NULL && include_addrs.lookup(&dkey) == NULL){
+        return 0;
+    }
+    return 1;
 }
 
 static void get_pkt_tuple(struct packet_tuple *pkt_tuple, struct ipv6hdr *ip6h, struct tcphdr *tcp){
+    u16 dport;
+    u32 seq, ack;
     bpf_probe_read_kernel(&pkt_tuple->daddr, sizeof(pkt_tuple->daddr), &ip6h->daddr.in6_u.u6_addr32);
-    u16 dport = tcp->dest;
+    bpf_probe_read_kernel(&dport, sizeof(dport), &tcp->dest);
+    bpf_probe_read_kernel(&seq, sizeof(seq), &tcp->seq);
+    bpf_probe_read_kernel(&ack, sizeof(ack), &tcp->ack_seq);
     pkt_tuple->dport = ntohs(dport);
-    u32 seq = tcp->seq;
-    u32 ack = tcp->ack_seq;
     pkt_tuple->seq = ntohl(seq);
     pkt_tuple->ack = ntohl(ack);
-} 
+}
 
-int on___tcp_transmit_skb(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb, int clone_it, gfp_t gfp_mask, u32 rcv_nxt){
-    u16 family = sk->__sk_common.skc_family;
+static inline int handle___tcp_transmit_skb(void *ctx, struct sock *sk, struct sk_buff *skb, u32 rcv_nxt){
+    u16 family;
+    bpf_probe_read_kernel(&family, sizeof(family), &sk->__sk_common.skc_family);
 
     if (family == AF_INET6) {
-        // bpf_trace_printk("tcp_transmit_skb v6!!!!");
         struct flow_tuple ftuple = {};
         struct packet_tuple pkt_tuple = {};
-        struct tcp_skb_cb *tcb;
-
+        struct tcp_skb_cb *tcb = TCP_SKB_CB(skb);
         u16 dport;
-        bpf_probe_read_kernel(&dport, sizeof(dport),&sk->__sk_common.skc_dport);
-        
+        u32 len;
+
+        bpf_probe_read_kernel(&dport, sizeof(dport), &sk->__sk_common.skc_dport);
         bpf_probe_read_kernel(&ftuple.saddr, sizeof(ftuple.saddr), &sk->__sk_common.skc_v6_rcv_saddr.in6_u.u6_addr32);
         bpf_probe_read_kernel(&ftuple.daddr, sizeof(ftuple.daddr), &sk->__sk_common.skc_v6_daddr.in6_u.u6_addr32);
         bpf_probe_read_kernel(&ftuple.sport, sizeof(ftuple.sport), &sk->__sk_common.skc_num);
-        ftuple.dport = pkt_tuple.dport;
+        ftuple.dport = ntohs(dport);
 
-        bpf_probe_read_kernel(&pkt_tuple.daddr, sizeof(pkt_tuple.daddr), &sk->__sk_common.skc_v6_daddr.in6_u.u6_addr32);
+        pkt_tuple.daddr = ftuple.daddr;
         pkt_tuple.dport = ntohs(dport);
-        tcb = TCP_SKB_CB(skb);
-        pkt_tuple.seq = tcb->seq; 
+        bpf_probe_read_kernel(&pkt_tuple.seq, sizeof(pkt_tuple.seq), &tcb->seq);
         pkt_tuple.ack = rcv_nxt;
+        bpf_probe_read_kernel(&len, sizeof(len), &skb->len);
 
-        ##SAMPLING##
-        ##FILTER_DPORT##
-        ##FILTER_SPORT##
+        u32 sample = 0, sample_threshold = 0;
+        if (!packet_allowed(ftuple.sport, pkt_tuple.dport, pkt_tuple.seq + pkt_tuple.ack + len, &ftuple.saddr, &ftuple.daddr, &sample, &sample_threshold)){
+            return 0;
+        }
 
-        flows.lookup_or_init(&pkt_tuple, &ftuple);
+        flows.lookup_or_try_init(&pkt_tuple, &ftuple);
         struct ktime_info *tinfo, zero = {};
-        if ((tinfo = out_timestamps.lookup_or_init(&pkt_tuple, &zero)) == NULL){
-            return 0;
+        if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
+            if ((tinfo = out_timestamps.lookup_or_try_init(&pkt_tuple, &zero)) == NULL){
+                return 0;
+            }
+            map_stats.increment(STAT_INSERTED);
         }
         tinfo->tcp_time = bpf_ktime_get_ns();
+        tinfo->sample = sample;
+        tinfo->sample_threshold = sample_threshold;
     }
-    
+
     return 0;
 }
 
-
-int on_inet6_csk_xmit(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb){
-    u16 family = sk->__sk_common.skc_family;
+static inline int handle_inet6_csk_xmit(void *ctx, struct sock *sk, struct sk_buff *skb){
+    u16 family;
+    bpf_probe_read_kernel(&family, sizeof(family), &sk->__sk_common.skc_family);
 
     if (family == AF_INET6) {
         struct packet_tuple pkt_tuple = {};
@@ -118,37 +206,29 @@ int on_inet6_csk_xmit(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb)
         u16 dport;
         u32 seq, ack;
         bpf_probe_read_kernel(&pkt_tuple.daddr, sizeof(pkt_tuple.daddr), &sk->__sk_common.skc_v6_daddr.in6_u.u6_addr32);
-        bpf_probe_read_kernel(&dport, sizeof(dport),&sk->__sk_common.skc_dport);
+        bpf_probe_read_kernel(&dport, sizeof(dport), &sk->__sk_common.skc_dport);
+        bpf_probe_read_kernel(&seq, sizeof(seq), &tcp->seq);
+        bpf_probe_read_kernel(&ack, sizeof(ack), &tcp->ack_seq);
         pkt_tuple.dport = ntohs(dport);
-        seq = tcp->seq;
-        ack = tcp->ack_seq;
         pkt_tuple.seq = ntohl(seq);
         pkt_tuple.ack = ntohl(ack);
 
-        ##SAMPLING##
-        ##FILTER_DPORT##
-        ##FILTER_SPORT##
-        
         struct ktime_info *tinfo;
         if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
             return 0;
         }
         tinfo->ip_time = bpf_ktime_get_ns();
     }
-    
+
     return 0;
 }
 
-int on_dev_queue_xmit(struct pt_regs *ctx, struct sk_buff *skb){
+static inline int handle_dev_queue_xmit(void *ctx, struct sk_buff *skb){
     struct ipv6hdr *ip6h = skb_to_ipv6hdr(skb);
     struct tcphdr *tcp = skb_to_tcphdr(skb);
     struct packet_tuple pkt_tuple = {};
     get_pkt_tuple(&pkt_tuple, ip6h, tcp);
 
-    ##SAMPLING##
-    ##FILTER_DPORT##
-    ##FILTER_SPORT##
-
     struct ktime_info *tinfo;
     if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
         return 0;
@@ -157,41 +237,34 @@ int on_dev_queue_xmit(struct pt_regs *ctx, struct sk_buff *skb){
     return 0;
 }
 
-int on_dev_hard_start_xmit(struct pt_regs *ctx, struct sk_buff *skb){
+static inline int handle_dev_hard_start_xmit(void *ctx, struct sk_buff *skb){
     struct ipv6hdr *ip6h = skb_to_ipv6hdr(skb);
     struct tcphdr *tcp = skb_to_tcphdr(skb);
     struct packet_tuple pkt_tuple = {};
     get_pkt_tuple(&pkt_tuple, ip6h, tcp);
 
-    ##SAMPLING##
-    ##FILTER_DPORT##
-    ##FILTER_SPORT##
-    
     struct flow_tuple *ftuple;
     if((ftuple = flows.lookup(&pkt_tuple)) == NULL){
         return 0;
     }
- 
+
     struct ktime_info *tinfo;
     if ((tinfo = out_timestamps.lookup(&pkt_tuple)) == NULL){
         return 0;
     }
-    
-    u16 sport = 0;
-    sport = tcp->source;
+
+    u16 sport;
+    bpf_probe_read_kernel(&sport, sizeof(sport), &tcp->source);
     tinfo->qdisc_time = bpf_ktime_get_ns();
     struct data_t data = {};
-    bpf_trace_printk("qdisc_time: %ld", tinfo->qdisc_time);
-    bpf_trace_printk("mac_time: %ld", tinfo->mac_time);
-    bpf_trace_printk("ip_time: %ld", tinfo->ip_time);
-    bpf_trace_printk("tcp_time: %ld", tinfo->tcp_time);
-
     data.ktime = bpf_ktime_get_ns();
     data.total_time = tinfo->qdisc_time - tinfo->tcp_time;
     data.qdisc_timestamp = tinfo->qdisc_time;
     data.qdisc_time = tinfo->qdisc_time - tinfo->mac_time;
     data.ip_time = tinfo->mac_time - tinfo->ip_time;
     data.tcp_time = tinfo->ip_time - tinfo->tcp_time;
+    data.sample = tinfo->sample;
+    data.sample_threshold = tinfo->sample_threshold;
     data.saddr = ftuple->saddr;
     data.daddr = pkt_tuple.daddr;
     data.nat_sport = ntohs(sport);
@@ -199,9 +272,48 @@ int on_dev_hard_start_xmit(struct pt_regs *ctx, struct sk_buff *skb){
     data.dport = pkt_tuple.dport;
     data.seq = pkt_tuple.seq;
     data.ack = pkt_tuple.ack;
-    
+
     flows.delete(&pkt_tuple);
     out_timestamps.delete(&pkt_tuple);
+    map_stats.increment(STAT_COMPLETED);
     timestamp_events.perf_submit(ctx, &data, sizeof(data));
     return 0;
 }
+
+#ifdef USE_FENTRY
+
+KFUNC_PROBE(__tcp_transmit_skb, struct sock *sk, struct sk_buff *skb, int clone_it, gfp_t gfp_mask, u32 rcv_nxt){
+    return handle___tcp_transmit_skb(ctx, sk, skb, rcv_nxt);
+}
+
+KFUNC_PROBE(inet6_csk_xmit, struct sock *sk, struct sk_buff *skb){
+    return handle_inet6_csk_xmit(ctx, sk, skb);
+}
+
+KFUNC_PROBE(DEV_QUEUE_XMIT_EVENT, struct sk_buff *skb){
+    return handle_dev_queue_xmit(ctx, skb);
+}
+
+KFUNC_PROBE(dev_hard_start_xmit, struct sk_buff *skb){
+    return handle_dev_hard_start_xmit(ctx, skb);
+}
+
+#else
+
+int on___tcp_transmit_skb(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb, int clone_it, gfp_t gfp_mask, u32 rcv_nxt){
+    return handle___tcp_transmit_skb(ctx, sk, skb, rcv_nxt);
+}
+
+int on_inet6_csk_xmit(struct pt_regs *ctx, struct sock *sk, struct sk_buff *skb){
+    return handle_inet6_csk_xmit(ctx, sk, skb);
+}
+
+int on_dev_queue_xmit(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_dev_queue_xmit(ctx, skb);
+}
+
+int on_dev_hard_start_xmit(struct pt_regs *ctx, struct sk_buff *skb){
+    return handle_dev_hard_start_xmit(ctx, skb);
+}
+
+#endif
@@ -1,35 +1,17 @@
 import logging
 from dataclasses import dataclass, field
 from functools import cache
-from pathlib import Path
 from socket import AF_INET6, inet_ntop
-from threading import Lock, Thread
-from time import sleep
-from typing import Any, Optional, Union, cast
-
-from bcc import BPF
+from typing import Any, cast
 
 from network_tracing.common.utilities import DataclassConversionMixin
-from network_tracing.daemon.tracing.probes.models import (BaseProbe,
-                                                          EventCallback)
+from network_tracing.daemon.tracing.probes import delay_analysis
+from network_tracing.daemon.tracing.probes.delay_analysis import ProbeOptions
 from network_tracing.daemon.utilities import KernelSymbol
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class ProbeOptions(DataclassConversionMixin):
-
-    sport: Optional[int] = field(default=None)
-    """If not `None`, trace this source port only. Equivalent to the original `--sport` option."""
-
-    dport: Optional[int] = field(default=None)
-    """If not `None`, trace this destination port only. Equivalent to the original `--dport` option."""
-
-    sample: Optional[int] = field(default=None)
-    """If not `None`, enable trace sampling. Equivalent to the original `--sample` option."""
-
-
 @dataclass
 class ProbeEvent(DataclassConversionMixin):
 
@@ -64,6 +46,8 @@ class ProbeEvent(DataclassConversionMixin):
 
     raw: RawProbeEvent
     parsed: ParsedProbeEvent
+    sample_ratio: float = field(default=1.0)
+    """Fraction of packets traced when this packet was sampled at the first hook, by which statistics can be re-weighted."""
 
     def __post_init__(self):
         if isinstance(self.raw, dict):
@@ -98,55 +82,13 @@ class ProbeEvent(DataclassConversionMixin):
         return cls(raw=raw_event, parsed=parsed_event)
 
 
-class Probe(BaseProbe):
-
-    _PERF_BUFFER_NAME = 'timestamp_events'
-
-    def __init__(self, event_callback: EventCallback,
-                 options: Union[None, dict, ProbeOptions]) -> None:
-        super().__init__(event_callback)
-        self._options = Probe._convert_options(options)
-        self._bpf = Probe._build_bpf(self._options)
-        self._bpf[Probe._PERF_BUFFER_NAME].open_perf_buffer(
-            self._perf_buffer_callback)
-        self._thread: Optional[Thread] = None
-        self._lock = Lock()
-
-    def start(self) -> None:
-
-        def run_async():
-            while self._thread is not None:
-                self._bpf.perf_buffer_poll(200)
-
-        with self._lock:
-            if self._thread is not None:
-                return
-
-            for fn_name, event in Probe._get_kprobe_names().items():
-                self._bpf.attach_kprobe(fn_name=fn_name, event=event)
+class Probe(delay_analysis.Probe):
 
-            self._thread = Thread(target=run_async, daemon=True)
-            self._thread.start()
+    _BPF_SOURCE_FILE = 'delay_analysis_out_v6.bpf.c'
+    _INFLIGHT_MAP_NAMES = ('flows', 'out_timestamps')
+    _IPV6 = True
 
-    def stop(self) -> None:
-        with self._lock:
-            if self._thread is None:
-                return
-
-            thread, self._thread = self._thread, None
-            for _ in range(30):
-                if not thread.is_alive():
-                    break
-                sleep(1)
-            else:
-                if thread.is_alive():
-                    raise RuntimeError('Failed to stop')
-
-            for fn_name, event in Probe._get_kprobe_names().items():
-                self._bpf.detach_kprobe(fn_name=fn_name, event=event)
-
-    def _perf_buffer_callback(self, cpu, data, size):
-        event_data = self._bpf[Probe._PERF_BUFFER_NAME].event(data)
+    def _convert_event(self, event_data: Any) -> ProbeEvent:
         raw_event = ProbeEvent.RawProbeEvent(
             ktime=event_data.ktime,
             saddr=event_data.saddr,
@@ -160,56 +102,7 @@ class Probe(BaseProbe):
             qdisc_time=event_data.qdisc_time,
             ip_time=event_data.ip_time,
             tcp_time=event_data.tcp_time)
-        event = ProbeEvent.from_raw_event(raw_event)
-        self._submit_event(event)
-
-    @staticmethod
-    def _build_bpf(options: ProbeOptions) -> BPF:
-        with open(Path(__file__).parent / 'delay_analysis_out_v6.bpf.c',
-                  'r',
-                  encoding='utf-8') as fp:
-            bpf_text = fp.read()
-
-        if options.sport:
-            bpf_text = bpf_text.replace(
-                '##FILTER_SPORT##',
-                'if (pkt_tuple.sport != %d) { return 0; }' % options.sport)
-        else:
-            bpf_text = bpf_text.replace('##FILTER_SPORT##',
-                                        '/* FILTER_SPORT disabled */')
-
-        if options.dport:
-            bpf_text = bpf_text.replace(
-                '##FILTER_DPORT##',
-                'if (pkt_tuple.dport != %d) { return 0; }' % options.dport)
-        else:
-            bpf_text = bpf_text.replace('##FILTER_DPORT##',
-                                        '/* FILTER_DPORT disabled */')
-
-        if options.sample:
-            bpf_text = bpf_text.replace(
-                '##SAMPLING##',
-                'if (((pkt_tuple.seq + pkt_tuple.ack + skb->len) << (32-%d) >> (32-%d)) != ((0x01 << %d) - 1)) { return 0;}'
-                % (options.sample, options.sample, options.sample))
-        else:
-            bpf_text = bpf_text.replace('##SAMPLING##',
-                                        '/* SAMPLING disabled */')
-
-        bpf = BPF(text=bpf_text)
-        return bpf
-
-    @staticmethod
-    def _convert_options(
-            options: Union[None, dict, ProbeOptions]) -> ProbeOptions:
-        if options is None:
-            return ProbeOptions()
-        elif isinstance(options, dict):
-            return ProbeOptions.from_dict(options)
-        elif isinstance(options, ProbeOptions):
-            return options
-        else:
-            raise RuntimeError(
-                'Unrecognized type of options {}'.format(options))
+        return ProbeEvent.from_raw_event(raw_event)
 
     @cache
     @staticmethod
@@ -3,6 +3,7 @@ from typing import Any, Callable
 from network_tracing.daemon.models import BackgroundTask
 
 EventCallback = Callable[..., Any]
+"""Called with one or more events at once."""
 
 ProbeFactory = Callable[[EventCallback, Any], BackgroundTask]
 
@@ -11,3 +12,21 @@ class BaseProbe(BackgroundTask):
 
     def __init__(self, event_callback: EventCallback) -> None:
         self._submit_event = event_callback
+
+    def update_options(self, options: dict[str, Any]) -> None:
+        """Update given options of the probe in place, without restarting it."""
+        self.apply_options(self.prepare_options(options))
+
+    def prepare_options(self, options: dict[str, Any]) -> Any:
+        """Check given options to update, and return them prepared for `apply_options()`, without changing the probe. Raise `ValueError` or `TypeError` if they are invalid."""
+        raise NotImplementedError(
+            'Probe does not support updating options at runtime')
+
+    def apply_options(self, prepared: Any) -> None:
+        """Apply options returned by `prepare_options()` in place, without restarting the probe."""
+        raise NotImplementedError(
+            'Probe does not support updating options at runtime')
+
+    def details(self) -> dict[str, Any]:
+        """Return information about the probe determined at runtime, to be reported along with the task."""
+        return {}
@@ -1,22 +1,31 @@
 import logging
+import os
 import re
+import sys
+from argparse import ArgumentParser
+from codecs import getincrementaldecoder
 from dataclasses import dataclass, field
 from pathlib import Path
 from signal import SIGINT
 from socket import AF_INET, inet_ntop
 from struct import pack
 from subprocess import PIPE, Popen
-from threading import Lock, Thread
-from time import sleep
-from typing import IO, Any, Optional, TextIO, Union, cast
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import IO, Any, BinaryIO, Callable, Optional, Union, cast
 
 from network_tracing.common.utilities import DataclassConversionMixin
 from network_tracing.daemon.tracing.probes.models import (BaseProbe,
                                                           EventCallback)
-from network_tracing.daemon.utilities import IPMatcher
+from network_tracing.daemon.utilities import IPMatcher, KernelSymbolTable
 
 logger = logging.getLogger(__name__)
 
+_READ_SIZE = 65536
+
+_TEXT_SYMBOL_TYPES = 'tT'
+_PADDING_SYMBOL_PREFIX = '__pfx_'
+
 DEFAULT_TRACED_FUNCTIONS = [
     # Key functions
     'lock_sock_nested',
@@ -127,7 +136,19 @@ class ProbeOptions(DataclassConversionMixin):
     log_path: Optional[str] = field(default=None)
     """If not `None`, copy stdout from `retsnoop` to specified path."""
 
+    replay_path: Optional[str] = field(default=None)
+    """If not `None`, do not run `retsnoop`; parse its stdout captured at specified path (e.g. by `log_path`) instead."""
+
+    replay_speed: Optional[float] = field(default=None)
+    """Speed of replaying relative to the original timing, e.g. 1.0 for the original timing and 2.0 for twice as fast. If `None`, replay as fast as possible."""
+
+    resolve_symbols: bool = field(default=True)
+    """Deduplicate `traced_functions` and expand wildcards in it against kernel symbols before starting `retsnoop`, dropping functions that do not exist. If `False`, pass `traced_functions` to `retsnoop` verbatim."""
+
     def __post_init__(self):
+        if self.replay_speed is not None and self.replay_speed <= 0:
+            raise ValueError('Invalid replay speed {}'.format(
+                self.replay_speed))
         self._ignore_matcher = IPMatcher(self.ignore)
         if self.trace_key_functions_only:
             self.traced_functions = KEY_TRACED_FUNCTIONS[:]
@@ -160,15 +181,11 @@ class ProbeEvent(DataclassConversionMixin):
         return self.timestamp
 
 
-class Probe(BaseProbe):
+class _OutputParser:
+    """State machine turning stdout of `retsnoop` into `ProbeEvent`s.
 
-    _BASE_ARGS = [
-        Path(__file__).parent / 'retsnoop',
-        '-T',
-        '-S',
-        '-e',
-        '__tcp_transmit_skb',
-    ]
+    Feed it with raw bytes as they are read; lines are decoded incrementally, dispatched on their leading marker, and events completed within each `feed()` call are submitted together.
+    """
 
     # FIXME: swapper/3/swapper/3 is parsed into {'tname': 'swapper/3/swapper', 'pname': '3'} instead of {'tname': 'swapper/3', 'pname': 'swapper/3'}
     _RE_HEADER = re.compile(
@@ -181,7 +198,246 @@ class Probe(BaseProbe):
     _RE_FUNCTION_EXIT = re.compile(
         r'\s*(?P<mark>[↔←])\s(?P<name>[a-zA-Z_]*)~\d*~\s*\[.*\]\s*~(?P<time>[0-9]*\.[0-9]*)us<=(?P<saddr>\d*)-(?P<sport>\d*)-(?P<daddr>\d*)-(?P<dport>\d*)#',
         re.U)
-    _RE_TAIL = re.compile(r'-END-', re.U)
+    _TAIL = '-END-'
+
+    _SKIPPED_LOG_THRESHOLD = 256
+
+    def __init__(self, options: ProbeOptions,
+                 event_callback: EventCallback) -> None:
+        self._options = options
+        self._submit_events = event_callback
+        self._decoder = getincrementaldecoder('utf-8')(errors='replace')
+        self._partial_line = ''
+        self._completed_events: list[ProbeEvent] = []
+        self._handlers: dict[str, Callable[[str], None]] = {
+            '‼': self._handle_missing_record,
+            '→': self._handle_function_entry,
+            '↔': self._handle_function_exit,
+            '←': self._handle_function_exit,
+            '-': self._handle_tail,
+        }
+
+        self._event: Optional[ProbeEvent] = None
+        self._curr_depth = -1
+        self._max_depth = -1
+        self._ignored_count = 0
+        self._non_header_count = 0
+
+    def feed(self, data: bytes) -> None:
+        lines = (self._partial_line + self._decoder.decode(data)).split('\n')
+        self._partial_line = lines.pop()
+        self._feed_lines(lines)
+
+    def close(self) -> None:
+        """Parse whatever remains after the last newline, and submit pending events."""
+        line = self._partial_line + self._decoder.decode(b'', final=True)
+        self._partial_line = ''
+        self._feed_lines([line])
+
+    def _feed_lines(self, lines: list[str]) -> None:
+        try:
+            for line in lines:
+                try:
+                    self.feed_line(line)
+                except Exception as e:
+                    # Drop only the event being parsed, and go on with the next line
+                    logger.warn(
+                        'Encountered an error while parsing a line from retsnoop',
+                        exc_info=e)
+                    self._reset()
+        finally:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._completed_events:
+            events, self._completed_events = self._completed_events, []
+            self._submit_events(*events)
+
+    def feed_line(self, line: str) -> None:
+        line = line.strip()
+        if not line:
+            return
+
+        # Outside an event, only a header is of interest; inside one, headers are ignored
+        if self._event is None:
+            self._handle_header(line)
+            return
+
+        handler = self._handlers.get(line[0], None)
+        if handler is not None:
+            handler(line)
+
+    def _reset(self) -> None:
+        self._event = None
+        self._curr_depth = -1
+        self._max_depth = -1
+
+    def _handle_header(self, line: str) -> None:
+        header = self._RE_HEADER.match(line) if line[0].isdigit() else None
+        if header is None:
+            self._non_header_count += 1
+            if self._non_header_count >= self._SKIPPED_LOG_THRESHOLD:
+                logger.debug('Skipped %d line(s)', self._non_header_count)
+                self._non_header_count = 0
+            return
+
+        if self._non_header_count:
+            logger.debug('Skipped %d line(s)', self._non_header_count)
+            self._non_header_count = 0
+
+        self._reset()
+        self._event = ProbeEvent(timestamp=int(header.group('timestamp')),
+                                 tid=int(header.group('tid')),
+                                 pid=int(header.group('pid')),
+                                 tname=header.group('tname'),
+                                 pname=header.group('pname'))
+
+    def _handle_missing_record(self, line: str) -> None:
+        if self._RE_MISSING_RECORD.match(line):
+            self._event = None
+            logger.debug('Dropped an event (missing record)')
+
+    def _handle_function_entry(self, line: str) -> None:
+        event = cast(ProbeEvent, self._event)
+        if (function_entry := self._RE_FUNCTION_ENTRY.match(line)) is None:
+            return
+
+        saddr_bytes = pack('I', int(function_entry.group('saddr')))
+        if self._options.ignore_matcher.match_ip4_bytes(saddr_bytes):
+            self._event = None
+            self._ignored_count += 1
+            if self._ignored_count >= self._SKIPPED_LOG_THRESHOLD:
+                logger.debug('Dropped %d event(s) (ignored source address)',
+                             self._ignored_count)
+                self._ignored_count = 0
+            return
+
+        if self._ignored_count:
+            logger.debug('Dropped %d event(s) (ignored source address)',
+                         self._ignored_count)
+            self._ignored_count = 0
+
+        if function_entry.group('name') == '__tcp_transmit_skb':
+            sport, daddr_int, dport = map(
+                int, function_entry.group('sport', 'daddr', 'dport'))
+            daddr_bytes = pack('I', daddr_int)
+            flow_data = FunctionsPerFlow(inet_ntop(AF_INET,
+                                                   saddr_bytes), sport,
+                                         inet_ntop(AF_INET, daddr_bytes),
+                                         dport)
+            self._curr_depth += 1
+            if self._max_depth < self._curr_depth:
+                self._max_depth = self._curr_depth
+            event.flows.append(flow_data)
+
+    def _handle_function_exit(self, line: str) -> None:
+        event = cast(ProbeEvent, self._event)
+        if (function_exit := self._RE_FUNCTION_EXIT.match(line)) is None:
+            return
+
+        if self._curr_depth < 0:  # 避免前面数据丢失，只剩退出的函数
+            self._event = None
+            logger.debug('Dropped an event (curr_depth < 0)')
+            return
+
+        mark, name, time_str = function_exit.group('mark', 'name', 'time')
+        time = float(time_str)
+        flow_functions = event.flows[self._curr_depth].functions
+        flow_functions[name] = flow_functions.get(name, 0.0) + time
+        process_functions = event.functions
+        process_functions[name] = process_functions.get(name, 0.0) + time
+        if mark == '←' and name == '__tcp_transmit_skb':
+            self._curr_depth -= 1
+            if self._curr_depth < -1:  # 应对一次进去多次退出的特殊情况
+                self._event = None
+                logger.debug('Dropped an event (curr_depth < -1)')
+
+    def _handle_tail(self, line: str) -> None:
+        if line.startswith(self._TAIL):
+            self._completed_events.append(cast(ProbeEvent, self._event))
+            self._event = None
+
+
+def resolve_traced_functions(
+        patterns: list[str],
+        table: Optional[KernelSymbolTable] = None
+) -> tuple[list[str], list[str]]:
+    """Expand shell-style patterns of function names into existing kernel functions.
+
+    Return names of functions in order of first appearance without duplicates, and patterns matching no function.
+    """
+    if table is None:
+        table = KernelSymbolTable.get_instance()
+
+    functions: dict[str, None] = {}
+    unresolved: list[str] = []
+    for pattern in dict.fromkeys(patterns):
+        if re.search(r'[*?[]', pattern) is None:
+            names = [
+                symbol.symbol_name
+                for symbol in table.find_all_by_name(pattern)
+                if symbol.symbol_type in _TEXT_SYMBOL_TYPES
+            ][:1]
+        else:
+            # Skip parts that are not function entries, e.g. `tcp_sendmsg.cold` split by the compiler and `__pfx_tcp_sendmsg` padding before functions
+            names = [
+                symbol.symbol_name for symbol in table.find_by_glob(pattern)
+                if symbol.symbol_type in _TEXT_SYMBOL_TYPES
+                and '.' not in symbol.symbol_name
+                and not symbol.symbol_name.startswith(_PADDING_SYMBOL_PREFIX)
+            ]
+        if not names:
+            unresolved.append(pattern)
+        functions.update(dict.fromkeys(names))
+    return list(functions), unresolved
+
+
+def replay(options: ProbeOptions,
+           event_callback: EventCallback,
+           stop_event: Optional[Event] = None) -> None:
+    """Feed stdout of `retsnoop` captured at `options.replay_path` through the same parser as live tracing, submitting events as fast as possible or paced by `options.replay_speed`. Return when the capture is exhausted or `stop_event` is set."""
+    if stop_event is None:
+        stop_event = Event()
+    submit_events = event_callback
+    if options.replay_speed is not None:
+        submit_events = _build_paced_callback(event_callback,
+                                              options.replay_speed, stop_event)
+
+    parser = _OutputParser(options, submit_events)
+    with open(cast(str, options.replay_path), 'rb') as fp:
+        while not stop_event.is_set() and (data := fp.read(_READ_SIZE)):
+            parser.feed(data)
+    if not stop_event.is_set():
+        parser.close()
+
+
+def _build_paced_callback(event_callback: EventCallback, speed: float,
+                          stop_event: Event) -> EventCallback:
+    """Wrap `event_callback` to submit events one by one, at intervals between their timestamps divided by `speed`."""
+    origin: Optional[tuple[int, float]] = None
+
+    def paced_callback(*events: ProbeEvent):
+        nonlocal origin
+        for event in events:
+            if origin is None:
+                origin = (event.timestamp, monotonic())
+            due = origin[1] + (event.timestamp - origin[0]) / 1e9 / speed
+            if stop_event.wait(max(due - monotonic(), 0)):
+                return
+            event_callback(event)
+
+    return paced_callback
+
+
+class Probe(BaseProbe):
+
+    _BASE_ARGS = [
+        Path(__file__).parent / 'retsnoop',
+        '-T',
+        '-S',
+        '-e',
+        '__tcp_transmit_skb',
+    ]
 
     def __init__(self, event_callback: EventCallback,
                  options: Union[None, dict[str, Any], ProbeOptions]) -> None:
@@ -189,23 +445,41 @@ class Probe(BaseProbe):
         self._options = self._convert_options(options)
         self._lock = Lock()
         self._running = False
-        self._process: Optional[Popen[str]] = None
+        self._process: Optional[Popen[bytes]] = None
         self._stdout_thread: Optional[Thread] = None
         self._stderr_thread: Optional[Thread] = None
-        self._log_file: Optional[TextIO] = None
+        self._log_file: Optional[BinaryIO] = None
+        self._replay_thread: Optional[Thread] = None
+        self._replay_stop_event = Event()
+        self._traced_functions: Optional[list[str]] = None
+        self._unresolved_functions: list[str] = []
+
+    def details(self) -> dict[str, Any]:
+        if self._traced_functions is None:
+            return {}
+        return {
+            'traced_functions': self._traced_functions,
+            'unresolved_functions': self._unresolved_functions,
+        }
 
     def start(self) -> None:
         if self._running:
             return
 
+        if self._options.replay_path is not None:
+            with self._lock:
+                self._running = True
+                self._replay_stop_event.clear()
+                self._replay_thread = Thread(target=self._replay, daemon=True)
+                self._replay_thread.start()
+            return
+
         with self._lock:
             self._process = self._create_process()
             self._running = True
             if self._options.log_path is not None:
                 try:
-                    self._log_file = open(self._options.log_path,
-                                          'a',
-                                          encoding='utf-8')
+                    self._log_file = open(self._options.log_path, 'ab')
                 except Exception as e:
                     logger.warn(
                         'Encountered an error while opening log file; will not copy stdout of `retsnoop`',
@@ -223,6 +497,16 @@ class Probe(BaseProbe):
         if not self._running:
             return
 
+        if self._replay_thread is not None:
+            with self._lock:
+                self._running = False
+                self._replay_stop_event.set()
+                self._replay_thread.join(timeout=10)
+                if self._replay_thread.is_alive():
+                    logger.warn('Cannot stop thread replaying; skipping')
+                self._replay_thread = None
+            return
+
         with self._lock:
             process = cast(Popen, self._process)
             stdout_thread = cast(Thread, self._stdout_thread)
@@ -256,17 +540,42 @@ class Probe(BaseProbe):
                 self._log_file = None
 
     def _build_process_args(self) -> list[Union[str, Path]]:
+        self._resolve_traced_functions()
         args = self._BASE_ARGS[:]
-        for traced_function in self._options.traced_functions:
+        for traced_function in self._traced_functions:  # type: ignore
             args.extend(['-a', traced_function])
         return args
 
+    def _resolve_traced_functions(self) -> None:
+        patterns = list(dict.fromkeys(self._options.traced_functions))
+        self._unresolved_functions = []
+        if not self._options.resolve_symbols:
+            self._traced_functions = patterns
+            return
+
+        try:
+            self._traced_functions, self._unresolved_functions = \
+                resolve_traced_functions(patterns)
+        except OSError as e:
+            logger.warn(
+                'Cannot read kernel symbols; passing traced functions to retsnoop verbatim',
+                exc_info=e)
+            self._traced_functions = patterns
+            return
+
+        if self._unresolved_functions:
+            logger.warn('Skipping traced functions not found in kernel: %s',
+                        ', '.join(self._unresolved_functions))
+        logger.info('Resolved %d pattern(s) into %d traced function(s)',
+                    len(patterns), len(self._traced_functions))
+
     def _create_process(self) -> Popen:
         args = self._build_process_args()
         logger.debug('Starting retsnoop with command %s',
                      ' '.join(map(lambda arg: "'{}'".format(arg), args)))
 
-        process = Popen(args, stdout=PIPE, stderr=PIPE, text=True)
+        # Read stdout as bytes in bulk; see `_OutputParser`
+        process = Popen(args, stdout=PIPE, stderr=PIPE)
 
         # # Do not block read() calls, as it might cause threads not exiting
         # os.set_blocking(process.stdout.fileno(), False)  # type: ignore
@@ -275,147 +584,39 @@ class Probe(BaseProbe):
         return process
 
     def _parse_process_stdout(self):
-        process_stdout: IO[str] = self._process.stdout  # type: ignore
-        log_file: Optional[TextIO] = self._log_file
-
-        @dataclass
-        class Context:
-            event: Optional[ProbeEvent] = field(default=None)
-            curr_depth: int = field(default=-1)
-            max_depth: int = field(default=-1)
-            ignored_count: int = field(default=0)
-            non_header_count: int = field(default=0)
-
-            def reset(self) -> None:
-                self.event = None
-                self.curr_depth = -1
-                self.max_depth = -1
-
-        context = Context()
-
-        def handle_header(line: str):
-            if context.event is not None:
-                return
-
-            if (header := re.match(self._RE_HEADER, line)) is None:
-                context.non_header_count += 1
-                if context.non_header_count >= 256:
-                    logger.debug('Skipped %d line(s)',
-                                 context.non_header_count)
-                    context.non_header_count = 0
-                return
-
-            if context.non_header_count:
-                logger.debug('Skipped %d line(s)', context.non_header_count)
-                context.non_header_count = 0
-
-            header_fields = header.groupdict()
-            for field in ('timestamp', 'pid', 'tid'):
-                header_fields[field] = int(header_fields[field])
-            context.reset()
-            context.event = ProbeEvent.from_dict(header_fields)
-
-        def handle_missing_record(line: str):
-            if context.event is None:
-                return
-
-            if re.match(self._RE_MISSING_RECORD, line):
-                context.event = None
-                logger.debug('Dropped an event (missing record)')
-                return
-
-        def handle_function_entry(line: str):
-            if context.event is None:
-                return
-
-            if (function_entry := re.match(self._RE_FUNCTION_ENTRY,
-                                           line)) is None:
-                return
-
-            saddr_bytes = pack('I', int(function_entry.group('saddr')))
-            if self._options.ignore_matcher.match_ip4_bytes(saddr_bytes):
-                context.event = None
-                context.ignored_count += 1
-                if context.ignored_count >= 256:
-                    logger.debug(
-                        'Dropped %d event(s) (ignored source address)')
-                    context.ignored_count = 0
-                return
-
-            if context.ignored_count:
-                logger.debug('Dropped %d event(s) (ignored source address)',
-                             context.ignored_count)
-                context.ignored_count = 0
-
-            if function_entry.group('name') == '__tcp_transmit_skb':
-                sport, daddr_int, dport = map(
-                    int, function_entry.group('sport', 'daddr', 'dport'))
-                daddr_bytes = pack('I', daddr_int)
-                saddr, daddr = map(
-                    lambda ip_bytes: inet_ntop(AF_INET, ip_bytes),
-                    (saddr_bytes, daddr_bytes))
-                flow_data = FunctionsPerFlow(saddr, sport, daddr, dport)
-                context.curr_depth += 1
-                if context.max_depth < context.curr_depth:
-                    context.max_depth = context.curr_depth
-                context.event.flows.append(flow_data)
-
-        def handle_function_exit(line: str):
-            if context.event is None:
-                return
-
-            if (function_exit := re.match(self._RE_FUNCTION_EXIT,
-                                          line)) is None:
-                return
-
-            if context.curr_depth < 0:  # 避免前面数据丢失，只剩退出的函数
-                context.event = None
-                logger.debug('Dropped an event (curr_depth < 0)')
-                return
-
-            mark, name, time_str = function_exit.group('mark', 'name', 'time')
-            time = float(time_str)
-            flow_functions = context.event.flows[context.curr_depth].functions
-            flow_functions[name] = flow_functions.get(name, 0.0) + time
-            process_functions = context.event.functions
-            process_functions[name] = flow_functions.get(name, 0.0) + time
-            if mark == '←' and name == '__tcp_transmit_skb':
-                context.curr_depth -= 1
-                if context.curr_depth < -1:  # 应对一次进去多次退出的特殊情况
-                    context.event = None
-                    logger.debug('Dropped an event (curr_depth < -1)')
-                    return
-
-        def handle_tail(line: str):
-            if context.event is None:
-                return
-
-            if re.match(self._RE_TAIL, line):
-                self._submit_event(context.event)
-                context.event = None
-                return
+        stdout_fd = self._process.stdout.fileno()  # type: ignore
+        log_file: Optional[BinaryIO] = self._log_file
+        parser = _OutputParser(self._options, self._submit_event)
 
         while self._running:
             try:
-                line = process_stdout.readline()
+                data = os.read(stdout_fd, _READ_SIZE)
+                if not data:
+                    break
                 if log_file is not None:
-                    log_file.write(line)
-                line = line.strip()
-                if not line:
-                    continue
-                for handler in (handle_header, handle_missing_record,
-                                handle_function_entry, handle_function_exit,
-                                handle_tail):
-                    handler(line)
+                    log_file.write(data)
+                parser.feed(data)
             except Exception as e:
                 logger.warn(
-                    'Encountered an error while parsing stdout from retsnoop',
+                    'Encountered an error while reading stdout from retsnoop',
                     exc_info=e)
 
+        parser.close()
+
+    def _replay(self):
+        try:
+            replay(self._options, self._submit_event, self._replay_stop_event)
+        except Exception as e:
+            logger.warn('Encountered an error while replaying %s',
+                        self._options.replay_path,
+                        exc_info=e)
+        else:
+            logger.info('Finished replaying %s', self._options.replay_path)
+
     def _parse_process_stderr(self):
-        process_stderr: IO[str] = self._process.stderr  # type: ignore
+        process_stderr: IO[bytes] = self._process.stderr  # type: ignore
         while self._running:
-            line = process_stderr.readline().strip()
+            line = process_stderr.readline().decode(errors='replace').strip()
             if not line:
                 continue
             logger.debug('retsnoop stderr: %s', line)
@@ -432,3 +633,63 @@ class Probe(BaseProbe):
             return options
         else:
             raise Exception('Invalid options {}'.format(options))
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description=
+        'Replay captured stdout of retsnoop through the parser of the retsnoop probe, and print resulting events as JSON lines.'
+    )
+    parser.add_argument('path',
+                        metavar='PATH',
+                        help='path to captured stdout of retsnoop')
+    parser.add_argument(
+        '-s',
+        '--speed',
+        type=float,
+        help=
+        'speed relative to the original timing; replay as fast as possible if not specified'
+    )
+    parser.add_argument(
+        '-i',
+        '--ignore',
+        metavar='CIDR',
+        action='append',
+        help=
+        'ignore flows from this address or range; can be specified more than once, and defaults to 127.0.0.0/8'
+    )
+    parser.add_argument('-q',
+                        '--quiet',
+                        action='store_true',
+                        help='do not print events; print statistics only')
+    args = parser.parse_args()
+
+    options_dict: dict[str, Any] = {
+        'replay_path': args.path,
+        'replay_speed': args.speed,
+    }
+    if args.ignore is not None:
+        options_dict['ignore'] = args.ignore
+    options = ProbeOptions.from_dict(options_dict)
+
+    event_count = 0
+
+    def print_events(*events: ProbeEvent):
+        nonlocal event_count
+        event_count += len(events)
+        if not args.quiet:
+            for event in events:
+                print(event.to_json())
+
+    start = monotonic()
+    try:
+        replay(options, print_events)
+    except KeyboardInterrupt:
+        pass
+    elapsed = monotonic() - start
+    print('Replayed {} event(s) in {:.3f} s'.format(event_count, elapsed),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,63 @@
 
 BPF_HASH(start, u32);
 
+// Filters updatable at runtime; see `ProbeOptions` for meanings of fields
+struct probe_config {
+    u64 min_us;
+    u64 event_min_us;
+    u32 pid;
+    u32 tgid;
+    u8 aggregate;
+    u8 per_cpu;
+};
+
+BPF_ARRAY(config, struct probe_config, 1);
+
+// Return non-zero if the task should not be traced
+static inline int filter_task(u32 tgid, u32 pid)
+{
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL)
+        return 0;
+    return (cfg->pid && pid != cfg->pid) || (cfg->tgid && tgid != cfg->tgid);
+}
+
+// Return non-zero if the latency should not be reported
+static inline int filter_delta_us(u64 delta_us)
+{
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL)
+        return 0;
+    // When aggregating, only latencies above a (much higher) separate threshold are reported individually
+    u64 min_us = cfg->aggregate ? cfg->event_min_us : cfg->min_us;
+    return min_us && delta_us <= min_us;
+}
+
+struct hist_key {
+    u32 tgid;
+    u32 cpu;
+    u64 slot;
+};
+
+BPF_HASH(hists, struct hist_key, u64, HIST_MAX_ENTRIES);
+
+// Count the latency into the log2 histogram of its task group, if aggregation is enabled
+static inline void aggregate_delta_us(u32 tgid, u64 delta_us)
+{
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL || !cfg->aggregate)
+        return;
+    struct hist_key key = {};
+    key.tgid = tgid;
+    key.cpu = cfg->per_cpu ? bpf_get_smp_processor_id() : 0;
+    // bpf_log2l() returns floor(log2(v)) + 1, and 1 for 0; make slot i hold [2^i, 2^(i+1)) us, and slot 0 hold [0, 2) us
+    key.slot = bpf_log2l(delta_us) - 1;
+    hists.increment(key);
+}
+
 struct data_t {
     u32 pid;
     u32 tgid;
@@ -19,36 +76,37 @@ BPF_PERF_OUTPUT(events);
 // record enqueue timestamp
 static int trace_enqueue(u32 tgid, u32 pid)
 {
-    if (FILTER_PID || FILTER_TGID || pid == 0)
+    if (filter_task(tgid, pid) || pid == 0)
         return 0;
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
     return 0;
 }
 
-int trace_wake_up_new_task(struct pt_regs *ctx, struct task_struct *p)
-{
-    return trace_enqueue(p->tgid, p->pid);
-}
-
-int trace_ttwu_do_wakeup(struct pt_regs *ctx, struct rq *rq, struct task_struct *p,
-    int wake_flags)
+// Kernel memory is read explicitly below, so that the same handlers work with both kprobes and fentry
+static inline int handle_enqueue(struct task_struct *p)
 {
-    return trace_enqueue(p->tgid, p->pid);
+    u32 tgid, pid;
+    bpf_probe_read_kernel(&tgid, sizeof(tgid), &p->tgid);
+    bpf_probe_read_kernel(&pid, sizeof(pid), &p->pid);
+    return trace_enqueue(tgid, pid);
 }
 
 // calculate latency
-int trace_run(struct pt_regs *ctx, struct task_struct *prev)
+static inline int handle_run(void *ctx, struct task_struct *prev)
 {
-    u32 pid, tgid;
+    u32 pid, tgid, prev_pid;
+    STATE_TYPE state;
+    bpf_probe_read_kernel(&state, sizeof(state), &prev->STATE_FIELD);
+    bpf_probe_read_kernel(&prev_pid, sizeof(prev_pid), &prev->pid);
 
     // ivcsw: treat like an enqueue event and store timestamp
-    if (prev->STATE_FIELD == TASK_RUNNING) {
-        tgid = prev->tgid;
-        pid = prev->pid;
+    if (state == TASK_RUNNING) {
+        bpf_probe_read_kernel(&tgid, sizeof(tgid), &prev->tgid);
+        pid = prev_pid;
         u64 ts = bpf_ktime_get_ns();
         if (pid != 0) {
-            if (!(FILTER_PID) && !(FILTER_TGID)) {
+            if (!filter_task(tgid, pid)) {
                 start.update(&pid, &ts);
             }
         }
@@ -65,14 +123,16 @@ int trace_run(struct pt_regs *ctx, struct task_struct *prev)
     }
     delta_us = (bpf_ktime_get_ns() - *tsp) / 1000;
 
-    if (FILTER_US)
+    u64 tgid_pid = bpf_get_current_pid_tgid();
+    tgid = tgid_pid >> 32;
+    aggregate_delta_us(tgid, delta_us);
+
+    if (filter_delta_us(delta_us))
         return 0;
-	u64 tgid_pid = bpf_get_current_pid_tgid();
-	tgid = tgid_pid >> 32;
     struct data_t data = {};
     data.pid = pid;
-    data.tgid = pid;
-    data.prev_pid = prev->pid;
+    data.tgid = tgid;
+    data.prev_pid = prev_pid;
     data.delta_us = delta_us;
     bpf_get_current_comm(&data.task, sizeof(data.task));
     bpf_probe_read_kernel_str(&data.prev_task, sizeof(data.prev_task), prev->comm);
@@ -84,3 +144,39 @@ int trace_run(struct pt_regs *ctx, struct task_struct *prev)
     return 0;
 }
 
+#ifdef USE_FENTRY
+
+KFUNC_PROBE(wake_up_new_task, struct task_struct *p)
+{
+    return handle_enqueue(p);
+}
+
+KFUNC_PROBE(ttwu_do_wakeup, struct rq *rq, struct task_struct *p, int wake_flags)
+{
+    return handle_enqueue(p);
+}
+
+KFUNC_PROBE(finish_task_switch, struct task_struct *prev)
+{
+    return handle_run(ctx, prev);
+}
+
+#else
+
+int trace_wake_up_new_task(struct pt_regs *ctx, struct task_struct *p)
+{
+    return handle_enqueue(p);
+}
+
+int trace_ttwu_do_wakeup(struct pt_regs *ctx, struct rq *rq, struct task_struct *p,
+    int wake_flags)
+{
+    return handle_enqueue(p);
+}
+
+int trace_run(struct pt_regs *ctx, struct task_struct *prev)
+{
+    return handle_run(ctx, prev);
+}
+
+#endif
@@ -1,19 +1,27 @@
 import logging
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from functools import cache
 from pathlib import Path
-from threading import Lock, Thread
-from time import sleep
-from typing import Optional, Union
+from threading import Lock
+from time import monotonic
+from typing import Any, Optional, Union
 
 from bcc import BPF
 
 from network_tracing.common.utilities import DataclassConversionMixin
 from network_tracing.daemon.tracing.probes.models import (BaseProbe,
                                                           EventCallback)
+from network_tracing.daemon.tracing.poller import get_poller
+from network_tracing.daemon.utilities import KernelSymbolTable
 
 logger = logging.getLogger(__name__)
 
+ATTACH_MODES = ('auto', 'raw_tracepoint', 'fentry', 'kprobe')
+"""Ways to attach to the scheduler. `auto` prefers them in this order."""
+
+HIST_MAX_ENTRIES = 10240
+"""Maximum number of histogram buckets, across all task groups and CPUs, kept in kernel between summaries."""
+
 
 @dataclass
 class ProbeOptions(DataclassConversionMixin):
@@ -26,6 +34,28 @@ class ProbeOptions(DataclassConversionMixin):
     tid: Optional[int] = field(default=None)
     """Trace this TID only. Equivalent to the previous `--tid` option."""
 
+    attach_mode: str = field(default='auto')
+    """One of `auto`, `raw_tracepoint`, `fentry` and `kprobe`."""
+
+    aggregate: bool = field(default=False)
+    """If true, keep log2 histograms of run queue latency per TGID in kernel and emit them periodically as summaries."""
+
+    per_cpu: bool = field(default=False)
+    """If true, keep separate histograms for each CPU as well. Takes effect only if `aggregate` is true."""
+
+    summary_interval: float = field(default=10.0)
+    """Interval between summaries, in seconds. Takes effect only if `aggregate` is true."""
+
+    event_min_us: int = field(default=10000)
+    """Minimum run queue latency to emit individual events for, in us (default 10000), replacing `min_us` if `aggregate` is true."""
+
+    def __post_init__(self):
+        if self.attach_mode not in ATTACH_MODES:
+            raise ValueError('Invalid attach mode {}'.format(self.attach_mode))
+        if self.summary_interval <= 0:
+            raise ValueError('Invalid summary interval {}'.format(
+                self.summary_interval))
+
 
 @dataclass
 class ProbeEvent(DataclassConversionMixin):
@@ -35,54 +65,138 @@ class ProbeEvent(DataclassConversionMixin):
     task: str
     prev_task: str
     delta_us: int
+    kind: str = field(default='event')
+
+
+@dataclass
+class ProbeSummary(DataclassConversionMixin):
+    tgid: int
+    cpu: Optional[int]
+    """CPU on which tasks were switched in, or `None` if histograms are not kept per CPU."""
+
+    interval: float
+    """Seconds covered by this summary."""
+
+    count: int
+    slots: list[int]
+    """Log2 histogram of latencies; `slots[i]` counts latencies in [2^i, 2^(i+1)) us, except that `slots[0]` counts those in [0, 2) us."""
+
+    kind: str = field(default='summary')
 
 
 class Probe(BaseProbe):
 
     _PERF_BUFFER_NAME = 'events'
+    _CONFIG_TABLE_NAME = 'config'
+    _HIST_TABLE_NAME = 'hists'
+    _UPDATABLE_OPTIONS = frozenset(('min_us', 'pid', 'tid', 'event_min_us'))
+    _FENTRY_EVENTS = (b'ttwu_do_wakeup', b'wake_up_new_task',
+                      b'finish_task_switch')
 
     def __init__(self, event_callback: EventCallback,
                  options: Union[dict, None, ProbeOptions]) -> None:
         super().__init__(event_callback)
         self._options = self._convert_options(options)
-        self._bpf = self._build_bpf(self._options)
+        self._attach_mode = Probe._resolve_attach_mode(self._options)
+        self._bpf = self._build_bpf(self._options, self._attach_mode)
+        self._write_config(self._options)
         self._bpf[Probe._PERF_BUFFER_NAME].open_perf_buffer(
             self._perf_buffer_callback)
-        self._thread: Optional[Thread] = None
+        self._poller_fds: Optional[list[int]] = None
+        self._summary_timer: Optional[int] = None
+        self._last_summary = monotonic()
         self._lock = Lock()
 
     def start(self) -> None:
-
-        def run_async():
-            while self._thread is not None:
-                self._bpf.perf_buffer_poll(200)
-
         with self._lock:
-            if self._thread is not None:
+            if self._poller_fds is not None:
                 return
 
-            for fn_name, event in Probe._get_kprobe_names().items():
-                self._bpf.attach_kprobe(fn_name=fn_name, event=event)
+            if self._attach_mode == 'fentry':
+                for event in Probe._FENTRY_EVENTS:
+                    self._bpf.attach_kfunc(fn_name=event)
+            elif self._attach_mode == 'kprobe':
+                for fn_name, event in Probe._get_kprobe_names().items():
+                    self._bpf.attach_kprobe(fn_name=fn_name, event=event)
 
-            self._thread = Thread(target=run_async, daemon=True)
-            self._thread.start()
+            poller = get_poller()
+            self._poller_fds = poller.register_bpf(self._bpf)
+            if self._options.aggregate:
+                self._last_summary = monotonic()
+                self._summary_timer = poller.add_timer(
+                    self._options.summary_interval, self._emit_summaries)
 
     def stop(self) -> None:
         with self._lock:
-            if self._thread is None:
+            if self._poller_fds is None:
                 return
 
-            thread, self._thread = self._thread, None
-            for _ in range(30):
-                if not thread.is_alive():
-                    break
-                sleep(1)
-            else:
-                if thread.is_alive():
-                    raise RuntimeError('Failed to stop')
-
-            for fn_name, event in Probe._get_kprobe_names().items():
-                self._bpf.detach_kprobe(fn_name=fn_name, event=event)
+            poller = get_poller()
+            poller.unregister_all(self._poller_fds)
+            self._poller_fds = None
+            if self._summary_timer is not None:
+                poller.remove_timer(self._summary_timer)
+                self._summary_timer = None
+
+            if self._attach_mode == 'fentry':
+                for event in Probe._FENTRY_EVENTS:
+                    self._bpf.detach_kfunc(fn_name=event)
+            elif self._attach_mode == 'kprobe':
+                for fn_name, event in Probe._get_kprobe_names().items():
+                    self._bpf.detach_kprobe(fn_name=fn_name, event=event)
+
+            if self._options.aggregate:
+                self._emit_summaries()
+
+    def prepare_options(self, options: dict[str, Any]) -> ProbeOptions:
+        unsupported = options.keys() - self._UPDATABLE_OPTIONS
+        if unsupported:
+            raise ValueError('Cannot update option(s) {} at runtime'.format(
+                ', '.join(sorted(unsupported))))
+        return replace(self._options, **options)
+
+    def apply_options(self, prepared: ProbeOptions) -> None:
+        with self._lock:
+            self._write_config(prepared)
+            self._options = prepared
+
+    def _write_config(self, options: ProbeOptions) -> None:
+        table = self._bpf[Probe._CONFIG_TABLE_NAME]
+        config = table.Leaf()
+        config.min_us = options.min_us
+        # PIDs in kernel space are TIDs in user space, and so are TGIDs and PIDs
+        config.pid = options.tid or 0
+        config.tgid = options.pid or 0
+        config.event_min_us = options.event_min_us
+        config.aggregate = options.aggregate
+        config.per_cpu = options.per_cpu
+        table[0] = config
+
+    def _emit_summaries(self) -> None:
+        now = monotonic()
+        interval, self._last_summary = now - self._last_summary, now
+
+        # Take buckets out one by one rather than clearing the map, so that only counts between reading and deleting each of them can be lost
+        table = self._bpf[Probe._HIST_TABLE_NAME]
+        histograms: dict[tuple[int, int], list[int]] = {}
+        for key in list(table.keys()):
+            try:
+                value = table[key].value
+                del table[key]
+            except KeyError:
+                continue
+            slots = histograms.setdefault((key.tgid, key.cpu), [])
+            if len(slots) <= key.slot:
+                slots.extend([0] * (key.slot + 1 - len(slots)))
+            slots[key.slot] += value
+
+        for (tgid, cpu), slots in sorted(histograms.items()):
+            self._submit_event(
+                ProbeSummary(tgid=tgid,
+                             cpu=cpu if self._options.per_cpu else None,
+                             interval=interval,
+                             count=sum(slots),
+                             slots=slots))
 
     def _perf_buffer_callback(self, cpu, data, size):
         event_data = self._bpf[Probe._PERF_BUFFER_NAME].event(data)
@@ -95,16 +209,52 @@ class Probe(BaseProbe):
         self._submit_event(event)
 
     @staticmethod
-    def _build_bpf(options: ProbeOptions) -> BPF:
-        bpf_text = Probe._load_bpf_text()
+    def _build_bpf(options: ProbeOptions, attach_mode: str) -> BPF:
+        bpf_text = Probe._load_bpf_text(attach_mode)
         bpf_text = Probe._alter_bpf_text(bpf_text, options)
-        return BPF(text=bpf_text)
+        bpf_text = bpf_text.replace('HIST_MAX_ENTRIES', str(HIST_MAX_ENTRIES))
+        if attach_mode != 'fentry':
+            return BPF(text=bpf_text)
+
+        bpf = BPF(text=bpf_text, cflags=['-DUSE_FENTRY'])
+        # BCC attaches fentry programs as soon as they are loaded; leave that to start()
+        for event in Probe._FENTRY_EVENTS:
+            bpf.detach_kfunc(fn_name=event)
+        return bpf
 
     @staticmethod
-    def _load_bpf_text() -> str:
+    def _resolve_attach_mode(options: ProbeOptions) -> str:
+        if options.attach_mode == 'raw_tracepoint':
+            if not Probe._use_raw_tracepoint():
+                raise RuntimeError(
+                    'Raw tracepoints are not supported by current kernel')
+            return 'raw_tracepoint'
+        elif options.attach_mode == 'fentry':
+            if not Probe._use_fentry():
+                raise RuntimeError(
+                    'fentry is not supported by current kernel, or finish_task_switch() is not traceable'
+                )
+            return 'fentry'
+        elif options.attach_mode == 'kprobe':
+            return 'kprobe'
+
+        if Probe._use_raw_tracepoint():
+            return 'raw_tracepoint'
+        elif Probe._use_fentry():
+            logger.debug(
+                'Raw tracepoints are not supported; using fentry as an alternative'
+            )
+            return 'fentry'
+        logger.debug(
+            'Raw tracepoints and fentry are not supported; using kprobes as an alternative'
+        )
+        return 'kprobe'
+
+    @staticmethod
+    def _load_bpf_text(attach_mode: str) -> str:
         source_directory = Path(__file__).parent
         source_file = source_directory / 'runqslower.raw_tracepoint.bpf.c' \
-            if Probe._use_raw_tracepoint() \
+            if attach_mode == 'raw_tracepoint' \
                   else source_directory / 'runqslower.kprobe.bpf.c'
         with open(source_file, 'r', encoding='utf-8') as fp:
             return fp.read()
@@ -113,26 +263,10 @@ class Probe(BaseProbe):
     def _alter_bpf_text(bpf_text: str, options: ProbeOptions) -> str:
         if BPF.kernel_struct_has_field(b'task_struct', b'__state') == 1:
             bpf_text = bpf_text.replace('STATE_FIELD', '__state')
+            bpf_text = bpf_text.replace('STATE_TYPE', 'unsigned int')
         else:
             bpf_text = bpf_text.replace('STATE_FIELD', 'state')
-
-        if options.min_us == 0:
-            bpf_text = bpf_text.replace('FILTER_US', '0')
-        else:
-            bpf_text = bpf_text.replace('FILTER_US',
-                                        'delta_us <= %s' % str(options.min_us))
-
-        if options.tid:
-            bpf_text = bpf_text.replace('FILTER_PID',
-                                        'pid != %s' % options.tid)
-        else:
-            bpf_text = bpf_text.replace('FILTER_PID', '0')
-
-        if options.pid:
-            bpf_text = bpf_text.replace('FILTER_TGID',
-                                        'tgid != %s' % options.pid)
-        else:
-            bpf_text = bpf_text.replace('FILTER_TGID', '0')
+            bpf_text = bpf_text.replace('STATE_TYPE', 'long')
 
         return bpf_text
 
@@ -156,16 +290,23 @@ class Probe(BaseProbe):
 
     @cache
     @staticmethod
-    def _get_kprobe_names() -> dict[bytes, bytes]:
-        if Probe._use_raw_tracepoint():
-            return {}
-
-        logger.debug(
-            'Raw tracepoints are not supported; using kprobes as an alternative'
-        )
+    def _use_fentry() -> bool:
+        # finish_task_switch() is often compiled into a .isra clone, to which fentry cannot attach by its original name
+        return BPF.support_kfunc() and any(
+            symbol.symbol_type in 'tT'
+            for symbol in KernelSymbolTable.get_instance().find_all_by_name(
+                'finish_task_switch'))
 
-        finish_task_switch_events = BPF.get_kprobe_functions(
-            event_re=r"^finish_task_switch$|^finish_task_switch\.isra\.\d$")
+    @cache
+    @staticmethod
+    def _get_kprobe_names() -> dict[bytes, bytes]:
+        symbol_table = KernelSymbolTable.get_instance()
+        finish_task_switch_events = {
+            symbol.symbol_name.encode()
+            for symbol in symbol_table.find_all_by_name('finish_task_switch') +
+            symbol_table.find_by_glob('finish_task_switch.isra.?')
+            if symbol.symbol_type in 'tT'
+        }
         return {
             b'trace_ttwu_do_wakeup': b'ttwu_do_wakeup',
             b'trace_wake_up_new_task': b'wake_up_new_task',
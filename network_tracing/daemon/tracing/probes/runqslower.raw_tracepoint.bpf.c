@@ -5,6 +5,63 @@
 
 BPF_HASH(start, u32);
 
+// Filters updatable at runtime; see `ProbeOptions` for meanings of fields
+struct probe_config {
+    u64 min_us;
+    u64 event_min_us;
+    u32 pid;
+    u32 tgid;
+    u8 aggregate;
+    u8 per_cpu;
+};
+
+BPF_ARRAY(config, struct probe_config, 1);
+
+// Return non-zero if the task should not be traced
+static inline int filter_task(u32 tgid, u32 pid)
+{
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL)
+        return 0;
+    return (cfg->pid && pid != cfg->pid) || (cfg->tgid && tgid != cfg->tgid);
+}
+
+// Return non-zero if the latency should not be reported
+static inline int filter_delta_us(u64 delta_us)
+{
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL)
+        return 0;
+    // When aggregating, only latencies above a (much higher) separate threshold are reported individually
+    u64 min_us = cfg->aggregate ? cfg->event_min_us : cfg->min_us;
+    return min_us && delta_us <= min_us;
+}
+
+struct hist_key {
+    u32 tgid;
+    u32 cpu;
+    u64 slot;
+};
+
+BPF_HASH(hists, struct hist_key, u64, HIST_MAX_ENTRIES);
+
+// Count the latency into the log2 histogram of its task group, if aggregation is enabled
+static inline void aggregate_delta_us(u32 tgid, u64 delta_us)
+{
+    int zero = 0;
+    struct probe_config *cfg = config.lookup(&zero);
+    if (cfg == NULL || !cfg->aggregate)
+        return;
+    struct hist_key key = {};
+    key.tgid = tgid;
+    key.cpu = cfg->per_cpu ? bpf_get_smp_processor_id() : 0;
+    // bpf_log2l() returns floor(log2(v)) + 1, and 1 for 0; make slot i hold [2^i, 2^(i+1)) us, and slot 0 hold [0, 2) us
+    key.slot = bpf_log2l(delta_us) - 1;
+    hists.increment(key);
+}
+
 struct data_t {
     u32 pid;
     u32 tgid;
@@ -19,7 +76,7 @@ BPF_PERF_OUTPUT(events);
 // record enqueue timestamp
 static int trace_enqueue(u32 tgid, u32 pid)
 {
-    if (FILTER_PID || FILTER_TGID || pid == 0)
+    if (filter_task(tgid, pid) || pid == 0)
         return 0;
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
@@ -59,7 +116,7 @@ RAW_TRACEPOINT_PROBE(sched_switch)
         bpf_probe_read_kernel(&tgid, sizeof(prev->tgid), &prev->tgid);
         u64 ts = bpf_ktime_get_ns();
         if (pid != 0) {
-            if (!(FILTER_PID) && !(FILTER_TGID)) {
+            if (!filter_task(tgid, pid)) {
                 start.update(&pid, &ts);
             }
         }
@@ -79,10 +136,12 @@ RAW_TRACEPOINT_PROBE(sched_switch)
     }
     delta_us = (bpf_ktime_get_ns() - *tsp) / 1000;
 
-    if (FILTER_US)
+    // Current task is still prev here
+    bpf_probe_read_kernel(&tgid, sizeof(next->tgid), &next->tgid);
+    aggregate_delta_us(tgid, delta_us);
+
+    if (filter_delta_us(delta_us))
         return 0;
-	u64 tgid_pid = bpf_get_current_pid_tgid();
-	tgid = tgid_pid >> 32;
     struct data_t data = {};
     data.pid = pid;
     data.tgid = tgid;
@@ -0,0 +1,359 @@
+"""A probe generating events shaped like those of other probes, for load testing without BPF or root."""
+
+import json
+import logging
+import random
+from dataclasses import dataclass, field
+from socket import AF_INET, inet_ntop
+from threading import Event, Thread
+from time import monotonic, time_ns
+from typing import Any, Callable, Optional, Union
+
+from network_tracing.common.utilities import DataclassConversionMixin
+from network_tracing.daemon.tracing.probes.models import (BaseProbe,
+                                                          EventCallback)
+from network_tracing.daemon.utilities import Ktime
+
+logger = logging.getLogger(__name__)
+
+SHAPES = ('delay_analysis_out', 'delay_analysis_in', 'runqslower', 'retsnoop')
+
+MAX_BATCH_SIZE = 1024
+"""Maximum number of events submitted at once when the generator falls behind."""
+
+_RETSNOOP_FUNCTIONS = ('tcp_write_xmit', 'ip_queue_xmit', 'dev_queue_xmit',
+                       'dev_hard_start_xmit', '_raw_spin_lock_bh', 'skb_clone',
+                       'lock_sock_nested', 'tcp_sendmsg')
+_TASK_NAMES = ('iperf3', 'nginx', 'redis-server', 'java', 'kworker/0:1')
+
+
+@dataclass
+class ProbeOptions(DataclassConversionMixin):
+
+    shape: str = field(default='delay_analysis_out')
+    """Probe whose events to imitate; one of `delay_analysis_out`, `delay_analysis_in`, `runqslower` and `retsnoop`. Also the shape of replayed events, unless they are tracing events of one of these probes."""
+
+    rate: float = field(default=1000.0)
+    """Average number of events per second."""
+
+    burstiness: float = field(default=1.0)
+    """Coefficient of variation of intervals between events: 0 for evenly spaced events, 1 for a Poisson process, and greater for burstier traffic."""
+
+    flows: int = field(default=1024)
+    """Number of distinct flows (or tasks, for `runqslower`) events are spread over."""
+
+    payload_size: int = field(default=0)
+    """If positive, pad each event with a `payload` string of this many bytes."""
+
+    seed: Optional[int] = field(default=None)
+    """Seed of the random generator, to make generated events reproducible."""
+
+    replay_path: Optional[str] = field(default=None)
+    """If not `None`, replay events recorded as JSON lines at specified path instead of generating them. Each line is either an event, or a tracing event with `timestamp` and `event` as printed by the API."""
+
+    replay_speed: Optional[float] = field(default=None)
+    """Speed of replaying relative to recorded timestamps. If `None`, replay as fast as possible."""
+
+    def __post_init__(self):
+        if self.shape not in SHAPES:
+            raise ValueError('Invalid shape {}'.format(self.shape))
+        if self.rate <= 0:
+            raise ValueError('Invalid rate {}'.format(self.rate))
+        if self.burstiness < 0:
+            raise ValueError('Invalid burstiness {}'.format(self.burstiness))
+        if self.flows <= 0:
+            raise ValueError('Invalid number of flows {}'.format(self.flows))
+        if self.payload_size < 0:
+            raise ValueError('Invalid payload size {}'.format(
+                self.payload_size))
+        if self.replay_speed is not None and self.replay_speed <= 0:
+            raise ValueError('Invalid replay speed {}'.format(
+                self.replay_speed))
+
+
+class ProbeEvent(DataclassConversionMixin):
+    """An event in the same format as that of the imitated probe, plus a `shape` field naming it, so that consumers need not guess it from other fields."""
+
+    def __init__(self, timestamp: int, data: dict[str, Any]) -> None:
+        self.timestamp = timestamp
+        self.data = data
+
+    def __timestamp__(self) -> int:
+        return self.timestamp
+
+    def to_dict(self) -> dict[str, Any]:
+        return self.data
+
+
+@dataclass
+class _Flow:
+    saddr: int
+    sport: int
+    daddr: int
+    dport: int
+    saddr_str: str
+    daddr_str: str
+    seq: int
+    ack: int
+
+
+class Probe(BaseProbe):
+
+    def __init__(self, event_callback: EventCallback,
+                 options: Union[None, dict[str, Any], ProbeOptions]) -> None:
+        super().__init__(event_callback)
+        self._options = self._convert_options(options)
+        self._random = random.Random(self._options.seed)
+        self._flows = [self._build_flow() for _ in range(self._options.flows)]
+        self._payload = 'x' * self._options.payload_size
+        self._generators: dict[str, Callable[[int], dict[str, Any]]] = {
+            'delay_analysis_out': self._generate_delay_analysis_out,
+            'delay_analysis_in': self._generate_delay_analysis_in,
+            'runqslower': self._generate_runqslower,
+            'retsnoop': self._generate_retsnoop,
+        }
+        self._thread: Optional[Thread] = None
+        self._stop_event = Event()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        target = self._replay if self._options.replay_path is not None \
+            else self._generate
+        self._thread = Thread(target=target, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _generate(self) -> None:
+        shape = self._options.shape
+        generate = self._generators[shape]
+        # Offset of wall-clock timestamps from the monotonic clock, fixed for the whole run
+        offset = Ktime.get_offset()
+        next_due = monotonic()
+        while not self._stop_event.is_set():
+            now = monotonic()
+            events = []
+            while next_due <= now and len(events) < MAX_BATCH_SIZE:
+                ktime = int(next_due * 1e9)
+                data = generate(ktime)
+                data['shape'] = shape
+                if self._payload:
+                    data['payload'] = self._payload
+                events.append(ProbeEvent(offset + ktime, data))
+                next_due += self._next_interval()
+            if events:
+                self._submit_event(*events)
+            self._stop_event.wait(max(next_due - monotonic(), 0))
+
+    def _next_interval(self) -> float:
+        mean = 1 / self._options.rate
+        burstiness = self._options.burstiness
+        if burstiness == 0:
+            return mean
+        # Gamma-distributed intervals with the given mean and coefficient of variation
+        shape = 1 / burstiness**2
+        return self._random.gammavariate(shape, mean / shape)
+
+    def _replay(self) -> None:
+        speed = self._options.replay_speed
+        origin: Optional[tuple[int, float]] = None
+        with open(self._options.replay_path, 'r',
+                  encoding='utf-8') as fp:  # type: ignore
+            for line in fp:
+                if self._stop_event.is_set():
+                    return
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    logger.warn('Skipping malformed line in %s',
+                                self._options.replay_path)
+                    continue
+
+                shape = self._options.shape
+                if isinstance(data.get('event', None), dict) \
+                        and 'timestamp' in data:
+                    if data.get('probe', None) in SHAPES:
+                        shape = data['probe']
+                    timestamp, data = data['timestamp'], data['event']
+                else:
+                    timestamp = time_ns()
+                data.setdefault('shape', shape)
+
+                if speed is not None:
+                    if origin is None:
+                        origin = (timestamp, monotonic())
+                    due = origin[1] + (timestamp - origin[0]) / 1e9 / speed
+                    if self._stop_event.wait(max(due - monotonic(), 0)):
+                        return
+                self._submit_event(ProbeEvent(timestamp, data))
+        logger.info('Finished replaying %s', self._options.replay_path)
+
+    def _build_flow(self) -> _Flow:
+        saddr_bytes = bytes((10, 0, self._random.randrange(256),
+                             self._random.randrange(1, 255)))
+        daddr_bytes = bytes((10, 1, self._random.randrange(256),
+                             self._random.randrange(1, 255)))
+        return _Flow(saddr=int.from_bytes(saddr_bytes, 'little'),
+                     sport=self._random.randrange(32768, 61000),
+                     daddr=int.from_bytes(daddr_bytes, 'little'),
+                     dport=self._random.choice((80, 443, 5201, 6379)),
+                     saddr_str=inet_ntop(AF_INET, saddr_bytes),
+                     daddr_str=inet_ntop(AF_INET, daddr_bytes),
+                     seq=self._random.getrandbits(32),
+                     ack=self._random.getrandbits(32))
+
+    def _next_flow(self) -> _Flow:
+        flow = self._random.choice(self._flows)
+        flow.seq = (flow.seq + self._random.choice((1, 1448, 2896))) % 2**32
+        return flow
+
+    def _latency_ns(self, median_ns: float) -> int:
+        # Latencies are roughly log-normal, with a long tail
+        return int(self._random.lognormvariate(0, 0.6) * median_ns)
+
+    def _generate_delay_analysis_out(self, ktime: int) -> dict[str, Any]:
+        flow = self._next_flow()
+        tcp_time = self._latency_ns(6000)
+        ip_time = self._latency_ns(2000)
+        qdisc_time = self._latency_ns(1500)
+        total_time = tcp_time + ip_time + qdisc_time
+        qdisc_timestamp = ktime - qdisc_time
+        return {
+            'raw': {
+                'ktime': ktime,
+                'saddr': flow.saddr,
+                'sport': flow.sport,
+                'daddr': flow.daddr,
+                'dport': flow.dport,
+                'seq': flow.seq,
+                'ack': flow.ack,
+                'qdisc_timestamp': qdisc_timestamp,
+                'total_time': total_time,
+                'qdisc_time': qdisc_time,
+                'ip_time': ip_time,
+                'tcp_time': tcp_time,
+            },
+            'parsed': {
+                'saddr': flow.saddr_str,
+                'sport': flow.sport,
+                'daddr': flow.daddr_str,
+                'dport': flow.dport,
+                'seq': flow.seq,
+                'ack': flow.ack,
+                'qdisc_timestamp': qdisc_timestamp / 1000,
+                'total_time': total_time / 1000,
+                'qdisc_time': qdisc_time / 1000,
+                'ip_time': ip_time / 1000,
+                'tcp_time': tcp_time / 1000,
+            },
+            'sample_ratio': 1.0,
+        }
+
+    def _generate_delay_analysis_in(self, ktime: int) -> dict[str, Any]:
+        flow = self._next_flow()
+        mac_time = self._latency_ns(1000)
+        ip_time = self._latency_ns(1500)
+        tcp_time = self._latency_ns(8000)
+        total_time = mac_time + ip_time + tcp_time
+        mac_timestamp = ktime - total_time
+        return {
+            'raw': {
+                'ktime': ktime,
+                'saddr': flow.daddr,
+                'sport': flow.dport,
+                'daddr': flow.saddr,
+                'dport': flow.sport,
+                'seq': flow.ack,
+                'ack': flow.seq,
+                'mac_timestamp': mac_timestamp,
+                'total_time': total_time,
+                'mac_time': mac_time,
+                'ip_time': ip_time,
+                'tcp_time': tcp_time,
+            },
+            'parsed': {
+                'saddr': flow.daddr_str,
+                'sport': flow.dport,
+                'daddr': flow.saddr_str,
+                'dport': flow.sport,
+                'seq': flow.ack,
+                'ack': flow.seq,
+                'mac_timestamp': mac_timestamp * 1e-9,
+                'total_time': total_time / 1000,
+                'mac_time': mac_time / 1000,
+                'ip_time': ip_time / 1000,
+                'tcp_time': tcp_time / 1000,
+            },
+            'sample_ratio': 1.0,
+        }
+
+    def _generate_runqslower(self, ktime: int) -> dict[str, Any]:
+        # Use flows as tasks, so that cardinality means the same thing
+        index = self._random.randrange(len(self._flows))
+        prev_index = self._random.randrange(len(self._flows))
+        return {
+            'pid': 1000 + index,
+            'tgid': 1000 + index,
+            'prev_pid': 1000 + prev_index,
+            'task': _TASK_NAMES[index % len(_TASK_NAMES)],
+            'prev_task': _TASK_NAMES[prev_index % len(_TASK_NAMES)],
+            'delta_us': self._latency_ns(400),
+            'kind': 'event',
+        }
+
+    def _generate_retsnoop(self, ktime: int) -> dict[str, Any]:
+        flow = self._next_flow()
+        tid = 1000 + self._random.randrange(len(self._flows))
+        task = _TASK_NAMES[tid % len(_TASK_NAMES)]
+        functions = {
+            name: self._latency_ns(5000) / 1000
+            for name in self._random.sample(_RETSNOOP_FUNCTIONS, 5)
+        }
+        functions['__tcp_transmit_skb'] = sum(functions.values())
+        return {
+            'timestamp':
+            Ktime.get_offset() + ktime,
+            'tid':
+            tid,
+            'pid':
+            tid,
+            'tname':
+            task,
+            'pname':
+            task,
+            'functions':
+            functions,
+            'flows': [{
+                'saddr': flow.saddr_str,
+                'sport': flow.sport,
+                'daddr': flow.daddr_str,
+                'dport': flow.dport,
+                'functions': dict(functions),
+            }],
+        }
+
+    @staticmethod
+    def _convert_options(
+            options: Union[None, dict[str, Any],
+                           ProbeOptions]) -> ProbeOptions:
+        if options is None:
+            return ProbeOptions()
+        elif isinstance(options, dict):
+            return ProbeOptions.from_dict(options)
+        elif isinstance(options, ProbeOptions):
+            return options
+        else:
+            raise RuntimeError(
+                'Unrecognized type of options {}'.format(options))
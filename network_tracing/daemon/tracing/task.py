@@ -1,11 +1,13 @@
 from collections import deque
 from datetime import datetime
 from queue import Queue
+from threading import Lock
 from typing import Any, Callable, Optional, Protocol, runtime_checkable
 
 from network_tracing.common.models import TracingEvent, TracingTaskOptions
 from network_tracing.daemon.models import BackgroundTask
 from network_tracing.daemon.tracing.probes import probe_factories
+from network_tracing.daemon.tracing.probes.models import BaseProbe
 from network_tracing.daemon.utilities import Ktime
 
 
@@ -65,12 +67,27 @@ class TracingTask(BackgroundTask):
         self._event_buffer: deque[TracingEvent] = deque(
             maxlen=self._options.events.buffer_length)
         self._event_queues: set[Queue[TracingEvent]] = set()
+        # Guards numbering, buffering and dispatching of events, so that events are buffered and queued in order of sequence numbers
+        self._event_lock = Lock()
+        self._next_seq = 0
         self._probes = self._bulid_probes(options.probes)
 
     @property
     def options(self):
         return self._options
 
+    @property
+    def details(self) -> dict[str, Any]:
+        """Runtime details reported by probes, keyed by probe type. Probes without details are omitted."""
+        details = {}
+        for probe_type, probe in self._probes.items():
+            if not isinstance(probe, BaseProbe):
+                continue
+            probe_details = probe.details()
+            if probe_details:
+                details[probe_type] = probe_details
+        return details
+
     def start(self) -> None:
         for probe in self._probes.values():
             probe.start()
@@ -79,11 +96,45 @@ class TracingTask(BackgroundTask):
         for probe in self._probes.values():
             probe.stop()
 
-    def get_event_poller(self) -> TracingEventPoller:
-        queue = TracingTask._QueueFromDeque(self._event_buffer)
-        self._event_queues.add(queue)
-
-        close_hook = lambda: self._event_queues.remove(queue)
+    def update(self, probes: dict[str, dict[str, Any]]) -> None:
+        """Update options of running probes in place, without rebuilding them."""
+        for probe_type in probes:
+            if probe_type not in self._probes:
+                raise ValueError(
+                    'Cannot find probe with type \'{}\' in this task'.format(
+                        probe_type))
+
+        # Check options of all probes first, so that invalid ones leave every probe unchanged
+        prepared = {
+            probe_type: self._probes[probe_type].prepare_options(probe_options)
+            for probe_type, probe_options in probes.items()
+        }
+        for probe_type, probe_options in probes.items():
+            self._probes[probe_type].apply_options(prepared[probe_type])
+
+            current_options = self._options.probes.get(probe_type, None)
+            if not isinstance(current_options, dict):
+                current_options = {}
+            self._options.probes[probe_type] = {
+                **current_options,
+                **probe_options
+            }
+
+    def get_event_poller(self,
+                         after: Optional[int] = None) -> TracingEventPoller:
+        """Get a poller of buffered events followed by new ones. If `after` is given, skip buffered events with sequence numbers up to it, e.g. those a reconnecting client has already seen."""
+        with self._event_lock:
+            # Take a snapshot, as probe threads keep appending to the buffer
+            event_buffer = self._event_buffer.copy()
+            if after is not None:
+                while event_buffer and event_buffer[0].seq <= after:
+                    event_buffer.popleft()
+            queue = TracingTask._QueueFromDeque(event_buffer)
+            self._event_queues.add(queue)
+
+        def close_hook():
+            with self._event_lock:
+                self._event_queues.remove(queue)
 
         event_poller = TracingEventPoller(queue=queue, close_hook=close_hook)
         return event_poller
@@ -100,9 +151,9 @@ class TracingTask(BackgroundTask):
             probes[probe_type] = probe_factory(event_callback, probe_options)
         return probes
 
-    def _build_event_callback(self, probe_type: str) -> Callable[[Any], Any]:
+    def _build_event_callback(self, probe_type: str) -> Callable[..., Any]:
 
-        def event_callback(event: Any):
+        def wrap_event(event: Any) -> TracingEvent:
             # Prefer timestamp passed from kernel space
             if isinstance(event, TimestampAvailable):
                 timestamp = event.__timestamp__()
@@ -111,12 +162,20 @@ class TracingTask(BackgroundTask):
             else:
                 timestamp = int(datetime.now().timestamp() * 1e9)
 
-            wrapped_event = TracingEvent(timestamp=timestamp,
-                                         probe=probe_type,
-                                         event=event)
-
-            self._event_buffer.append(wrapped_event)
-            for queue in self._event_queues:
-                queue.put(wrapped_event)
+            return TracingEvent(timestamp=timestamp,
+                                probe=probe_type,
+                                event=event)
+
+        def event_callback(*events: Any):
+            wrapped_events = [wrap_event(event) for event in events]
+
+            with self._event_lock:
+                for wrapped_event in wrapped_events:
+                    wrapped_event.seq = self._next_seq
+                    self._next_seq += 1
+                self._event_buffer.extend(wrapped_events)
+                for queue in self._event_queues:
+                    for wrapped_event in wrapped_events:
+                        queue.put(wrapped_event)
 
         return event_callback
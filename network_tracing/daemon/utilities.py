@@ -1,14 +1,25 @@
 import logging
+import os
+import re
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass, field
-from functools import cache
+from fnmatch import fnmatchcase
 from socket import AF_INET, AF_INET6, inet_pton
-from time import CLOCK_MONOTONIC, CLOCK_REALTIME, clock_gettime_ns
+from threading import Lock
+from time import CLOCK_MONOTONIC, CLOCK_REALTIME, clock_gettime_ns, monotonic
 from typing import Iterable, NoReturn, Optional, Protocol, Union
 
 from network_tracing.daemon.models import BackgroundTask
+from network_tracing.daemon.tracing.poller import Poller
 
 logger = logging.getLogger(__name__)
 
+KALLSYMS_PATH = '/proc/kallsyms'
+MODULES_PATH = '/proc/modules'
+
+MODULES_CHECK_INTERVAL = 1.0
+"""Minimum interval in seconds between checks of loaded kernel modules by `KernelSymbolTable`."""
+
 
 @dataclass
 class KernelSymbol:
@@ -26,8 +37,9 @@ class KernelSymbol:
     """Name of the module from which the kernel symbol comes. `None` if no module name is available."""
 
     @staticmethod
-    def find_all() -> Iterable['KernelSymbol']:
-        with open('/proc/kallsyms', 'r') as fp:
+    def find_all(path: str = KALLSYMS_PATH) -> Iterable['KernelSymbol']:
+        """Parse all symbols in `path`, which is in the format of /proc/kallsyms."""
+        with open(path, 'r') as fp:
             for line in fp:
                 segments = line.strip().split(maxsplit=3)
                 symbol_address, symbol_type, symbol_name = segments[:3]
@@ -42,12 +54,116 @@ class KernelSymbol:
                                    module_name=module_name)
 
     @staticmethod
-    def find_by_symbol_name(symbol_name: str) -> Optional['KernelSymbol']:
-        # TODO: Add cache
-        for symbol in KernelSymbol.find_all():
-            if symbol.symbol_name == symbol_name:
-                return symbol
-        return None
+    def find_by_symbol_name(
+            symbol_name: str,
+            path: str = KALLSYMS_PATH) -> Optional['KernelSymbol']:
+        return KernelSymbolTable.get_instance(path).find(symbol_name)
+
+
+class KernelSymbolTable:
+    """Kernel symbols indexed by name, built lazily on first lookup and rebuilt after kernel modules are loaded or unloaded.
+
+    Use `get_instance()` to share a single table across the daemon, so that /proc/kallsyms is scanned once rather than on each lookup.
+    """
+
+    _instances: dict[str, 'KernelSymbolTable'] = {}
+    _instances_lock = Lock()
+
+    def __init__(self,
+                 path: str = KALLSYMS_PATH,
+                 modules_path: str = MODULES_PATH) -> None:
+        self._path = path
+        self._modules_path = modules_path
+        self._lock = Lock()
+        self._symbols: dict[str, list[KernelSymbol]] = {}
+        self._names: list[str] = []
+        self._snapshot: Optional[tuple] = None
+        self._checked_at: Optional[float] = None
+
+    @classmethod
+    def get_instance(cls, path: str = KALLSYMS_PATH) -> 'KernelSymbolTable':
+        with cls._instances_lock:
+            instance = cls._instances.get(path, None)
+            if instance is None:
+                instance = cls(path)
+                cls._instances[path] = instance
+            return instance
+
+    def find(self, symbol_name: str) -> Optional[KernelSymbol]:
+        """Return the first symbol with exactly this name, or `None` if there is none."""
+        symbols = self._index()[0].get(symbol_name, None)
+        return symbols[0] if symbols else None
+
+    def find_all_by_name(self, symbol_name: str) -> list[KernelSymbol]:
+        """Return all symbols with exactly this name, e.g. static functions of the same name in different files."""
+        return list(self._index()[0].get(symbol_name, ()))
+
+    def find_by_prefix(self, prefix: str) -> list[KernelSymbol]:
+        symbols, names = self._index()
+        return [
+            symbol for name in self._names_with_prefix(names, prefix)
+            for symbol in symbols[name]
+        ]
+
+    def find_by_glob(self, pattern: str) -> list[KernelSymbol]:
+        """Return symbols whose names match a shell-style pattern, e.g. `tcp_*` or `finish_task_switch.isra.?`."""
+        symbols, names = self._index()
+        # Only names starting with the literal part of the pattern can match
+        prefix = re.split(r'[*?[]', pattern, maxsplit=1)[0]
+        return [
+            symbol for name in self._names_with_prefix(names, prefix)
+            if fnmatchcase(name, pattern) for symbol in symbols[name]
+        ]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
+
+    def _index(self) -> tuple[dict[str, list[KernelSymbol]], list[str]]:
+        with self._lock:
+            now = monotonic()
+            if self._snapshot is None or self._checked_at is None \
+                    or now - self._checked_at >= MODULES_CHECK_INTERVAL:
+                self._checked_at = now
+                snapshot = self._take_snapshot()
+                if snapshot != self._snapshot:
+                    if self._snapshot is not None:
+                        logger.debug(
+                            'Kernel modules changed; rebuilding symbol table')
+                    self._build()
+                    self._snapshot = snapshot
+            return self._symbols, self._names
+
+    def _build(self) -> None:
+        symbols: dict[str, list[KernelSymbol]] = {}
+        for symbol in KernelSymbol.find_all(self._path):
+            symbols.setdefault(symbol.symbol_name, []).append(symbol)
+        self._symbols = symbols
+        self._names = sorted(symbols)
+        logger.debug('Indexed %d kernel symbol name(s) from %s',
+                     len(self._names), self._path)
+
+    def _take_snapshot(self) -> tuple:
+        """Return something that changes whenever symbols in the table may have changed."""
+        try:
+            with open(self._modules_path, 'r') as fp:
+                # Name and load address of each module; other columns such as reference counts change all the time
+                modules = tuple((segments[0], segments[-1])
+                                for segments in map(str.split, fp) if segments)
+        except OSError:
+            modules = ()
+        if self._path == KALLSYMS_PATH:
+            return modules
+        # Regular files, e.g. in benchmarks, may be rewritten in place
+        return modules, os.stat(self._path).st_mtime_ns
+
+    @staticmethod
+    def _names_with_prefix(names: list[str], prefix: str) -> Iterable[str]:
+        for index in range(bisect_left(names, prefix), len(names)):
+            name = names[index]
+            if not name.startswith(prefix):
+                break
+            yield name
 
 
 class Ktime:
@@ -78,6 +194,13 @@ class Ktime:
 
 
 class IPMatcher:
+    """Match IP addresses against IP addresses or ranges (in CIDR notation).
+
+    Ranges are merged and sorted when compiled, so that each match is a binary search over disjoint ranges.
+    """
+
+    _Ranges = tuple[tuple[int, ...], tuple[int, ...]]
+    """Disjoint, sorted ranges `[start, end)`, as a tuple of starts and a tuple of ends."""
 
     def __init__(self, ips_or_cidrs: Union[str, Iterable[str]]) -> None:
         self._ip4_ranges, self._ip6_ranges = self._compile_ranges(ips_or_cidrs)
@@ -94,40 +217,79 @@ class IPMatcher:
     def match_ip6_bytes(self, ip_bytes: bytes) -> bool:
         return self._match_bytes(ip_bytes, self._ip6_ranges)
 
+    @staticmethod
+    def compile_prefixes(
+        ips_or_cidrs: Union[str, Iterable[str]]
+    ) -> tuple[tuple[tuple[bytes, int], ...], tuple[tuple[bytes, int], ...]]:
+        """Parse IP addresses or ranges (in CIDR notation) into `(network, prefix_length)` pairs of IPv4 and IPv6 respectively, where `network` is the masked address in network byte order."""
+
+        ip4_prefix_list: list[tuple[bytes, int]] = []
+        ip6_prefix_list: list[tuple[bytes, int]] = []
+
+        for is_ip6, start, prefix_length in IPMatcher._parse(ips_or_cidrs):
+            if is_ip6:
+                ip6_prefix_list.append(
+                    (start.to_bytes(16, byteorder='big'), prefix_length))
+            else:
+                ip4_prefix_list.append(
+                    (start.to_bytes(4, byteorder='big'), prefix_length))
+
+        return tuple(ip4_prefix_list), tuple(ip6_prefix_list)
+
     @staticmethod
     def _compile_ranges(
         ips_or_cidrs: Union[str, Iterable[str]]
-    ) -> tuple[tuple[tuple[int, int], ...], tuple[tuple[int, int], ...]]:
+    ) -> tuple['IPMatcher._Ranges', 'IPMatcher._Ranges']:
         ip4_range_list: list[tuple[int, int]] = []
         ip6_range_list: list[tuple[int, int]] = []
 
-        if not isinstance(ips_or_cidrs, Iterable):
+        for is_ip6, start, prefix_length in IPMatcher._parse(ips_or_cidrs):
+            if is_ip6:
+                ip6_range_list.append(
+                    (start, start + (0x01 << 128 - prefix_length)))
+            else:
+                ip4_range_list.append(
+                    (start, start + (0x01 << 32 - prefix_length)))
+
+        return IPMatcher._merge_ranges(
+            ip4_range_list), IPMatcher._merge_ranges(ip6_range_list)
+
+    @staticmethod
+    def _merge_ranges(ranges: list[tuple[int, int]]) -> 'IPMatcher._Ranges':
+        starts: list[int] = []
+        ends: list[int] = []
+        for start, end in sorted(ranges):
+            # Overlapping or adjacent to the previous range
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return tuple(starts), tuple(ends)
+
+    @staticmethod
+    def _parse(
+        ips_or_cidrs: Union[str, Iterable[str]]
+    ) -> Iterable[tuple[bool, int, int]]:
+        """Yield `(is_ip6, start, prefix_length)` for each of given IP addresses or ranges (in CIDR notation)."""
+
+        if isinstance(ips_or_cidrs,
+                      str) or not isinstance(ips_or_cidrs, Iterable):
             ips_or_cidrs = [ips_or_cidrs]
 
         for ip_or_cidr in ips_or_cidrs:
             ip, block, *dummy = (*ip_or_cidr.split('/', maxsplit=1), None)
             if IPMatcher._is_ip6(ip):  # IPv6
-                ip_binary = IPMatcher._binary_from_bytes(
-                    inet_pton(AF_INET6, ip))
-                if block is None:
-                    ip6_range_list.append((ip_binary, ip_binary + 1))
-                else:
-                    block = int(block)
-                    start = ip_binary & ~((0x01 << 128 - block) - 1)
-                    end = start + (0x01 << 128 - block)
-                    ip6_range_list.append((start, end))
+                family, bits = AF_INET6, 128
             else:  # IPv4
-                ip_binary = IPMatcher._binary_from_bytes(inet_pton(
-                    AF_INET, ip))
-                if block is None:
-                    ip4_range_list.append((ip_binary, ip_binary + 1))
-                else:
-                    block = int(block)
-                    start = ip_binary & ~((0x01 << 32 - block) - 1)
-                    end = start + (0x01 << 32 - block)
-                    ip4_range_list.append((start, end))
-
-        return tuple(ip4_range_list), tuple(ip6_range_list)
+                family, bits = AF_INET, 32
+            ip_binary = IPMatcher._binary_from_bytes(inet_pton(family, ip))
+            prefix_length = bits if block is None else int(block)
+            if prefix_length < 0 or prefix_length > bits:
+                raise ValueError(
+                    'Invalid prefix length in {}'.format(ip_or_cidr))
+            start = ip_binary & ~((0x01 << bits - prefix_length) - 1)
+            yield IPMatcher._is_ip6(ip), start, prefix_length
 
     @staticmethod
     def _is_ip6(ip: str) -> bool:
@@ -138,18 +300,16 @@ class IPMatcher:
         return int.from_bytes(b, byteorder='big', signed=False)
 
     @staticmethod
-    @cache
-    def _match_bytes(ip_bytes: bytes, ip_ranges: tuple[tuple[int, int],
-                                                       ...]) -> bool:
+    def _match_bytes(ip_bytes: bytes, ip_ranges: 'IPMatcher._Ranges') -> bool:
+        starts, ends = ip_ranges
         ip_binary = IPMatcher._binary_from_bytes(ip_bytes)
-        for ip_range in ip_ranges:
-            start, end = ip_range
-            if ip_binary >= start and ip_binary < end:
-                logger.debug(
-                    'Found matching range [0x%x, 0x%x) for IP 0x%x (%s)',
-                    start, end, ip_binary, ip_bytes)
-                return True
-        return False
+        # The only range that can contain the IP is the last one starting at or before it
+        index = bisect_right(starts, ip_binary) - 1
+        if index < 0 or ip_binary >= ends[index]:
+            return False
+        logger.debug('Found matching range [0x%x, 0x%x) for IP 0x%x (%s)',
+                     starts[index], ends[index], ip_binary, ip_bytes)
+        return True
 
 
 class _Application(Protocol):
@@ -163,6 +323,7 @@ class _Application(Protocol):
 @dataclass
 class _GlobalState:
     application: Optional[_Application] = field(default=None)
+    poller: Optional[Poller] = field(default=None)
 
 
 global_state = _GlobalState()
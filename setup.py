@@ -21,6 +21,14 @@ INSTALL_REQUIRES = [
     'requests',
     'influxdb-client[ciso]',
 ]
+EXTRAS_REQUIRE = {
+    # Columnar recording of events by `ntctl events -a record`
+    'record': ['pyarrow'],
+    # Faster decoding of events by `ntctl`
+    'fast': ['orjson'],
+    # Offline analysis of recorded events by `ntctl analyze`
+    'analyze': ['numpy'],
+}
 SETUP_REQUIRES = [
     'setuptools-git-versioning<2',
 ]
@@ -38,6 +46,7 @@ if __name__ == '__main__':
         packages=find_packages(include=PACKAGE_PATTERNS),
         entry_points=ENTRY_POINTS,
         install_requires=INSTALL_REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         setup_requires=SETUP_REQUIRES,
         python_requires=PYTHON_REQUIRES,
         include_package_data=True,